@@ -7,4 +7,18 @@ import frappe
 from frappe.model.document import Document
 
 class ZSW(Document):
-	pass
+	def on_update(self):
+		# the sync status is saved on every fetch: only drop cached client and level map on configuration changes
+		before = self.get_doc_before_save()
+		if before and get_configuration(before) == get_configuration(self):
+			return
+		from finkzeit.finkzeit.zsw import clear_zsw_level_cache, reset_client, clear_sync_fingerprints
+		clear_zsw_level_cache()
+		reset_client()
+		# another ZSW instance: the stored fingerprints are not valid anymore
+		if before and (before.endpoint, before.license) != (self.endpoint, self.license):
+			clear_sync_fingerprints()
+
+def get_configuration(zsw):
+	return (zsw.endpoint, zsw.license, zsw.user, zsw.password, zsw.concurrent_ws_sessions, zsw.session_idle_timeout,
+		[(f.erp_doctype, f.zsw_level) for f in zsw.field_configurations])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+import io
+from finkzeit.finkzeit.zsw import ZSWBooking, iterparse_bookings, get_booking_materials, group_bookings
+
+LEVELS = {1: "Customer", 2: "Item (Activity)", 3: "Invoicing Type", 4: "Sales Order"}
+
+BOOKING_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>
+<ns2:getBookingPairsResponse xmlns:ns2="urn:test">
+<return><fromBookingID>1000</fromBookingID><toBookingID>1001</toBookingID><person>7</person><duration>90</duration>
+<notice>Remote support</notice>
+<from><timeInSeconds>1767261600</timeInSeconds><timestamp>01.01.2026 10:00</timestamp><day>1</day><month>1</month><year>2026</year><hour>10</hour><min>0</min></from>
+<to><timeInSeconds>1767267000</timeInSeconds><timestamp>01.01.2026 11:30</timestamp><day>1</day><month>1</month><year>2026</year><hour>11</hour><min>30</min></to>
+<levels><WSLevelIdentification><levelID>1</levelID><code>00123</code></WSLevelIdentification>
+<WSLevelIdentification><levelID>2</levelID><code>T01</code></WSLevelIdentification>
+<WSLevelIdentification><levelID>3</levelID><code>J</code></WSLevelIdentification></levels>
+<properties><WSProperty><key>2</key><val>Max Muster</val></WSProperty>
+<WSProperty><key>14</key><val>2 7/3010</val></WSProperty></properties></return>
+<return><fromBookingID>1002</fromBookingID><toBookingID>1003</toBookingID><person>8</person><duration>30</duration>
+<from><timeInSeconds>1767351600</timeInSeconds><timestamp>02.01.2026 11:00</timestamp><day>2</day><month>1</month><year>2026</year><hour>11</hour><min>0</min></from>
+<to><timeInSeconds>1767353400</timeInSeconds><timestamp>02.01.2026 11:30</timestamp><day>2</day><month>1</month><year>2026</year><hour>11</hour><min>30</min></to>
+<levels><WSLevelIdentification><levelID>1</levelID><code>CH00456</code></WSLevelIdentification>
+<WSLevelIdentification><levelID>2</levelID><code>T02</code></WSLevelIdentification>
+<WSLevelIdentification><levelID>4</levelID><code>CHAB-00001</code></WSLevelIdentification></levels>
+<properties></properties></return>
+</ns2:getBookingPairsResponse></S:Body></S:Envelope>"""
+
+class TestZSWBooking(unittest.TestCase):
+	def test_iterparse_bookings(self):
+		bookings = list(iterparse_bookings(io.BytesIO(BOOKING_RESPONSE), LEVELS))
+		self.assertEqual([b.booking_id for b in bookings], [1000, 1002])
+		booking = bookings[0]
+		self.assertEqual(booking.person, 7)
+		self.assertEqual(booking.duration, 90)
+		self.assertEqual(booking.notice, "Remote support")
+		self.assertEqual((booking.customer, booking.activity, booking.invoice_type, booking.sales_order), ("00123", "T01", "J", None))
+		self.assertEqual(booking.date, "01.01.2026")
+		self.assertEqual((booking.hour, booking.minute), (10, 0))
+		self.assertEqual((booking.time_in_seconds, booking.to_time_in_seconds), (1767261600, 1767267000))
+		self.assertEqual(booking.properties, ((2, "Max Muster"), (14, "2 7/3010")))
+		self.assertEqual(booking.contact, "Max Muster")
+		booking = bookings[1]
+		self.assertEqual((booking.customer, booking.activity, booking.sales_order), ("CH00456", "T02", "CHAB-00001"))
+		self.assertIsNone(booking.notice)
+		self.assertEqual(booking.properties, ())
+
+	def test_get_hours(self):
+		self.assertEqual(ZSWBooking(1, duration=90).get_hours(), 1.5)
+		self.assertEqual(ZSWBooking(1, duration=20).get_hours(), 0.4)
+		booking = ZSWBooking(1, duration=90, properties=((15, "2:15"),))
+		self.assertEqual(booking.get_hours(), 2.25)
+		self.assertEqual(booking.get_hours(allow_override=False), 1.5)
+		self.assertEqual(ZSWBooking(1, duration=60, properties=((15, "invalid"),)).get_hours(), 1.0)
+
+	def test_get_booking_materials(self):
+		booking = ZSWBooking(1, properties=((2, "Max Muster"), (14, "2 7/3010"), (11, "6/1"), (11, "9/9"),
+			(12, "45"), (13, "120"), (14, "invalid")))
+		self.assertEqual(get_booking_materials(booking, "Main - FZAT"),
+			[("3010", 2.0), ("3031", 1.0), ("3026", 0.8), ("3007", 120.0)])
+		self.assertEqual(get_booking_materials(booking, "Tirol - FZT")[-1], ("3008", 120.0))
+		self.assertEqual(get_booking_materials(booking, generic=True), [("3010", 2.0)])
+
+	def test_group_bookings(self):
+		bookings = [ZSWBooking(1, customer="00123"), ZSWBooking(2), ZSWBooking(3, customer="00123")]
+		booking_index = group_bookings(bookings)
+		self.assertEqual([b.booking_id for b in booking_index["00123"]], [1, 3])
+		self.assertEqual([b.booking_id for b in booking_index[None]], [2])
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+# import frappe
+from frappe.model.document import Document
+
+class ZSWBooking(Document):
+	def autoname(self):
+		self.name = "{0}".format(self.booking_id)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from finkzeit.finkzeit.zsw import ZSWBooking, partition_bookings
+
+def get_run(tenant="AT", kst_filter=None, service_filter=None):
+	return {'tenant': tenant, 'kst_filter': kst_filter, 'service_filter': service_filter}
+
+class TestZSWInvoiceRun(unittest.TestCase):
+	def test_partition_bookings(self):
+		booking_index = {
+			"00001": [ZSWBooking(1, customer="00001", activity="T01"), ZSWBooking(2, customer="00001", activity="T03")],
+			"00002": [ZSWBooking(3, customer="00002", activity="T01")],
+			"CH00003": [ZSWBooking(4, customer="CH00003", activity="T01")],
+			None: [ZSWBooking(5, activity="T01")]
+		}
+		runs = [get_run(kst_filter="Wien - FZAT", service_filter="T01"), get_run(), get_run(tenant="CH")]
+		contexts = {
+			"AT": {'customers': {"K-00001": {'kostenstelle': "Wien - FZAT"}, "K-00002": {'kostenstelle': "Graz - FZAT"}}},
+			"CH": {'customers': {}}
+		}
+		partitions = partition_bookings(booking_index, runs, contexts)
+		get_ids = lambda partition: dict((c, [b.booking_id for b in bookings]) for c, bookings in partition.items())
+		# first matching run wins, bookings without customer are not invoiced
+		self.assertEqual(get_ids(partitions[0]), {"00001": [1]})
+		self.assertEqual(get_ids(partitions[1]), {"00001": [2], "00002": [3]})
+		self.assertEqual(get_ids(partitions[2]), {"CH00003": [4]})
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+import frappe
+from frappe.model.document import Document
+
+class ZSWInvoiceRun(Document):
+	def autoname(self):
+		# the run ID is assigned when the run is enqueued
+		self.name = self.flags.run_id or frappe.generate_hash(length=10)
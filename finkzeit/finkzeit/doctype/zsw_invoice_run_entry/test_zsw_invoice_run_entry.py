@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+
+class TestZSWInvoiceRunEntry(unittest.TestCase):
+	pass
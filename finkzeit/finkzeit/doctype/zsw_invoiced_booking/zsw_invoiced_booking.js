@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Fink Zeitsysteme/libracore and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('ZSW Invoiced Booking', {
+	refresh: function(frm) {
+
+	}
+});
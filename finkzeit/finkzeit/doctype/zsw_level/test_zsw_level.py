@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from finkzeit.finkzeit.zsw import diff_levels
+
+def get_level(text, active=1, extension_hash=None):
+	return {'text': text, 'active': active, 'extension_hash': extension_hash}
+
+class TestZSWLevel(unittest.TestCase):
+	def test_diff_levels(self):
+		expected = {
+			"00001": ({'text': "Muster, Wien", 'active': 1}, {'customer': "K-00001"}),
+			"00002": ({'text': "Beispiel, Graz", 'active': 0}, {'customer': "K-00002"}),
+			"00003": ({'text': "Neu, Linz", 'active': 1}, {'customer': "K-00003"})
+		}
+		mirror = {
+			"00001": get_level("Muster, Wien"),
+			"00002": get_level("Beispiel, Wien"),
+			"00004": get_level("Alt, Salzburg"),
+			"00005": get_level("Inaktiv, Salzburg", active=0),
+			"CH00006": get_level("Schweiz, Zürich")
+		}
+		drift = diff_levels(expected, mirror, "AT")
+		self.assertEqual(drift['in_sync'], 1)
+		self.assertEqual(drift['missing'], ["00003"])
+		self.assertEqual(drift['changed'], [{'code': "00002", 'fields': ["text", "active"]}])
+		# inactive levels and codes of other tenants are not orphaned
+		self.assertEqual(drift['orphaned'], ["00004"])
+		self.assertEqual(sorted(drift['records'].keys()), ["00002", "00003"])
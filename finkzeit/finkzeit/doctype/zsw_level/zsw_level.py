@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and contributors
+# For license information, please see license.txt
+
+from __future__ import unicode_literals
+# import frappe
+from frappe.model.document import Document
+
+class ZSWLevel(Document):
+	def autoname(self):
+		from finkzeit.finkzeit.zsw import get_level_key
+		self.name = get_level_key(self.level_id, self.code)
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from finkzeit.finkzeit.zsw import get_payload_fingerprint, get_changed_payloads
+
+class TestZSWSyncRecord(unittest.TestCase):
+	def test_payload_fingerprint(self):
+		payload = {'customer': "K-00001", 'text': "Muster, Wien", 'active': True, 'kst_code': None}
+		self.assertEqual(get_payload_fingerprint(payload),
+			get_payload_fingerprint({'kst_code': None, 'active': True, 'text': "Muster, Wien", 'customer': "K-00001"}))
+		self.assertNotEqual(get_payload_fingerprint(payload), get_payload_fingerprint(dict(payload, text="Muster, Graz")))
+		self.assertNotEqual(get_payload_fingerprint(payload), get_payload_fingerprint(dict(payload, active=False)))
+
+	def test_changed_payloads_forced(self):
+		payloads = {"K-00001": {'text': "Muster, Wien"}, "K-00002": {'text': "Beispiel, Graz"}}
+		fingerprints = get_changed_payloads("Customer", payloads, "AT", force=True)
+		self.assertEqual(fingerprints, dict((name, get_payload_fingerprint(payload)) for name, payload in payloads.items()))
@@ -0,0 +1,24 @@
+frappe.listview_settings['ZSW Sync Record'] = {
+    get_indicator: function(doc) {
+        var colors = {
+            'Queued': 'orange',
+            'Syncing': 'blue',
+            'Synced': 'green',
+            'Failed': 'red'
+        };
+        if (doc.status) {
+            return [__(doc.status), colors[doc.status], "status,=," + doc.status];
+        }
+    },
+    onload: function(listview) {
+        listview.page.add_menu_item( __("Retry failed pushes"), function() {
+            frappe.call({
+                "method": "finkzeit.finkzeit.zsw.retry_failed_pushes",
+                "callback": function(response) {
+                    frappe.show_alert( __("Failed pushes queued") );
+                    listview.refresh();
+                }
+            });
+        });
+    }
+}
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2026, Fink Zeitsysteme/libracore and Contributors
+# See license.txt
+from __future__ import unicode_literals
+
+import frappe
+import unittest
+from finkzeit.finkzeit.zsw import decode_booking_ids
+
+class TestZSWUnmarkedBooking(unittest.TestCase):
+	def test_decode_booking_ids(self):
+		self.assertEqual(decode_booking_ids(None), [])
+		self.assertEqual(decode_booking_ids(""), [])
+		self.assertEqual(decode_booking_ids([1, "2"]), [1, 2])
+		self.assertEqual(decode_booking_ids("[1, 2, 3]"), [1, 2, 3])
+		self.assertEqual(decode_booking_ids("(4, 5)"), [4, 5])
+		self.assertEqual(decode_booking_ids("6"), [6])
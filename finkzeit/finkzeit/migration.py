@@ -13,7 +13,7 @@ import csv
 import codecs
 from datetime import datetime
 from openpyxl import load_workbook
-from finkzeit.finkzeit.zsw import create_update_customer
+from finkzeit.finkzeit.zsw import create_update_customers, get_zsw_reference
 from frappe.utils import cint
 
 # column allocation
@@ -389,30 +389,33 @@ def correct_dl_kst():
             frappe.db.sql(sql_query, as_dict=True)
     return
 
-def send_customers_to_zsw(tenant, ignore_checked=1, select_customers=None):
+def send_customers_to_zsw(tenant, ignore_checked=1, select_customers=None, force=False):
     print("Sending all customers to ZSW...")
-    customers = frappe.get_all("Customer", fields=['name'])
-    for customer_number in customers:
-        if select_customers and customer_number['name'] not in select_customers:
+    customers = frappe.get_all("Customer", fields=['name', 'customer_name', 'disabled', 'is_checked', 'kostenstelle'])
+    zsw_customers = []
+    for customer in customers:
+        if select_customers and customer['name'] not in select_customers:
             continue
-        customer = frappe.get_doc("Customer", customer_number['name'])
-        if tenant.lower() == "ch":
-            zsw_ref = "CH" + customer.name[2:]
-        else:
-            zsw_ref = customer.name[2:]
         if ignore_checked == 1:
-            if customer.disabled:
+            if customer['disabled']:
                 active = False
             else:
                 active = True
         else:
-            if not customer.disabled and customer.is_checked:
+            if not customer['disabled'] and customer['is_checked']:
                 active = True
             else:
                 active = False
-        print("Updating {0} > {1} (active: {2}, kst: {3}".format(customer.name, zsw_ref, active, customer.kostenstelle))
-        create_update_customer(customer.name, customer.customer_name, active=active, kst=customer.kostenstelle, tenant=tenant)
-    print("Done. Please check the ERP error log for potential errors.")
+        print("Updating {0} > {1} (active: {2}, kst: {3}".format(customer['name'], get_zsw_reference(customer['name'], tenant), active, customer['kostenstelle']))
+        zsw_customers.append({
+            'customer': customer['name'],
+            'customer_name': customer['customer_name'],
+            'active': active,
+            'kst': customer['kostenstelle']
+        })
+    summary = create_update_customers(zsw_customers, tenant=tenant, force=force)
+    print("Done ({0} updated, {1} created, {2} unchanged, {3} failed). Please check the ERP error log for potential errors.".format(
+        summary['updated'], summary['created'], summary['skipped'], len(summary['failed'])))
     return
 
 """
@@ -420,21 +423,23 @@ This function will check and update all customers in ZSW
 
 Run from bench as
  $ bench execute finkzeit.finkzeit.migration.update_all_active_customers
+
+Only customers with changes since the last sync are sent, to push all customers run
+ $ bench execute finkzeit.finkzeit.migration.update_all_active_customers --kwargs "{'force': 1}"
 """
-def update_all_active_customers(tenant="AT"):
+def update_all_active_customers(tenant="AT", force=False):
     customers = frappe.get_all("Customer", fields=['name', 'customer_name', 'short_name', 'technik', 'disabled'])
+    zsw_customers = []
     for c in customers:
-        print("Updating {0}...".format(c['name']))
-        try:
-            create_update_customer(
-                customer=c['name'], 
-                customer_name=c['customer_name'], 
-                active=False if cint(c['disabled']) else True, 
-                tenant=tenant, 
-                technician=c['technik'], 
-                short_name=c['short_name']
-            )
-        except Exception as e:
-            print("Failed: {0}".format(e))
-        
+        zsw_customers.append({
+            'customer': c['name'], 
+            'customer_name': c['customer_name'], 
+            'active': False if cint(c['disabled']) else True, 
+            'technician': c['technik'], 
+            'short_name': c['short_name']
+        })
+    print("Updating {0} customers...".format(len(zsw_customers)))
+    summary = create_update_customers(zsw_customers, tenant=tenant, force=force)
+    print("Done ({0} updated, {1} created, {2} unchanged, {3} failed)".format(
+        summary['updated'], summary['created'], summary['skipped'], len(summary['failed'])))
     return
@@ -9,11 +9,27 @@ import frappe
 from frappe import _
 from lxml import etree
 from zeep import Client, Settings
-from time import time
-from datetime import datetime, time as dt_time
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+from zeep.helpers import serialize_object
+import hashlib
+import json
+import ast
+import os
+import uuid
+import atexit
+import threading
+import pytz
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time, sleep
+from croniter import croniter
+from datetime import datetime, timedelta, time as dt_time
 from frappe.utils.background_jobs import enqueue
 from finkzeit.finkzeit.doctype.licence.licence import create_invoice, create_delivery_note
 from frappe.utils.password import get_decrypted_password
+from frappe.utils import cint, now, now_datetime, get_datetime, get_time_zone
 
 ENUM_ACTION = {
     'NONE': 0,
@@ -23,103 +39,346 @@ ENUM_ACTION = {
     'REPLACE': 4
 }
 
+# default ZSW levels per ERPNext data structure (if not set in the field configuration)
+DEFAULT_ZSW_LEVELS = {
+    'Customer': 1,
+    'Item (Activity)': 2,
+    'Item (Material)': 7,
+    'Invoicing Type': 3,
+    'Sales Order': 4
+}
+
+# level map cache, shared by all processes (see get_zsw_levels)
+ZSW_LEVEL_CACHE_KEY = "zsw_level_map"
+
+# WSDL/XSD cache lifetime [s]
+WSDL_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+# process-level SOAP client stub and session pool, created on first use (see get_client, get_session_pool)
+client = None
+session_pool = None
+# process-level switch for the local sync state (sync fingerprints, booking store, employee cache, invoiced
+#  booking ledger, last sync time): off while the module runs against another ZSW instance, e.g. the stand-in (see use_standin)
+persist_state = True
+
+# number of customers per bulk call
+CUSTOMER_CHUNK_SIZE = 100
+# number of item levels (materials, activities) per createLevels call
+ITEM_CHUNK_SIZE = 500
+# marking bookings (checkBookings): initial/min/max page size, target latency [s], retries, backoff [s]
+MARK_PAGE_SIZE = 100
+MARK_PAGE_SIZE_MIN = 25
+MARK_PAGE_SIZE_MAX = 1000
+MARK_TARGET_LATENCY = 2
+MARK_RETRIES = 3
+MARK_BACKOFF = 5
+
+# push queue (form-triggered updates): coalescing window [s], records per batch, consumer lock timeout [s]
+PUSH_COALESCE_WINDOW = 10
+PUSH_BATCH_SIZE = 200
+PUSH_LOCK_TIMEOUT = 30 * 60
+
+# structures mirrored locally (see refresh_level_mirror)
+MIRROR_STRUCTURES = ("Customer", "Sales Order", "Item (Activity)", "Item (Material)")
+# customer extensions compared by the reconciliation (extension: customer payload key); the licence
+#  name is only pushed when set and is therefore not compared
+CUSTOMER_EXTENSIONS = OrderedDict([
+    ('p_ortKunde', 'city'),
+    ('p_strasseKunde', 'street'),
+    ('p_plzKunde', 'pincode'),
+    ('p_mailadresseKunde', 'email'),
+    ('p_telefonnummer', 'phone'),
+    ('p_projektverantwortlicher', 'technician')
+])
+
+# booking store: re-pulled overlap before the watermark [s] (late or changed bookings), insert batch size
+BOOKING_STORE_OVERLAP = 2 * 24 * 60 * 60
+BOOKING_STORE_BATCH_SIZE = 500
+# scheduled booking pull: sync state, default schedule, lock timeout [s], max. wait for a running pull [s]
+BOOKING_STORE_STATE = "Booking Store"
+BOOKING_PULL_CRON = "*/5 * * * *"
+BOOKING_PULL_LOCK_TIMEOUT = 60 * 60
+BOOKING_PULL_LOCK_WAIT = 60 * 60
+
+# parallel invoice runs: job timeout [s], a sub-run without journal activity for longer is finished by the sweeper
+INVOICE_CHUNK_TIMEOUT = 15000
+INVOICE_RUN_STALL_TIMEOUT = INVOICE_CHUNK_TIMEOUT + 15 * 60
+# bookings handed over to the jobs of a run in redis (without booking store) expire after [s]
+RUN_BOOKINGS_CACHE_TTL = 7 * 24 * 60 * 60
+
+# batch delivery: the shared booking fetch covers at most this period [s], older orders are fetched by project level
+PROJECT_FETCH_MAX_WINDOW = 92 * 24 * 60 * 60
+
+# employee directory cache (see get_employees)
+EMPLOYEE_CACHE_KEY = "zsw_employees"
+EMPLOYEE_CACHE_TTL = 12 * 60 * 60
+
+# session pool timing [s]
+SESSION_REFRESH_INTERVAL = 5 * 60
+LEASE_TIMEOUT = 5 * 60
+SLOT_KEEPALIVE_INTERVAL = 30
+
+# redis scripts for session slots (and the booking pull lock): only the owner (token) extends or frees a slot
+SLOT_TOUCH_SCRIPT = """if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0"""
+SLOT_RELEASE_SCRIPT = """if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0"""
+
+""" SOAP client """
+def get_client():
+    global client
+    if not client:
+        endpoint = frappe.db.get_single_value("ZSW", "endpoint")
+        # cache WSDL/XSD documents on disk so that a new worker does not need to download them
+        cache = SqliteCache(path=get_wsdl_cache_path(endpoint), timeout=WSDL_CACHE_TIMEOUT)
+        # with settings
+        #settings = Settings(strict=False, xml_huge_tree=True)
+        settings = Settings(strict=True, xml_huge_tree=False)
+        client = Client(endpoint, settings=settings, transport=Transport(cache=cache))
+        print("SOAP client stub initialized")
+    return client
+
+# one cache file per endpoint
+def get_wsdl_cache_path(endpoint):
+    return frappe.get_site_path("private", "files", "zsw_wsdl_cache_{0}.db".format(
+        hashlib.md5((endpoint or "").encode("utf-8")).hexdigest()))
+
+# drop client and sessions (e.g. when the endpoint has been changed)
+def reset_client():
+    global client, session_pool
+    disconnect()
+    client = None
+    session_pool = None
+    return
+
 """ Low-level connect/disconnect """
-def getSession():
-    global session
-    if not 'session' in globals():
-        session = None
+class ZSWSessionPool(object):
+    # leases authenticated ZSW sessions to callers, at most concurrent_ws_sessions sessions are open
+    # across all workers of the site (one slot in redis per open session); the SOAP client is built
+    # up front, so that worker threads never need frappe (site, config) to reach it.
+    # A slot is owned by one entry (token) and expires idle_timeout + 60 s after its last use; while
+    # a session is leased, a keepalive thread extends its slot, so that long calls keep it. The same
+    # thread closes sessions that have been idle for idle_timeout, so that a process that does not
+    # lease again (and does not run the after_request hook) does not keep them open
+    def __init__(self, site, license, user, password, size=2, idle_timeout=600, client=None):
+        self.client = client or get_client()
+        self.site = site
+        self.license = license
+        self.user = user
+        self.password = password
+        self.size = max(1, int(size or 1))
+        self.idle_timeout = int(idle_timeout or 600)
+        self.cache = frappe.cache()
+        self.idle = []                          # idle entries, most recently used last
+        self.leased = {}                        # leased entries (token: entry)
+        self.keepalive = None                   # keepalive thread while entries are leased or idle
+        self.lock = threading.Lock()
+        self.local = threading.local()          # nested leases within one thread share the session
+
+    def get_slot_key(self, slot):
+        return "{0}|zsw_session_slot|{1}".format(self.site, slot)
+
+    def acquire_slot(self, token):
+        for slot in range(0, self.size):
+            if self.cache.set(self.get_slot_key(slot), token, nx=True, ex=self.idle_timeout + 60):
+                return slot
+        return None
+
+    # extend the slot, returns False if it has expired (and may have been taken by another process)
+    def touch_slot(self, entry):
+        return bool(self.cache.eval(SLOT_TOUCH_SCRIPT, 1, self.get_slot_key(entry['slot']),
+            entry['token'], self.idle_timeout + 60))
+
+    def release_slot(self, entry):
+        self.cache.eval(SLOT_RELEASE_SCRIPT, 1, self.get_slot_key(entry['slot']), entry['token'])
+
+    def open(self, slot, token):
+        entry = {'session': None, 'slot': slot, 'token': token, 'last_used': time(), 'last_refresh': time()}
+        try:
+            entry['session'] = self.client.service.openSession(self.license)
+            print("Session: {0} created".format(entry['session']))
+            # try to authenticate session
+            login_result = self.client.service.login(entry['session'], self.user, self.password)
+            if login_result != 0:
+                raise Exception("Login failed ({0})".format(login_result))
+        except Exception as err:
+            self.close(entry)
+            raise Exception("Failed creating new ZSW session: {0}".format(err))
+        return entry
 
-    if session:
+    def refresh(self, entry):
         try:
-            session = client.service.refreshSession(session)
-            if session:
-                print("Session: {0} refreshed".format(session))
-                # return a refreshed and authenticated session
-                return session
-        except:
-            print("Old Session expired, creating new one")
+            entry['session'] = self.client.service.refreshSession(entry['session'])
+            if entry['session']:
+                entry['last_refresh'] = time()
+                print("Session: {0} refreshed".format(entry['session']))
+                return entry
+        except Exception as err:
+            print("Session expired ({0})".format(err))
+        self.close(entry)
+        return None
 
-    try:
-        #create a new session
-        session = client.service.openSession(config.license)
-        print("Session: {0}  created".format(session))
-        pw = get_decrypted_password("ZSW", "ZSW", 'password', False)
-        # try to authenticate session
-        login_result = client.service.login(session, config.user, pw)
-        if login_result != 0:
-            client.service.closeSession(session)
-            session = None
-    except:
-        print("Failed creating new session")
-        session = None
+    def close(self, entry):
+        if entry['session']:
+            try:
+                self.client.service.logout(entry['session'])
+                self.client.service.closeSession(entry['session'])
+            except Exception as err:
+                print("Closing session {0} failed ({1})".format(entry['session'], err))
+        entry['session'] = None
+        self.release_slot(entry)
+
+    def close_idle(self, force=False):
+        with self.lock:
+            expired = [e for e in self.idle if force or (time() - e['last_used']) > self.idle_timeout]
+            self.idle = [e for e in self.idle if e not in expired]
+        for entry in expired:
+            self.close(entry)
+
+    def lease(self, timeout=LEASE_TIMEOUT):
+        entry = getattr(self.local, 'entry', None)
+        if entry:
+            self.local.depth += 1
+            return entry
+        self.close_idle()
+        deadline = time() + timeout
+        while not entry:
+            with self.lock:
+                entry = self.idle.pop() if self.idle else None
+            if entry:
+                # refresh on a timer
+                if (time() - entry['last_refresh']) > SESSION_REFRESH_INTERVAL:
+                    entry = self.refresh(entry)
+                if entry and not self.touch_slot(entry):
+                    # the slot expired while the session was idle: drop the session
+                    self.close(entry)
+                    entry = None
+                continue
+            token = "{0}:{1}".format(os.getpid(), uuid.uuid4().hex)
+            slot = self.acquire_slot(token)
+            if slot is not None:
+                entry = self.open(slot, token)
+            elif time() > deadline:
+                raise Exception("No ZSW session available (limit of {0} concurrent sessions reached)".format(self.size))
+            else:
+                sleep(0.2)
+        self.local.entry = entry
+        self.local.depth = 1
+        with self.lock:
+            self.leased[entry['token']] = entry
+            if not self.keepalive:
+                self.keepalive = threading.Thread(target=self.keep_alive, name="zsw-session-keepalive")
+                self.keepalive.daemon = True
+                self.keepalive.start()
+        return entry
+
+    # keepalive thread: extends the slots of leased sessions and closes expired idle sessions, ends
+    # when no session is open
+    def keep_alive(self):
+        while True:
+            sleep(SLOT_KEEPALIVE_INTERVAL)
+            with self.lock:
+                entries = list(self.leased.values())
+                if not entries and not self.idle:
+                    self.keepalive = None
+                    return
+            for entry in entries:
+                try:
+                    if not self.touch_slot(entry):
+                        print("Session slot {0} expired during a call".format(entry['slot']))
+                except Exception as err:
+                    print("Extending session slot {0} failed ({1})".format(entry['slot'], err))
+            try:
+                self.close_idle()
+            except Exception as err:
+                print("Closing idle sessions failed ({0})".format(err))
+
+    def release(self, entry, failed=False):
+        self.local.depth -= 1
+        if self.local.depth > 0:
+            return
+        self.local.entry = None
+        with self.lock:
+            self.leased.pop(entry['token'], None)
+        if failed:
+            # the session might be the cause: refresh (or drop) before it is leased again
+            entry = self.refresh(entry)
+            if not entry:
+                return
+        entry['last_used'] = time()
+        if not self.touch_slot(entry):
+            self.close(entry)
+            return
+        with self.lock:
+            self.idle.append(entry)
 
-    # return the resulting session can bei either None or all OK
-    return session
+"""
+ Returns the process-level session pool (create from the main thread, worker threads can
+ then use pool.lease()/pool.release() and pool.client directly)
+"""
+def get_session_pool():
+    global session_pool
+    if not session_pool:
+        config = frappe.get_doc("ZSW", "ZSW")
+        session_pool = ZSWSessionPool(
+            client=get_client(),
+            site=frappe.local.site,
+            license=config.license,
+            user=config.user,
+            password=get_decrypted_password("ZSW", "ZSW", 'password', False),
+            size=config.concurrent_ws_sessions or 2,
+            idle_timeout=config.session_idle_timeout or 600)
+        # close open sessions on process shutdown (jobs and requests close theirs when they end, see
+        # run_zsw_job and the after_request hook: RQ work-horses exit without running atexit; without
+        # either, the keepalive thread of the pool closes them after idle_timeout)
+        atexit.register(disconnect)
+    return session_pool
 
-try:
-    # read configuration
-    config = frappe.get_doc("ZSW", "ZSW")
-    print("Global config loaded")
-
-    #import logging.config
-
-    #logging.config.dictConfig({
-    #    'version': 1,
-    #    'formatters': {
-    #        'verbose': {
-    #            'format': '%(name)s: %(message)s'
-    #        }
-    #    },
-    #    'handlers': {
-    #        'console': {
-    #            'level': 'DEBUG',
-    #            'class': 'logging.StreamHandler',
-    #            'formatter': 'verbose',
-    #        },
-    #    },
-    #    'loggers': {
-    #        'zeep.transports': {
-    #            'level': 'DEBUG',
-    #            'propagate': True,
-    #            'handlers': ['console'],
-    #        },
-    #    }
-    #})
-
-    #from zeep import Plugin
-
-    #class LoggingPlugin(Plugin):
-
-    #    def ingress(self, envelope, http_headers, operation):
-    #        print(etree.tostring(envelope, pretty_print=True))
-    #        return envelope, http_headers
-
-    #    def egress(self, envelope, http_headers, operation, binding_options):
-    #        print(etree.tostring(envelope, pretty_print=True))
-    #        return envelope, http_headers
-
-    # create SOAP client stub
-    # with logging plugin
-    #client = Client(config.endpoint, plugins=[LoggingPlugin()])
-    # without logging plugin
-    #client = Client(config.endpoint)
-    # with settings
-    #settings = Settings(strict=False, xml_huge_tree=True)
-    settings = Settings(strict=True, xml_huge_tree=False)
-    client = Client(config.endpoint, settings=settings)
-    print("Global SOAP client stub initialized")
-
-    # create and initialize session variable to be used later on
-    session = None
-    print("Global session variable initialized")
-except:
-    frappe.log_error("Unable to create and initialize global variables", "ZSW global")
+"""
+ Leases an authenticated session:
+   with zsw_session() as s:
+       get_client().service.getTime(s)
+"""
+@contextmanager
+def zsw_session():
+    pool = get_session_pool()
+    entry = pool.lease()
+    try:
+        yield entry['session']
+    except Exception:
+        pool.release(entry, failed=True)
+        raise
+    else:
+        pool.release(entry)
 
+# close all idle sessions of this process (end of a job or request, see after_request in hooks)
 def disconnect():
-    if session:
-        s = getSession()
-        client.service.logout(s)
-        client.service.closeSession(s)
+    if session_pool:
+        session_pool.close_idle(force=True)
+    return
+
+"""
+ Background jobs of this module are enqueued through run_zsw_job, which closes the sessions of
+ the job when it ends
+"""
+def enqueue_zsw_job(job_method, queue='long', timeout=15000, **kwargs):
+    enqueue("finkzeit.finkzeit.zsw.run_zsw_job",
+        queue=queue,
+        timeout=timeout,
+        job_name=job_method,
+        job_method=job_method,
+        **kwargs)
+    return
+
+def run_zsw_job(job_method, **kwargs):
+    try:
+        return frappe.get_attr(job_method)(**kwargs)
+    finally:
+        disconnect()
 
 """ support functions """
 def getExtension(list, propName):
@@ -202,17 +461,186 @@ def createOrUpdateWSExtension_link(extensions, propKey, value, naturalInfo, link
                            'name': propKey,
                            'link': { 'action': 1, 'linkType': linkType, 'naturalID': value, 'naturalInfo': naturalInfo }})
 
+""" booking records """
+# material codes for the travel property (key 11)
+TRAVEL_ITEMS = {
+    '6/0': "3048",
+    '6/1': "3031",
+    '6/2': "3032",
+    '6/3': "3033",
+    '6/4': "3036"
+}
+
+class ZSWBooking(object):
+    # compact representation of a ZSW booking pair, parsed once per run
+    __slots__ = ('booking_id', 'person', 'customer', 'activity', 'invoice_type', 'sales_order',
+        'duration', 'properties', 'timestamp', 'time_in_seconds', 'to_time_in_seconds', 'hour', 'minute', 'notice')
+
+    def __init__(self, booking_id, person=None, customer=None, activity=None, invoice_type=None,
+            sales_order=None, duration=0, properties=(), timestamp="", time_in_seconds=None, to_time_in_seconds=None,
+            hour=0, minute=0, notice=None):
+        self.booking_id = booking_id
+        self.person = person
+        self.customer = customer
+        self.activity = activity                # service type, e.g. "T01" (remote), "T03" (onsite), "T02"/"T04" (project)
+        self.invoice_type = invoice_type        # e.g. "J": invoice, "N"/"W": free of charge, "P": flat rate
+        self.sales_order = sales_order          # project (ZSW) / sales order (ERP), e.g. "AB-00001" or "CHAB-00000"
+        self.duration = duration                # in minutes
+        self.properties = properties            # tuple of (key, val)
+        self.timestamp = timestamp
+        self.time_in_seconds = time_in_seconds  # start of the booking (unix time)
+        self.to_time_in_seconds = to_time_in_seconds    # end of the booking (unix time)
+        self.hour = hour
+        self.minute = minute
+        self.notice = notice
+
+    def __repr__(self):
+        return "ZSWBooking({0}, customer={1}, activity={2}, invoice_type={3}, duration={4})".format(
+            self.booking_id, self.customer, self.activity, self.invoice_type, self.duration)
+
+    @property
+    def date(self):
+        return (self.timestamp or "").split(" ")[0]
+
+    @property
+    def contact(self):
+        for key, val in self.properties:
+            if key == 2:
+                return val
+        return None
+
+    # booked time in hours, a duration property (key 15, stored as hh:mm) overrides the booking pair
+    def get_hours(self, allow_override=True):
+        if allow_override:
+            for key, val in self.properties:
+                if key == 15:
+                    try:
+                        duration_fields = "{0}".format(val).split(":")
+                        return round((float(duration_fields[0])) + (float(duration_fields[1]) / 60), 2)
+                    except Exception as err:
+                        print("Invalid duration override on {0} ({1})".format(self.booking_id, err))
+        return round((float(self.duration or 0) / 60.0) + 0.04, 1)
+
+def parse_booking(booking, levels):
+    record = ZSWBooking(
+        booking_id=booking['fromBookingID'],
+        person=booking['person'],
+        duration=booking['duration'] or 0,
+        notice=booking['notice'])
+    try:
+        for level in booking['levels']['WSLevelIdentification']:
+            structure = levels.get(level['levelID'])
+            if structure == "Customer":
+                record.customer = level['code']
+            elif structure == "Item (Activity)":
+                record.activity = level['code']
+            elif structure == "Invoicing Type":
+                record.invoice_type = level['code']
+            elif structure == "Sales Order":
+                record.sales_order = level['code']
+    except Exception as err:
+        print("...no levels on {0}... ({1})".format(record.booking_id, err))
+    try:
+        record.properties = tuple((p['key'], p['val']) for p in booking['properties']['WSProperty'])
+    except Exception:
+        pass
+    try:
+        record.timestamp = booking['from']['timestamp'] or ""
+        record.hour = int(booking['from']['hour'] or 0)
+        record.minute = int(booking['from']['min'] or 0)
+        record.time_in_seconds = booking['from']['timeInSeconds']
+        record.to_time_in_seconds = booking['to']['timeInSeconds']
+    except Exception:
+        pass
+    return record
+
+def parse_bookings(bookings):
+    levels = get_zsw_levels()['structures']
+    for booking in bookings or []:
+        yield parse_booking(booking, levels)
+
+"""
+ Parses the booking pairs in one pass and groups them by customer code (bookings without
+ a customer are grouped under None)
+"""
+def index_bookings(bookings):
+    return group_bookings(parse_bookings(bookings))
+
+# group parsed bookings (e.g. from iter_bookings) by customer code
+def group_bookings(records):
+    booking_index = {}
+    for record in records:
+        booking_index.setdefault(record.customer, []).append(record)
+    return booking_index
+
+"""
+ Returns the material positions (item_code, qty) from the booking properties
+ Generic invoices only know materials (key 14)
+"""
+def get_booking_materials(booking, kst=None, generic=False):
+    materials = []
+    for key, val in booking.properties:
+        try:
+            if key == 14:
+                # "qty level/item_code"
+                materials.append((val.split("/")[1], float(val.split(" ")[0])))
+            elif generic:
+                continue
+            elif key == 11:
+                if val in TRAVEL_ITEMS:
+                    materials.append((TRAVEL_ITEMS[val], 1.0))
+            elif key == 12:
+                materials.append(("3026", round((float(val) / 60.0) + 0.04, 1)))     # in h
+            elif key == 13:
+                materials.append(("3008" if "FZT" in (kst or "") else "3007", float(val)))
+        except Exception as err:
+            print("Invalid property {0} on {1} ({2})".format(key, booking.booking_id, err))
+    return materials
+
 """ abstracted ZSW functions """
-def get_employees():
+class ZSWEmployees(dict):
+    # person ID: name; an unknown person ID reloads the directory from ZSW (once per run)
+    def __init__(self, *args, **kwargs):
+        self.persist = kwargs.pop('persist', True)
+        super(ZSWEmployees, self).__init__(*args, **kwargs)
+        self.reloaded = False
+
+    def get(self, person, default=None):
+        if person is not None and person not in self and not self.reloaded:
+            print("Unknown employee {0}, reloading employees".format(person))
+            self.reloaded = True
+            self.update(get_employees(reload=True, persist=self.persist))
+        return super(ZSWEmployees, self).get(person, default)
+
+"""
+ Returns the employee directory (person ID: name), cached in redis for EMPLOYEE_CACHE_TTL seconds
+ (reload=True fetches it from ZSW with getAllEmployees; persist=False, e.g. in dry runs, does not
+ write the cache)
+"""
+def get_employees(reload=False, persist=True):
+    persist = persist and persist_state
+    if not reload and persist_state:
+        employee_dict = frappe.cache().get_value(EMPLOYEE_CACHE_KEY, expires=True)
+        if employee_dict:
+            return ZSWEmployees(employee_dict, persist=persist)
     print("Read employees...")
-    employees = client.service.getAllEmployees(getSession(), 0)
+    with zsw_session() as s:
+        employees = get_client().service.getAllEmployees(s, 0)
     # clean up employees
     employee_dict = {}
-    for employee in employees:
+    for employee in employees or []:
         # reformat employees to indexed dict
         employee_dict[employee['personID']] = "{0} {1}".format(employee['firstname'], employee['lastname'])
-    print("Employees: {0}".format(employee_dict))
-    return employee_dict
+    print("Employees: {0}".format(len(employee_dict)))
+    if persist:
+        frappe.cache().set_value(EMPLOYEE_CACHE_KEY, employee_dict, expires_in_sec=EMPLOYEE_CACHE_TTL)
+    employees = ZSWEmployees(employee_dict, persist=persist)
+    employees.reloaded = True
+    return employees
+
+@frappe.whitelist()
+def refresh_employees():
+    return len(get_employees(reload=True))
 
 def get_bookings(start_time, end_time):
     end_time = int(end_time)
@@ -226,29 +654,304 @@ def get_bookings(start_time, end_time):
 
     # get bookings
     try:
-        bookings = client.service.getBookingPairs(getSession(), fromTS, toTS, False, 1)
+        with zsw_session() as s:
+            bookings = get_client().service.getBookingPairs(s, fromTS, toTS, False, 1)
     except Exception as err:
         frappe.log_error("Get booking pairs failed with error {0}.".format(err), "ZSW get booking pairs")
         #return here because going further doesn't make sense!
         return []
 
     # update end_time in ZSW record
-    global config
-    try:
-        config.last_sync_sec = end_time
-        config.last_sync_date = datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S')
-        config.save()
-        print("Global config updated")
-    except Exception as err:
-        frappe.log_error( "Unable to set end time. ({0})".format(err), "ZSW get_booking")
+    if not update_last_sync(end_time):
         return []
 
-    print("Bookings: {0}".format(bookings))
     if bookings:
         print("Total {0} bookings".format(len(bookings)))
     return bookings
 
-def get_project_bookings(zsw_project, from_time, to_time):
+class ZSWProfile(object):
+    # collects timings [s] and number of SQL queries per phase of a (dry) run; phases timed in
+    # worker threads (SOAP fetch, parse) are summed over all threads. Queries are counted with the
+    # statement counter of the database connection of the run (session status), read when a phase
+    # starts or ends in the thread that started the profile
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.queries = OrderedDict()
+        self.lock = threading.Lock()
+        self.current = None
+        self.thread = None
+        self.query_count = 0
+        self.started = time()
+
+    def start(self):
+        self.thread = threading.current_thread()
+        self.query_count = self.get_query_count()
+        self.started = time()
+
+    def stop(self):
+        self.count_queries()
+        self.thread = None
+        self.add("total", time() - self.started)
+
+    def get_query_count(self):
+        return cint(frappe.db.sql("""SHOW SESSION STATUS LIKE 'Questions';""")[0][1])
+
+    # add the queries since the last count to the current phase (the status query is not counted)
+    def count_queries(self):
+        if threading.current_thread() is not self.thread:
+            return
+        query_count = self.get_query_count()
+        phase = self.current or "other"
+        self.queries[phase] = self.queries.get(phase, 0) + max(query_count - self.query_count - 1, 0)
+        self.query_count = query_count
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, phase):
+        self.count_queries()
+        previous = self.current
+        self.current = phase
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(phase, time() - start)
+            self.count_queries()
+            self.current = previous
+
+    def as_dict(self):
+        return {
+            'timings': OrderedDict((k, round(v, 3)) for k, v in self.timings.items()),
+            'queries': dict(self.queries)
+        }
+
+# profile phase or no-op without profile
+@contextmanager
+def profile_phase(profile, phase):
+    if not profile:
+        yield
+        return
+    with profile.phase(phase):
+        yield
+
+"""
+ Fetches the booking pairs between start and end time in time windows (booking_window_hours)
+ and yields them as parsed bookings (ZSWBooking), so that the zeep objects of only a few windows
+ are held in memory. Up to booking_fetch_workers windows are fetched concurrently, bookings are
+ yielded in window order.
+
+ Raises if a window cannot be fetched (the sync time is only updated after the last window)
+"""
+def iter_bookings(start_time, end_time, window_hours=None, workers=None, profile=None, update_sync=True):
+    end_time = int(end_time)
+    start_time = int(start_time)
+    config = frappe.get_doc("ZSW", "ZSW")
+    window = int(float(window_hours or config.booking_window_hours or 24) * 3600)
+    workers = max(1, int(workers or config.booking_fetch_workers or 1))
+    fast = True if config.fast_booking_parser else False
+    windows = [(t, min(t + window, end_time)) for t in range(start_time, end_time, window)]
+    print("Fetching bookings from {0} to {1} in {2} windows ({3} workers)".format(start_time, end_time, len(windows), workers))
+    # prepare level map and session pool in the main thread
+    levels = get_zsw_levels()['structures']
+    pool = get_session_pool()
+    seen = set()
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        next_window = 0
+        while next_window < len(windows) or pending:
+            # keep at most <workers> windows in flight
+            while next_window < len(windows) and len(pending) < workers:
+                pending.append((windows[next_window], executor.submit(fetch_booking_window, pool, levels, windows[next_window], fast, profile)))
+                next_window += 1
+            booking_window, future = pending.popleft()
+            try:
+                records = future.result()
+            except Exception as err:
+                frappe.log_error("Get booking pairs ({0} .. {1}) failed with error {2}.".format(
+                    booking_window[0], booking_window[1], err), "ZSW get booking pairs")
+                raise
+            for record in records:
+                # pairs on a window boundary can be returned twice
+                if record.booking_id in seen:
+                    continue
+                seen.add(record.booking_id)
+                count += 1
+                yield record
+    print("Total {0} bookings".format(count))
+    if update_sync:
+        update_last_sync(end_time)
+
+# worker function: fetch and parse one booking window (no frappe calls, can run in a thread)
+def fetch_booking_window(pool, levels, booking_window, fast=False, profile=None):
+    fromTS = {'timeInSeconds': booking_window[0]}
+    toTS = {'timeInSeconds': booking_window[1]}
+    entry = pool.lease()
+    try:
+        if fast:
+            records = list(stream_booking_pairs("getBookingPairs", levels, entry['session'], fromTS, toTS, False, 1,
+                profile=profile, client=pool.client))
+        else:
+            start = time()
+            bookings = pool.client.service.getBookingPairs(entry['session'], fromTS, toTS, False, 1)
+            fetched = time()
+            records = [parse_booking(booking, levels) for booking in bookings or []]
+            if profile:
+                profile.add("soap_fetch", fetched - start)
+                profile.add("parse", time() - fetched)
+    except Exception:
+        pool.release(entry, failed=True)
+        raise
+    pool.release(entry)
+    return records
+
+"""
+ Fast path for the booking operations (getBookingPairs, getBookingPairsByLevel): the request is
+ built by zeep, but the response is parsed incrementally (lxml iterparse) straight into ZSWBooking
+ records without materializing the zeep objects. No frappe calls, can run in a thread (with
+ client=pool.client, the client of the session pool built in the main thread).
+ With a profile, the time until the response headers arrive counts as SOAP fetch, reading and
+ parsing the streamed body as parse.
+"""
+def stream_booking_pairs(operation, levels, *args, **kwargs):
+    profile = kwargs.get('profile')
+    start = time()
+    zeep_client = kwargs.get('client') or get_client()
+    binding_options = zeep_client.service._binding_options
+    envelope, http_headers = zeep_client.service._binding._create(operation, args, {},
+        client=zeep_client, options=binding_options)
+    response = zeep_client.transport.session.post(binding_options['address'],
+        data=etree.tostring(envelope), headers=http_headers,
+        timeout=zeep_client.transport.operation_timeout, stream=True)
+    fetched = time()
+    if profile:
+        profile.add("soap_fetch", fetched - start)
+    try:
+        if response.status_code != 200:
+            raise Exception("{0} failed ({1}): {2}".format(operation, response.status_code, get_fault_string(response.content)))
+        response.raw.decode_content = True
+        for record in iterparse_bookings(response.raw, levels):
+            yield record
+    finally:
+        response.close()
+        if profile:
+            profile.add("parse", time() - fetched)
+
+def get_fault_string(content):
+    try:
+        for element in etree.fromstring(content).iter():
+            if isinstance(element.tag, str) and element.tag.rpartition('}')[2] == "faultstring":
+                return element.text
+    except Exception:
+        pass
+    return content[:500]
+
+# parse booking pair elements (identified by their fromBookingID child) from a SOAP response stream
+def iterparse_bookings(source, levels):
+    booking_element = None
+    for event, element in etree.iterparse(source, events=('end',), huge_tree=True):
+        if element is booking_element:
+            yield parse_booking_element(element, levels)
+            # free processed bookings
+            element.clear()
+            parent = element.getparent()
+            while element.getprevious() is not None:
+                del parent[0]
+            booking_element = None
+        elif isinstance(element.tag, str) and element.tag.endswith("fromBookingID"):
+            booking_element = element.getparent()
+
+def parse_booking_element(element, levels):
+    record = ZSWBooking(booking_id=None)
+    for child in element:
+        if not isinstance(child.tag, str):
+            continue
+        tag = child.tag.rpartition('}')[2]
+        if tag == "fromBookingID":
+            record.booking_id = get_number(child.text)
+        elif tag == "person":
+            record.person = get_number(child.text)
+        elif tag == "duration":
+            record.duration = get_number(child.text) or 0
+        elif tag == "notice":
+            record.notice = child.text
+        elif tag == "from":
+            for ts in child:
+                ts_tag = ts.tag.rpartition('}')[2] if isinstance(ts.tag, str) else None
+                if ts_tag == "timestamp":
+                    record.timestamp = ts.text or ""
+                elif ts_tag == "timeInSeconds":
+                    record.time_in_seconds = get_number(ts.text)
+                elif ts_tag == "hour":
+                    record.hour = get_number(ts.text) or 0
+                elif ts_tag == "min":
+                    record.minute = get_number(ts.text) or 0
+        elif tag == "to":
+            for ts in child:
+                if isinstance(ts.tag, str) and ts.tag.rpartition('}')[2] == "timeInSeconds":
+                    record.to_time_in_seconds = get_number(ts.text)
+        elif tag == "levels":
+            for level in child:
+                level_id = None
+                code = None
+                for field in level:
+                    field_tag = field.tag.rpartition('}')[2] if isinstance(field.tag, str) else None
+                    if field_tag == "levelID":
+                        level_id = get_number(field.text)
+                    elif field_tag == "code":
+                        code = field.text
+                structure = levels.get(level_id)
+                if structure == "Customer":
+                    record.customer = code
+                elif structure == "Item (Activity)":
+                    record.activity = code
+                elif structure == "Invoicing Type":
+                    record.invoice_type = code
+                elif structure == "Sales Order":
+                    record.sales_order = code
+        elif tag == "properties":
+            properties = []
+            for prop in child:
+                key = None
+                val = None
+                for field in prop:
+                    field_tag = field.tag.rpartition('}')[2] if isinstance(field.tag, str) else None
+                    if field_tag == "key":
+                        key = get_number(field.text)
+                    elif field_tag == "val":
+                        val = field.text
+                properties.append((key, val))
+            record.properties = tuple(properties)
+    return record
+
+def get_number(text):
+    if text is None or text == "":
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+# update end_time in ZSW record (without saving the document: no version, no modified)
+def update_last_sync(end_time):
+    if not persist_state:
+        return True
+    try:
+        frappe.db.set_value("ZSW", "ZSW", {
+            'last_sync_sec': end_time,
+            'last_sync_date': datetime.fromtimestamp(end_time).strftime('%Y-%m-%d %H:%M:%S')
+        }, update_modified=False)
+        print("Global config updated")
+    except Exception as err:
+        frappe.log_error( "Unable to set end time. ({0})".format(err), "ZSW get_booking")
+        return False
+    return True
+
+# persist=False (dry runs): the booking store is read without pulling into it (see peek_bookings)
+def get_project_bookings(zsw_project, from_time, to_time, profile=None, persist=True):
     end_time = int(to_time)
     start_time = int(from_time)
     print("Start {0} (type: {1})".format(start_time, type(start_time)))
@@ -258,202 +961,916 @@ def get_project_bookings(zsw_project, from_time, to_time):
     fromTS = {'timeInSeconds': start_time}
     toTS = {'timeInSeconds': end_time}
 
-    # get bookings
+    # get bookings (parsed)
+    levels = get_zsw_levels()['structures']
     try:
-        bookings = client.service.getBookingPairsByLevel(getSession(), fromTS, toTS, zsw_project, 4)
+        if use_booking_store():
+            if not persist:
+                bookings = [b for b in peek_bookings(start_time, end_time, profile) if b.sales_order == zsw_project]
+                print("Total {0} bookings (store, not pulled)".format(len(bookings)))
+                return bookings
+            update_booking_store(start_time, end_time, profile=profile)
+            with profile_phase(profile, "store_read"):
+                bookings = get_stored_bookings(start_time, end_time, sales_order=zsw_project)
+            print("Total {0} bookings (store)".format(len(bookings)))
+            return bookings
+        with zsw_session() as s:
+            if frappe.db.get_single_value("ZSW", "fast_booking_parser"):
+                bookings = list(stream_booking_pairs("getBookingPairsByLevel", levels, s, fromTS, toTS, zsw_project, 4, profile=profile))
+            else:
+                with profile_phase(profile, "soap_fetch"):
+                    bookings = get_client().service.getBookingPairsByLevel(s, fromTS, toTS, zsw_project, 4)
+                with profile_phase(profile, "parse"):
+                    bookings = [parse_booking(booking, levels) for booking in bookings or []]
     except Exception as err:
         frappe.log_error("Get booking pairs by level failed with error {0}.".format(err), "ZSW get booking pairs by level")
         #return here because going further doesn't make sense!
         return []
 
-    print("Bookings: {0}".format(bookings))
     if bookings:
         print("Total {0} bookings".format(len(bookings)))
     return bookings
 
-def mark_bookings(bookings):
-    if type(bookings) is not list:
-        bookings = eval(bookings)
+"""
+ Marks bookings as invoiced in ZSW (checkBookings)
 
-    try:
-        # use pagination
-        per_page = 100
-        s = getSession()
-        for i in range(0, len(bookings), per_page):
-            bookings_paged = {'long': bookings[i:i+per_page]}
-            client.service.checkBookings(s, bookings_paged, 5)
-    except Exception as err:
-        frappe.log_error("Marking bookings {0} failed with error {1}.".format(bookings, err), "ZSW mark bookings")
+ Pages are sent concurrently over the session pool (at most one page in flight per pooled
+ session), the page size adapts to the observed latency and failed pages are retried with
+ backoff. IDs that could not be marked are kept as ZSW Unmarked Booking (one row per booking)
+ and included in the next call. Concurrent calls only drop the rows of the IDs they marked;
+ the caller commits.
+"""
+def mark_bookings(bookings, workers=None):
+    bookings = decode_booking_ids(bookings)
+    # include bookings left over from previous runs
+    unmarked = get_unmarked_bookings()
+    booking_ids = list(OrderedDict.fromkeys(unmarked + bookings))
+    if not booking_ids:
+        return True
+    if unmarked:
+        print("Retrying {0} unmarked bookings".format(len(unmarked)))
+    add_unmarked_bookings(bookings)
+    failed = send_booking_marks(booking_ids, workers)
+    failed_ids = set(failed)
+    remove_unmarked_bookings([b for b in booking_ids if b not in failed_ids])
+    if failed:
+        frappe.log_error("Marking {0} of {1} bookings failed, they will be retried on the next run: {2}".format(
+            len(failed), len(booking_ids), failed), "ZSW mark bookings")
         return False
-
     return True
 
-def create_update_customer(customer, customer_name, active, kst=None, tenant="AT", technician=None, short_name=None):
-    # collect information
-    zsw_reference = get_zsw_reference(customer, tenant)
-    adr_ids = frappe.get_all("Dynamic Link",
-        filters={'link_doctype': 'Customer', 'link_name': customer, 'parenttype': 'Address'},
-        fields=['parent'])
-    if adr_ids:
-        for adr_id in adr_ids:
-            address = frappe.get_doc("Address", adr_id['parent'])
-            if address.is_primary_address:
-                break
-        city = address.city or "-"
-        street = address.address_line1 or "-"
-        pincode = address.pincode or "-"
+# mark only the bookings left over from previous runs
+def retry_unmarked_bookings():
+    result = mark_bookings([])
+    frappe.db.commit()
+    return result
+
+# decode a list of booking IDs (list or JSON/literal string)
+def decode_booking_ids(bookings):
+    if not bookings:
+        return []
+    if not isinstance(bookings, (list, tuple, set)):
+        try:
+            bookings = json.loads(bookings)
+        except ValueError:
+            bookings = ast.literal_eval(bookings)
+        if not isinstance(bookings, (list, tuple, set)):
+            bookings = [bookings]
+    return [int(b) for b in bookings]
+
+def get_unmarked_bookings():
+    return [cint(r['booking_id']) for r in frappe.db.sql("""SELECT `booking_id`
+        FROM `tabZSW Unmarked Booking`
+        ORDER BY `queued_on` ASC, `booking_id` ASC;""", as_dict=True)]
+
+# existing entries are kept
+def add_unmarked_bookings(booking_ids, chunk_size=500):
+    timestamp = now()
+    user = frappe.session.user
+    booking_ids = list(booking_ids)
+    for i in range(0, len(booking_ids), chunk_size):
+        values = []
+        for booking_id in booking_ids[i:i+chunk_size]:
+            values += ["{0}".format(booking_id), "{0}".format(booking_id), timestamp, timestamp, timestamp, user, user]
+        frappe.db.sql("""INSERT IGNORE INTO `tabZSW Unmarked Booking`
+                (`name`, `booking_id`, `queued_on`, `creation`, `modified`, `owner`, `modified_by`)
+            VALUES {0}""".format(", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * int(len(values) / 7))),
+            tuple(values))
+    return
+
+def remove_unmarked_bookings(booking_ids, chunk_size=1000):
+    booking_ids = ["{0}".format(b) for b in booking_ids]
+    for i in range(0, len(booking_ids), chunk_size):
+        frappe.db.sql("""DELETE FROM `tabZSW Unmarked Booking` WHERE `name` IN %(booking_ids)s""",
+            {'booking_ids': tuple(booking_ids[i:i+chunk_size])})
+    return
+
+# returns the IDs that could not be marked
+def send_booking_marks(booking_ids, workers=None):
+    pool = get_session_pool()
+    workers = max(1, cint(workers or pool.size))
+    queue = deque(booking_ids)
+    page_size = MARK_PAGE_SIZE
+    retries = []            # (not before, attempt, page)
+    failed = []
+    pending = {}            # future: (attempt, page)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while queue or retries or pending:
+            # keep at most <workers> pages in flight, due retries first
+            while len(pending) < workers:
+                due = [r for r in retries if r[0] <= time()]
+                if due:
+                    retry = min(due)
+                    retries.remove(retry)
+                    attempt, page = retry[1], retry[2]
+                elif queue:
+                    attempt, page = 0, [queue.popleft() for i in range(0, min(page_size, len(queue)))]
+                else:
+                    break
+                pending[executor.submit(check_booking_page, pool, page)] = (attempt, page)
+            if not pending:
+                # only retries waiting for their backoff
+                sleep(max(0, min(retries)[0] - time()))
+                continue
+            timeout = max(0, min(retries)[0] - time()) if retries else None
+            done, not_done = wait(list(pending.keys()), timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt, page = pending.pop(future)
+                try:
+                    latency = future.result()
+                except Exception as err:
+                    if attempt < MARK_RETRIES:
+                        print("Marking {0} bookings failed ({1}), retry {2}".format(len(page), err, attempt + 1))
+                        retries.append((time() + MARK_BACKOFF * (2 ** attempt), attempt + 1, page))
+                    else:
+                        print("Marking {0} bookings failed ({1}), giving up".format(len(page), err))
+                        failed += page
+                    continue
+                # adapt page size to the latency
+                if latency < MARK_TARGET_LATENCY / 2 and len(page) == page_size:
+                    page_size = min(page_size * 2, MARK_PAGE_SIZE_MAX)
+                elif latency > MARK_TARGET_LATENCY:
+                    page_size = max(int(page_size / 2), MARK_PAGE_SIZE_MIN)
+    return failed
+
+# worker function: mark one page (no frappe calls, can run in a thread), returns the latency
+def check_booking_page(pool, page):
+    entry = pool.lease()
+    start = time()
+    try:
+        pool.client.service.checkBookings(entry['session'], {'long': page}, 5)
+    except Exception:
+        pool.release(entry, failed=True)
+        raise
+    pool.release(entry)
+    return time() - start
+
+"""
+ Invoiced booking ledger: booking IDs (fromBookingID) consumed by an invoice or delivery note
+ are recorded locally (ZSW Invoiced Booking), fetched bookings are filtered against it so
+ overlapping or repeated runs only process new bookings. The ledger is neither read nor written
+ while the local sync state is off (see persist_state)
+"""
+def get_invoiced_bookings(booking_ids, chunk_size=1000):
+    invoiced = set()
+    booking_ids = ["{0}".format(b) for b in booking_ids]
+    for i in range(0, len(booking_ids), chunk_size):
+        for r in frappe.db.sql("""SELECT `name` FROM `tabZSW Invoiced Booking` WHERE `name` IN %(booking_ids)s""",
+                {'booking_ids': tuple(booking_ids[i:i+chunk_size])}, as_dict=True):
+            invoiced.add(int(r['name']))
+    return invoiced
+
+# drop bookings that are in the ledger from a booking index (customer: bookings)
+def drop_invoiced_bookings(booking_index):
+    if not persist_state:
+        return booking_index
+    invoiced = get_invoiced_bookings([b.booking_id for bookings in booking_index.values() for b in bookings])
+    if not invoiced:
+        return booking_index
+    print("Skipping {0} bookings that are already invoiced".format(len(invoiced)))
+    filtered = {}
+    for customer, bookings in booking_index.items():
+        bookings = [b for b in bookings if b.booking_id not in invoiced]
+        if bookings:
+            filtered[customer] = bookings
+    return filtered
+
+"""
+ Reads the bookings of a period and groups them by customer (without already invoiced bookings)
+ With a profile (dry run), the bookings are collected first to time the grouping on its own,
+ the last sync time is not updated and the booking store is not pulled into
+"""
+def fetch_booking_index(start_time, end_time, profile=None):
+    if not profile:
+        return drop_invoiced_bookings(group_bookings(read_bookings(start_time, end_time)))
+    records = list(read_bookings(start_time, end_time, profile=profile, update_sync=False, persist=False))
+    with profile.phase("grouping"):
+        return drop_invoiced_bookings(group_bookings(records))
+
+# record consumed bookings (existing entries are kept)
+def record_invoiced_bookings(booking_ids, reference_doctype=None, reference_name=None, customer=None, chunk_size=500):
+    if not booking_ids or not persist_state:
+        return
+    timestamp = now()
+    user = frappe.session.user
+    booking_ids = list(booking_ids)
+    for i in range(0, len(booking_ids), chunk_size):
+        values = []
+        for booking_id in booking_ids[i:i+chunk_size]:
+            values += ["{0}".format(booking_id), "{0}".format(booking_id), customer, reference_doctype, reference_name,
+                timestamp, timestamp, timestamp, user, user]
+        frappe.db.sql("""INSERT IGNORE INTO `tabZSW Invoiced Booking`
+                (`name`, `booking_id`, `customer`, `reference_doctype`, `reference_name`, `invoiced_on`, `creation`, `modified`, `owner`, `modified_by`)
+            VALUES {0}""".format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * int(len(values) / 10))),
+            tuple(values))
+    frappe.db.commit()
+
+"""
+ Local booking store (ZSW Booking): the booking pairs are pulled incrementally from the store
+ watermark (ZSW Sync State, initially last_sync_sec) and upserted by booking ID. The last
+ BOOKING_STORE_OVERLAP seconds before the watermark are pulled again, so that late or changed
+ bookings are updated and bookings deleted in ZSW are dropped from the store. The start of the
+ covered range is kept (covered_from), an explicit start time below it extends the range (backfill).
+ Callers hold the pull lock (see booking_pull_lock). Returns the number of pulled bookings
+"""
+def sync_booking_store(end_time=None, start_time=None, window_hours=None, workers=None, profile=None):
+    end_time = min(int(end_time or time()), int(time()))
+    if start_time is None:
+        watermark = get_sync_watermark(BOOKING_STORE_STATE) or cint(frappe.db.get_single_value("ZSW", "last_sync_sec"))
+        if watermark >= end_time:
+            return 0
+        start_time = max(watermark - BOOKING_STORE_OVERLAP, 0) if watermark else end_time - 31 * 24 * 60 * 60
+    start_time = int(start_time)
+    if start_time >= end_time:
+        return 0
+    pulled_on = now()
+    count = 0
+    batch = []
+    for record in iter_bookings(start_time, end_time, window_hours=window_hours, workers=workers, profile=profile, update_sync=False):
+        batch.append(record)
+        if len(batch) >= BOOKING_STORE_BATCH_SIZE:
+            count += store_bookings(batch, pulled_on)
+            batch = []
+    count += store_bookings(batch, pulled_on)
+    # bookings of the pulled range that were not returned again have been deleted in ZSW
+    frappe.db.sql("""DELETE FROM `tabZSW Booking`
+        WHERE `time_in_seconds` >= %(start_time)s AND `time_in_seconds` < %(end_time)s AND `pulled_on` < %(pulled_on)s""",
+        {'start_time': start_time, 'end_time': end_time, 'pulled_on': pulled_on})
+    covered_from = get_store_coverage()
+    if not covered_from or start_time < covered_from <= end_time:
+        covered_from = start_time
+    set_sync_state(BOOKING_STORE_STATE, {'covered_from': covered_from})
+    set_sync_watermark(BOOKING_STORE_STATE, max(end_time, get_sync_watermark(BOOKING_STORE_STATE)))
+    frappe.db.commit()
+    print("Stored {0} bookings ({1} .. {2})".format(count, start_time, end_time))
+    return count
+
+# pulls the bookings before the covered range of the booking store (from start_time on) into the store
+def backfill_booking_store(start_time, profile=None):
+    covered_from = get_store_coverage()
+    if not covered_from or int(start_time) >= covered_from:
+        return 0
+    print("Backfilling booking store ({0} .. {1})".format(int(start_time), covered_from))
+    return sync_booking_store(covered_from, start_time=start_time, profile=profile)
+
+# start of the range the booking store covers (unix time, 0: nothing pulled yet)
+def get_store_coverage():
+    state = get_sync_state(BOOKING_STORE_STATE)
+    covered_from = cint(state['covered_from'])
+    if not covered_from and cint(state['watermark']):
+        # pulled before the covered range was kept: the oldest stored booking is a safe bound
+        oldest = frappe.db.sql("""SELECT MIN(`time_in_seconds`) FROM `tabZSW Booking`""")[0][0]
+        covered_from = cint(oldest) or cint(state['watermark'])
+    return covered_from
+
+"""
+ Sync states (ZSW Sync State): watermark (unix time), covered range and last run of the incremental
+ pulls, one lightweight row per state instead of saving the ZSW document on every pull
+"""
+def get_sync_state(state):
+    states = frappe.db.sql("""SELECT `watermark`, `covered_from`, `last_run`, `last_status`
+        FROM `tabZSW Sync State`
+        WHERE `name` = %(state)s;""", {'state': state}, as_dict=True)
+    return states[0] if states else {'watermark': 0, 'covered_from': 0, 'last_run': None, 'last_status': None}
+
+def get_sync_watermark(state):
+    return cint(get_sync_state(state)['watermark'])
+
+def set_sync_watermark(state, watermark):
+    set_sync_state(state, {
+        'watermark': int(watermark),
+        'watermark_date': datetime.fromtimestamp(int(watermark)).strftime('%Y-%m-%d %H:%M:%S')
+    })
+    return
+
+# upsert fields of a sync state (watermark, watermark_date, covered_from, last_run, last_status)
+def set_sync_state(state, values):
+    timestamp = now()
+    fields = list(values.keys())
+    frappe.db.sql("""INSERT INTO `tabZSW Sync State`
+            (`name`, `state`, {fields}, `creation`, `modified`, `owner`, `modified_by`)
+        VALUES (%(state)s, %(state)s, {placeholders}, %(timestamp)s, %(timestamp)s, %(user)s, %(user)s)
+        ON DUPLICATE KEY UPDATE {updates}, `modified` = VALUES(`modified`)""".format(
+            fields=", ".join("`{0}`".format(f) for f in fields),
+            placeholders=", ".join("%({0})s".format(f) for f in fields),
+            updates=", ".join("`{0}` = VALUES(`{0}`)".format(f) for f in fields)),
+        dict(values, state=state, timestamp=timestamp, user=frappe.session.user))
+    return
+
+"""
+ Scheduled booking pull (scheduler, every minute): pulls new booking pairs into the booking store
+ when the schedule (booking_pull_cron) is due since the last run. One pull runs at a time (lock
+ in redis), so month-end invoice runs start from bookings that are already local
+"""
+def scheduled_booking_pull():
+    config = frappe.get_doc("ZSW", "ZSW")
+    if not config.scheduled_booking_pull:
+        return
+    last_run = get_sync_state(BOOKING_STORE_STATE)['last_run']
+    if last_run:
+        try:
+            due = croniter(config.booking_pull_cron or BOOKING_PULL_CRON, get_datetime(last_run)).get_next(datetime)
+        except Exception as err:
+            frappe.log_error("Invalid booking pull schedule {0} ({1})".format(config.booking_pull_cron, err), "ZSW scheduled_booking_pull")
+            return
+        if due > now_datetime():
+            return
+    try:
+        pull_booking_store()
+    finally:
+        # scheduler job: close the sessions of the pull
+        disconnect()
+    return
+
+def get_booking_pull_key():
+    return "{0}|zsw_booking_pull|lock".format(frappe.local.site)
+
+"""
+ Pull lock of the booking store (redis): every pull into the store runs under it, so that the
+ removal of deleted bookings (pulled_on) and the watermark of concurrent pulls do not interleave.
+ Waits up to wait seconds for a running pull and yields whether the lock was acquired
+"""
+@contextmanager
+def booking_pull_lock(wait=0):
+    cache = frappe.cache()
+    token = "{0}:{1}".format(os.getpid(), uuid.uuid4().hex)
+    deadline = time() + wait
+    while not cache.set(get_booking_pull_key(), token, nx=True, ex=BOOKING_PULL_LOCK_TIMEOUT):
+        if time() >= deadline:
+            yield False
+            return
+        sleep(1)
+    try:
+        yield True
+    finally:
+        # only release the own lock (compare and delete)
+        cache.eval(SLOT_RELEASE_SCRIPT, 1, get_booking_pull_key(), token)
+
+# pulls the booking store up to end_time and backfills it to start_time, waits for a running pull
+def update_booking_store(start_time, end_time, profile=None):
+    with booking_pull_lock(wait=BOOKING_PULL_LOCK_WAIT) as locked:
+        if not locked:
+            raise Exception("Booking store is locked by another pull")
+        sync_booking_store(end_time, profile=profile)
+        backfill_booking_store(start_time, profile=profile)
+    return
+
+@frappe.whitelist()
+def pull_booking_store():
+    with booking_pull_lock() as locked:
+        if not locked:
+            print("Booking pull already running")
+            return
+        try:
+            set_sync_state(BOOKING_STORE_STATE, {'last_run': now()})
+            frappe.db.commit()
+            count = sync_booking_store()
+            status = "Pulled {0} bookings".format(count)
+        except Exception as err:
+            frappe.db.rollback()
+            frappe.log_error("Booking pull failed: {0}".format(err), "ZSW pull_booking_store")
+            status = "Failed: {0}".format(err)
+    set_sync_state(BOOKING_STORE_STATE, {'last_status': status})
+    frappe.db.commit()
+    return status
+
+# upsert parsed bookings (ZSWBooking) into the booking store
+def store_bookings(records, pulled_on=None):
+    if not records:
+        return 0
+    pulled_on = pulled_on or now()
+    user = frappe.session.user
+    values = []
+    for r in records:
+        values += ["{0}".format(r.booking_id), r.booking_id, r.person, r.customer, r.activity, r.invoice_type,
+            r.sales_order, r.duration, json.dumps([list(p) for p in r.properties]), r.timestamp, r.time_in_seconds,
+            r.to_time_in_seconds, r.hour, r.minute, r.notice, pulled_on, pulled_on, pulled_on, user, user]
+    frappe.db.sql("""INSERT INTO `tabZSW Booking`
+            (`name`, `booking_id`, `person`, `customer`, `activity`, `invoice_type`, `sales_order`, `duration`,
+             `properties`, `timestamp`, `time_in_seconds`, `to_time_in_seconds`, `hour`, `minute`, `notice`,
+             `pulled_on`, `creation`, `modified`, `owner`, `modified_by`)
+        VALUES {0}
+        ON DUPLICATE KEY UPDATE
+            `person` = VALUES(`person`), `customer` = VALUES(`customer`), `activity` = VALUES(`activity`),
+            `invoice_type` = VALUES(`invoice_type`), `sales_order` = VALUES(`sales_order`), `duration` = VALUES(`duration`),
+            `properties` = VALUES(`properties`), `timestamp` = VALUES(`timestamp`), `time_in_seconds` = VALUES(`time_in_seconds`),
+            `to_time_in_seconds` = VALUES(`to_time_in_seconds`), `hour` = VALUES(`hour`), `minute` = VALUES(`minute`),
+            `notice` = VALUES(`notice`), `pulled_on` = VALUES(`pulled_on`), `modified` = VALUES(`modified`)""".format(
+            ", ".join(["(" + ", ".join(["%s"] * 20) + ")"] * len(records))),
+        tuple(values))
+    return len(records)
+
+# bookings of the store between start and end time (optionally of one customer or project) as ZSWBooking
+def get_stored_bookings(start_time, end_time, customer=None, sales_order=None):
+    conditions = ""
+    if customer:
+        conditions += " AND `customer` = %(customer)s"
+    if sales_order:
+        conditions += " AND `sales_order` = %(sales_order)s"
+    rows = frappe.db.sql("""SELECT `booking_id`, `person`, `customer`, `activity`, `invoice_type`, `sales_order`, `duration`,
+            `properties`, `timestamp`, `time_in_seconds`, `to_time_in_seconds`, `hour`, `minute`, `notice`
+        FROM `tabZSW Booking`
+        WHERE `time_in_seconds` BETWEEN %(start_time)s AND %(end_time)s {conditions}
+        ORDER BY `time_in_seconds` ASC, `booking_id` ASC;""".format(conditions=conditions),
+        {'start_time': int(start_time), 'end_time': int(end_time), 'customer': customer, 'sales_order': sales_order}, as_dict=True)
+    return [get_stored_booking(r) for r in rows]
+
+# bookings of the store by booking ID as ZSWBooking
+def get_stored_bookings_by_id(booking_ids, chunk_size=1000):
+    rows = []
+    booking_ids = list(booking_ids)
+    for i in range(0, len(booking_ids), chunk_size):
+        rows += frappe.db.sql("""SELECT `booking_id`, `person`, `customer`, `activity`, `invoice_type`, `sales_order`, `duration`,
+                `properties`, `timestamp`, `time_in_seconds`, `to_time_in_seconds`, `hour`, `minute`, `notice`
+            FROM `tabZSW Booking`
+            WHERE `booking_id` IN %(booking_ids)s;""", {'booking_ids': tuple(booking_ids[i:i+chunk_size])}, as_dict=True)
+    rows.sort(key=lambda r: (r['time_in_seconds'], r['booking_id']))
+    return [get_stored_booking(r) for r in rows]
+
+def get_stored_booking(r):
+    return ZSWBooking(
+        booking_id=r['booking_id'],
+        person=r['person'],
+        customer=r['customer'],
+        activity=r['activity'],
+        invoice_type=r['invoice_type'],
+        sales_order=r['sales_order'],
+        duration=r['duration'] or 0,
+        properties=tuple(tuple(p) for p in json.loads(r['properties'] or "[]")),
+        timestamp=r['timestamp'] or "",
+        time_in_seconds=r['time_in_seconds'],
+        to_time_in_seconds=r['to_time_in_seconds'],
+        hour=r['hour'] or 0,
+        minute=r['minute'] or 0,
+        notice=r['notice'])
+
+# the booking store is used if enabled (and the local sync state is on, see persist_state)
+def use_booking_store():
+    return persist_state and frappe.db.get_single_value("ZSW", "use_booking_store")
+
+"""
+ Bookings of a period: from the booking store (use_booking_store, pulled up to the end time and
+ backfilled to the start time first) or fetched in time windows (iter_bookings). persist=False
+ (dry runs) reads the store without pulling into it (see peek_bookings)
+"""
+def read_bookings(start_time, end_time, profile=None, update_sync=True, persist=True):
+    if not use_booking_store():
+        return iter_bookings(start_time, end_time, profile=profile, update_sync=update_sync)
+    if not persist:
+        records = peek_bookings(start_time, end_time, profile)
+        print("Total {0} bookings (store, not pulled)".format(len(records)))
+        return records
+    update_booking_store(start_time, end_time, profile=profile)
+    with profile_phase(profile, "store_read"):
+        records = get_stored_bookings(start_time, end_time)
+    print("Total {0} bookings (store)".format(len(records)))
+    if update_sync:
+        update_last_sync(int(end_time))
+    return records
+
+"""
+ Bookings of a period from the booking store without writing to it: the range from the store
+ watermark (less the re-pulled overlap) on is fetched from ZSW instead of being pulled, a period
+ starting before the covered range is fetched from ZSW entirely
+"""
+def peek_bookings(start_time, end_time, profile=None):
+    start_time = int(start_time)
+    end_time = int(end_time)
+    watermark = get_sync_watermark(BOOKING_STORE_STATE)
+    covered = watermark and start_time >= get_store_coverage()
+    split = min(max(watermark - BOOKING_STORE_OVERLAP, start_time), end_time) if covered else start_time
+    records = []
+    if split > start_time:
+        with profile_phase(profile, "store_read"):
+            records = get_stored_bookings(start_time, split - 1)
+    if split < end_time:
+        records += list(iter_bookings(split, end_time, profile=profile, update_sync=False))
+    return records
+
+# booked hours per customer from the booking store (booking pair durations, without overrides) in an invoicing period
+@frappe.whitelist()
+def get_stored_booking_hours(from_date, to_date, customer=None):
+    start_time, end_time = get_invoice_period(from_date, to_date)
+    return frappe.db.sql("""SELECT `customer`, COUNT(`name`) AS `bookings`, ROUND(SUM(`duration`) / 60, 2) AS `hours`
+        FROM `tabZSW Booking`
+        WHERE `time_in_seconds` BETWEEN %(start_time)s AND %(end_time)s {conditions}
+        GROUP BY `customer`
+        ORDER BY `customer` ASC;""".format(conditions=" AND `customer` = %(customer)s" if customer else ""),
+        {'start_time': start_time, 'end_time': end_time, 'customer': customer}, as_dict=True)
+
+"""
+ Delta sync: a fingerprint of the last payload successfully pushed to ZSW is kept per
+ record (ZSW Sync Record), only records with a changed payload are sent (unless forced)
+"""
+def get_sync_key(record_type, record_name, tenant=None):
+    return "{0}:{1}:{2}".format(tenant or "-", record_type, record_name)
+
+def get_payload_fingerprint(payload):
+    return hashlib.md5(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# returns the stored fingerprints as dict record_name: fingerprint
+def get_sync_fingerprints(record_type, record_names, tenant=None, chunk_size=1000):
+    fingerprints = {}
+    if not persist_state:
+        return fingerprints
+    record_names = list(record_names)
+    for i in range(0, len(record_names), chunk_size):
+        for r in frappe.db.sql("""SELECT `record_name`, `fingerprint`
+                FROM `tabZSW Sync Record`
+                WHERE `record_type` = %(record_type)s AND `tenant` = %(tenant)s AND `record_name` IN %(record_names)s""",
+                {'record_type': record_type, 'tenant': tenant or "", 'record_names': tuple(record_names[i:i+chunk_size])}, as_dict=True):
+            fingerprints[r['record_name']] = r['fingerprint']
+    return fingerprints
+
+# store fingerprints (dict record_name: fingerprint) of successfully pushed records
+def set_sync_fingerprints(record_type, fingerprints, tenant=None, chunk_size=500):
+    if not fingerprints or not persist_state:
+        return
+    timestamp = now()
+    user = frappe.session.user
+    rows = list(fingerprints.items())
+    for i in range(0, len(rows), chunk_size):
+        values = []
+        for record_name, fingerprint in rows[i:i+chunk_size]:
+            values.append((get_sync_key(record_type, record_name, tenant), record_type, record_name, tenant or "",
+                fingerprint, timestamp, "Synced", timestamp, timestamp, user, user))
+        # queued pushes keep their status (see push queue)
+        frappe.db.sql("""INSERT INTO `tabZSW Sync Record`
+                (`name`, `record_type`, `record_name`, `tenant`, `fingerprint`, `last_sync`, `status`, `creation`, `modified`, `owner`, `modified_by`)
+            VALUES {0}
+            ON DUPLICATE KEY UPDATE `fingerprint` = VALUES(`fingerprint`), `last_sync` = VALUES(`last_sync`),
+                `error` = IF(`status` IN ('Queued', 'Syncing'), `error`, NULL),
+                `status` = IF(`status` IN ('Queued', 'Syncing'), `status`, VALUES(`status`)),
+                `modified` = VALUES(`modified`), `modified_by` = VALUES(`modified_by`)""".format(
+                ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(values))),
+            tuple(v for row in values for v in row))
+    frappe.db.commit()
+
+# drop stored fingerprints (all or of one record type), the next sync will push everything again
+def clear_sync_fingerprints(record_type=None):
+    if record_type:
+        frappe.db.sql("""DELETE FROM `tabZSW Sync Record` WHERE `record_type` = %(record_type)s""", {'record_type': record_type})
     else:
-        city = "-"
-        street = "-"
-        pincode = "-"
+        frappe.db.sql("""DELETE FROM `tabZSW Sync Record`""")
+    frappe.db.commit()
+
+"""
+ Returns the records whose fingerprint differs from the stored one (all records if forced)
+   payloads: dict record_name: payload
+ and the fingerprints of these records (to be stored after a successful push)
+"""
+def get_changed_payloads(record_type, payloads, tenant=None, force=False):
+    fingerprints = {name: get_payload_fingerprint(payload) for name, payload in payloads.items()}
+    if not force:
+        stored = get_sync_fingerprints(record_type, fingerprints.keys(), tenant)
+        fingerprints = {name: fingerprint for name, fingerprint in fingerprints.items() if stored.get(name) != fingerprint}
+    return fingerprints
+
+def create_update_customer(customer, customer_name, active, kst=None, tenant="AT", technician=None, short_name=None, force=False):
+    return create_update_customers([{
+        'customer': customer,
+        'customer_name': customer_name,
+        'active': active,
+        'kst': kst,
+        'technician': technician,
+        'short_name': short_name
+    }], tenant=tenant, force=force)
+
+"""
+ Creates or updates a list of customers in ZSW
+   customers: list of dicts with customer, customer_name, active, kst, technician, short_name
+   force: push all customers, also if their payload did not change since the last sync
+
+ E-levels are read for a chunk of customers at once, updates are built in memory and sent
+ as one updateLevelsE / createLevelsE call per chunk
+"""
+def create_update_customers(customers, tenant="AT", chunk_size=CUSTOMER_CHUNK_SIZE, force=False):
+    payloads = []
+    failed = []
+    # load ERP information of all customers at once
+    customer_data = get_customer_zsw_data([c['customer'] for c in customers])
+    for c in customers:
+        try:
+            payloads.append(get_customer_payload(
+                customer=c['customer'],
+                customer_name=c['customer_name'],
+                active=c.get('active', True),
+                kst=c.get('kst'),
+                tenant=tenant,
+                technician=c.get('technician'),
+                short_name=c.get('short_name'),
+                data=customer_data.get(c['customer'])))
+        except Exception as err:
+            print("Failed: {0} ({1})".format(c['customer'], err))
+            failed.append(get_zsw_reference(c['customer'], tenant))
+    # only push customers with changed payload
+    fingerprints = get_changed_payloads("Customer", {p['customer']: p for p in payloads}, tenant, force)
+    skipped = len(payloads) - len(fingerprints)
+    payloads = [p for p in payloads if p['customer'] in fingerprints]
+    summary = push_customers(payloads, chunk_size=chunk_size, fingerprints=fingerprints, tenant=tenant)
+    summary['failed'] += failed
+    summary['skipped'] = skipped
+    return summary
+
+# collect the ERP information of a customer for ZSW (data: see get_customer_zsw_data)
+def get_customer_payload(customer, customer_name, active, kst=None, tenant="AT", technician=None, short_name=None, data=None):
+    if data is None:
+        data = get_customer_zsw_data([customer]).get(customer) or {}
+    city = data.get('city') or "-"
     # technician: crop from technician field (email ID without @...)
-    customer_record = frappe.get_doc("Customer", customer)
-    if technician:
+    if technician and technician == data.get('technik'):
+        zsw_technician = data.get('technician')
+    elif technician:
         zsw_technician = get_technician_id(technician)
     else:
         zsw_technician = ""
-    # contact
-    if customer_record.customer_primary_contact:
-        contact = frappe.get_doc("Contact", customer_record.customer_primary_contact)
-        email = contact.email_id or "-"
-        phone = contact.phone or "-"
-    else:
-        # no primary contact defined
-        con_id = frappe.get_all("Dynamic Link",
-            filters={'link_doctype': 'Customer', 'link_name': customer, 'parenttype': 'Contact'},
-            fields=['parent'])
-        if con_id:
-            contact = frappe.get_doc("Contact", con_id[0]['parent'])
-            email = contact.email_id or "-"
-            phone = contact.phone or "-"
-        else:
-            email = "-"
-            phone = "-"
-    # maintenance contract customer?
-    #sql_query = """SELECT DISTINCT `tabSales Invoice`.`posting_date`
-    #               FROM `tabSales Invoice Item`
-    #               LEFT JOIN `tabSales Invoice` ON `tabSales Invoice Item`.`parent` = `tabSales Invoice`.`name`
-    #               WHERE
-    #                `tabSales Invoice`.`posting_date` >= (DATE_SUB(NOW(), INTERVAL 12 MONTH))
-    #                AND `tabSales Invoice Item`.`item_code` IN ("3010")
-    #                AND `tabSales Invoice`.`customer` = '{customer}'
-    #                AND `tabSales Invoice`.`is_return` = 0
-    #               ORDER BY `tabSales Invoice`.`posting_date` DESC;""".format(customer=customer)
-    #contract = frappe.db.sql(sql_query, as_dict=True)
-    #if len(contract) > 0:
-    #    maintenance_contract = True
-    #else:
-    #    maintenance_contract = False
-    # fetch license information
-    licence = frappe.get_all("Licence", filters={'customer': customer}, fields=['title', 'retailer', 'customer'])
-    if len(licence) > 0:
-        licence_name = licence[0]['title']
-        # check if retail customer / commission
-        if licence[0]['retailer'] and licence[0]['retailer'] != licence[0]['customer']:
-            active = False          # disable retail end-customers
-    else:
-        licence_name = None
-    # create link information (for cost center groups)
-    link = {
-        'naturalID': zsw_reference,
-        'naturalInfo': 1,
-        'linkType': 3,
-        'action': 4
-      }
-    # map cost center
+    # check if retail customer / commission
+    if data.get('is_retail_customer'):
+        active = False          # disable retail end-customers
+    return {
+        'customer': customer,
+        'zsw_reference': get_zsw_reference(customer, tenant),
+        'customer_name': customer_name,
+        'text': "{0}, {1}".format(short_name or customer_name, city),
+        'active': active,
+        'city': city,
+        'street': data.get('street') or "-",
+        'pincode': data.get('pincode') or "-",
+        'email': data.get('email') or "-",
+        'phone': data.get('phone') or "-",
+        'technician': zsw_technician,
+        'licence_name': data.get('licence_name'),
+        'kst_code': get_kst_code(kst) if kst else None
+    }
+
+"""
+ Loads the ERP information for ZSW customer levels with a few set-based queries
+ Returns a dict per customer with city, street, pincode (primary address), email, phone (primary
+ or first contact), licence_name, is_retail_customer (licence) and technik, technician (ZSW username)
+"""
+def get_customer_zsw_data(customers, chunk_size=1000):
+    data = {}
+    customers = list(customers or [])
+    for i in range(0, len(customers), chunk_size):
+        chunk = tuple(customers[i:i+chunk_size])
+        for c in chunk:
+            data[c] = {}
+        # addresses: primary address, otherwise the first linked address
+        addresses = frappe.db.sql("""
+            SELECT 
+                `tabDynamic Link`.`link_name` AS `customer`,
+                `tabAddress`.`city`,
+                `tabAddress`.`address_line1` AS `street`,
+                `tabAddress`.`pincode`,
+                `tabAddress`.`is_primary_address`
+            FROM `tabDynamic Link`
+            JOIN `tabAddress` ON `tabAddress`.`name` = `tabDynamic Link`.`parent`
+            WHERE 
+                `tabDynamic Link`.`parenttype` = 'Address'
+                AND `tabDynamic Link`.`link_doctype` = 'Customer'
+                AND `tabDynamic Link`.`link_name` IN %(customers)s
+            ORDER BY `tabAddress`.`is_primary_address` DESC, `tabAddress`.`creation` ASC;""", 
+            {'customers': chunk}, as_dict=True)
+        for adr in addresses:
+            customer_data = data.setdefault(adr['customer'], {})
+            if 'city' not in customer_data:
+                customer_data.update({
+                    'city': adr['city'], 
+                    'street': adr['street'], 
+                    'pincode': adr['pincode']
+                })
+        # customer: primary contact and technician
+        customer_records = frappe.db.sql("""
+            SELECT 
+                `tabCustomer`.`name` AS `customer`,
+                `tabCustomer`.`customer_primary_contact`,
+                `tabCustomer`.`technik`,
+                `tabUser`.`username` AS `technician`,
+                `tabContact`.`email_id` AS `email`,
+                `tabContact`.`phone`
+            FROM `tabCustomer`
+            LEFT JOIN `tabContact` ON `tabContact`.`name` = `tabCustomer`.`customer_primary_contact`
+            LEFT JOIN `tabUser` ON `tabUser`.`name` = `tabCustomer`.`technik`
+            WHERE `tabCustomer`.`name` IN %(customers)s;""", 
+            {'customers': chunk}, as_dict=True)
+        without_primary_contact = []
+        for c in customer_records:
+            customer_data = data.setdefault(c['customer'], {})
+            customer_data.update({
+                'technik': c['technik'],
+                # fallback to first part of mail
+                'technician': c['technician'] or (c['technik'] or "").split('@')[0]
+            })
+            if c['customer_primary_contact']:
+                customer_data.update({'email': c['email'], 'phone': c['phone']})
+            else:
+                without_primary_contact.append(c['customer'])
+        # no primary contact defined: first linked contact
+        if without_primary_contact:
+            contacts = frappe.db.sql("""
+                SELECT 
+                    `tabDynamic Link`.`link_name` AS `customer`,
+                    `tabContact`.`email_id` AS `email`,
+                    `tabContact`.`phone`
+                FROM `tabDynamic Link`
+                JOIN `tabContact` ON `tabContact`.`name` = `tabDynamic Link`.`parent`
+                WHERE 
+                    `tabDynamic Link`.`parenttype` = 'Contact'
+                    AND `tabDynamic Link`.`link_doctype` = 'Customer'
+                    AND `tabDynamic Link`.`link_name` IN %(customers)s
+                ORDER BY `tabContact`.`creation` ASC;""", 
+                {'customers': tuple(without_primary_contact)}, as_dict=True)
+            for con in contacts:
+                customer_data = data.setdefault(con['customer'], {})
+                if 'email' not in customer_data:
+                    customer_data.update({'email': con['email'], 'phone': con['phone']})
+        # licence information
+        licences = frappe.db.sql("""
+            SELECT `customer`, `title`, `retailer`
+            FROM `tabLicence`
+            WHERE `customer` IN %(customers)s
+            ORDER BY `modified` DESC;""", 
+            {'customers': chunk}, as_dict=True)
+        for lic in licences:
+            customer_data = data.setdefault(lic['customer'], {})
+            if 'licence_name' not in customer_data:
+                customer_data.update({
+                    'licence_name': lic['title'],
+                    'is_retail_customer': True if (lic['retailer'] and lic['retailer'] != lic['customer']) else False
+                })
+    return data
+
+# map cost center to ZSW group
+def get_kst_code(kst):
     if "FZW" in kst:
-        kst_code = 86
+        return 86
     elif "FZT" in kst:
-        kst_code = 87
+        return 87
     elif "FZCH" in kst:
-        kst_code = 114
+        return 114
     elif "FZO" in kst:
-        kst_code = 150
+        return 150
     else:
-        kst_code = 13
-    s = getSession()
-    # create or update customer
-    wsTsNow = client.service.getTime(s)
-    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': zsw_reference }] }
-    wsLevelEArray = client.service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow)
-    #print("Level E: {0}".format(wsLevelEArray))
-    # prepare properties
-    available_properties = get_all_property_definitions()
-    # check if customer exists
-    if wsLevelEArray:
-        # customer exists --> update
-        print("Customer found, update")
-        wsLevelEArray[0]["action"] = 3
-        if short_name:
-            wsLevelEArray[0]["wsLevel"]["text"] = "{0}, {1}".format(short_name, city or "-")
+        return 13
+
+# extension values (extension: value) pushed for a customer payload, only extensions defined in ZSW
+def get_customer_extensions(payload, available_properties, update=False):
+    extensions = OrderedDict((name, payload[key]) for name, key in CUSTOMER_EXTENSIONS.items() if name in available_properties)
+    # if "p_wartungsvertrag" in available_properties:
+    #     extensions['p_wartungsvertrag'] = maintenance_contract
+    if update and "p_lizenzname" in available_properties and payload['licence_name']:
+        extensions['p_lizenzname'] = payload['licence_name']
+    return extensions
+
+# level text pushed for a customer payload (new levels are created with the customer name)
+def get_customer_level_text(payload, update=False):
+    return payload['text'] if update else payload['customer_name']
+
+# set the customer extensions on a (new or existing) E-level
+def set_customer_extensions(extensions, payload, available_properties, update=False):
+    for name, value in get_customer_extensions(payload, available_properties, update).items():
+        if name == "p_projektverantwortlicher":
+            createOrUpdateWSExtension_link(extensions, name, value, 2, 0, False)
         else:
-            wsLevelEArray[0]["wsLevel"]["text"] = "{0}, {1}".format(customer_name, city or "-")
-        wsLevelEArray[0]["wsLevel"]["active"] = active
-        # make sure extension key exists
-        if not wsLevelEArray[0]["extensions"]:
-            wsLevelEArray[0]["extensions"] = {'WSExtension': []}
-        if not wsLevelEArray[0]["extensions"]["WSExtension"]:
-            wsLevelEArray[0]["extensions"]["WSExtension"] = []
-        if "p_ortKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_ortKunde", city)
-        if "p_strasseKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_strasseKunde", street)
-        if "p_plzKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_plzKunde", pincode)
-        if "p_mailadresseKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_mailadresseKunde", email)
-        if "p_telefonnummer" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_telefonnummer", phone)
-        # if "p_wartungsvertrag" in available_properties:
-        #     createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_wartungsvertrag", maintenance_contract)
-        if "p_projektverantwortlicher" in available_properties:
-            createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_projektverantwortlicher", zsw_technician, 2, 0, False)
-        if "p_lizenzname" in available_properties and licence_name:
-            createOrUpdateWSExtension(wsLevelEArray[0]["extensions"]["WSExtension"], "p_lizenzname", licence_name)
-        # compress level
-        contentDict = compress_level_e(wsLevelEArray[0])
-        print("{0}".format(contentDict))
+            createOrUpdateWSExtension(extensions, name, value)
+    return
+
+def get_customer_level_update(level_e, payload, available_properties):
+    level_e["action"] = ENUM_ACTION['UPDATE']
+    level_e["wsLevel"]["text"] = get_customer_level_text(payload, update=True)
+    level_e["wsLevel"]["active"] = payload['active']
+    # make sure extension key exists
+    if not level_e["extensions"]:
+        level_e["extensions"] = {'WSExtension': []}
+    if not level_e["extensions"]["WSExtension"]:
+        level_e["extensions"]["WSExtension"] = []
+    set_customer_extensions(level_e["extensions"]["WSExtension"], payload, available_properties, update=True)
+    # compress level
+    return compress_level_e(level_e)
+
+def get_customer_level_create(payload, available_properties):
+    level_e = {
+        'action': ENUM_ACTION['CREATE'],
+        'wsLevel': { 'active': payload['active'], 'levelID': get_zsw_level("Customer"), 'code': payload['zsw_reference'], 'text': get_customer_level_text(payload) },
+        'extensions': { 'WSExtension': [   ]}
+    }
+    set_customer_extensions(level_e['extensions']['WSExtension'], payload, available_properties)
+    return level_e
+
+"""
+ Sends prepared customer payloads to ZSW in chunks, returns a summary with the failed ZSW references.
+ A chunk that fails (e.g. reading its E-levels) is counted as failed and the next chunk is sent;
+ the fingerprints (customer: fingerprint) of the customers of a chunk are stored once it is pushed
+"""
+def push_customers(payloads, chunk_size=CUSTOMER_CHUNK_SIZE, fingerprints=None, tenant=None):
+    summary = {'updated': 0, 'created': 0, 'failed': []}
+    if not payloads:
+        return summary
+    done = 0
+    try:
+        with zsw_session() as s:
+            # prepare properties
+            available_properties = get_all_property_definitions()
+            wsTsNow = get_client().service.getTime(s)
+            for i in range(0, len(payloads), chunk_size):
+                chunk = payloads[i:i+chunk_size]
+                done = i + len(chunk)
+                try:
+                    failed = push_customer_chunk(s, chunk, available_properties, wsTsNow, summary)
+                except Exception as err:
+                    frappe.log_error("Pushing customers {0} failed: {1}".format(
+                        [p['zsw_reference'] for p in chunk], err), "ZSW update customer")
+                    summary['failed'] += [p['zsw_reference'] for p in chunk]
+                    continue
+                summary['failed'] += failed
+                if fingerprints:
+                    set_sync_fingerprints("Customer", {p['customer']: fingerprints[p['customer']] for p in chunk
+                        if p['zsw_reference'] not in failed and p['customer'] in fingerprints}, tenant)
+    except Exception as err:
+        # no session or no property definitions: the remaining customers have not been sent
+        frappe.log_error("Pushing customers failed: {0}".format(err), "ZSW update customer")
+        summary['failed'] += [p['zsw_reference'] for p in payloads[done:]]
+    return summary
+
+# send one chunk of customers (updates and creates), returns the ZSW references that could not be sent
+def push_customer_chunk(s, chunk, available_properties, wsTsNow, summary):
+    failed = []
+    # read existing customers of this chunk in one call
+    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': p['zsw_reference']} for p in chunk] }
+    wsLevelEArray = get_client().service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow) or []
+    existing = {}
+    for level_e in wsLevelEArray:
+        existing[level_e["wsLevel"]["code"]] = level_e
+    updates = []
+    creates = []
+    for p in chunk:
+        if p['zsw_reference'] in existing:
+            updates.append(get_customer_level_update(existing[p['zsw_reference']], p, available_properties))
+        else:
+            creates.append(get_customer_level_create(p, available_properties))
+    print("{0} customers to update, {1} to create".format(len(updates), len(creates)))
+    summary['updated'] += send_levels_e(s, "updateLevelsE", updates, failed)
+    summary['created'] += send_levels_e(s, "createLevelsE", creates, failed)
+    # add links for cost center groups (or ignore if it exists already)
+    for p in chunk:
+        if not p['kst_code']:
+            continue
+        link = {
+            'naturalID': p['zsw_reference'],
+            'naturalInfo': 1,
+            'linkType': 3,
+            'action': 4
+        }
         try:
-            client.service.updateLevelsE(session, {'WSExtensibleLevel': [contentDict]})
+            get_client().service.quickAddGroupMember(s, p['kst_code'], link)
         except Exception as err:
-            frappe.log_error("{0} on {1}".format(err, contentDict), "ZSW create_update customer error")
-    else:
-        print("Customer not found")
-        wsLevelEArray = { 'WSExtensibleLevel' : 
-          [{
-            'action': 1,
-            'wsLevel': { 'active': active, 'levelID': get_zsw_level("Customer"), 'code': zsw_reference, 'text': customer_name },
-            'extensions': { 'WSExtension': [   ]}
-          }]
-        }
-        if "p_ortKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]['extensions']['WSExtension'], 'p_ortKunde', city)
-        if "p_strasseKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_strasseKunde", street)
-        if "p_plzKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_plzKunde", pincode)
-        if "p_mailadresseKunde" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_mailadresseKunde", email)
-        if "p_telefonnummer" in available_properties:
-            createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_telefonnummer", phone)
-        # if "p_wartungsvertrag" in available_properties:
-        #     createOrUpdateWSExtension(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_wartungsvertrag", maintenance_contract)
-        if "p_projektverantwortlicher" in available_properties:
-            createOrUpdateWSExtension_link(wsLevelEArray['WSExtensibleLevel'][0]["extensions"]["WSExtension"], "p_projektverantwortlicher", zsw_technician, 2, 0, False)
-        client.service.createLevelsE(session, wsLevelEArray)
-
-    # add link (or ignore if it exists already)
+            frappe.log_error( "Unable to add link ({0})<br>Session: {1}, kst: {2}, link: {3}".format(
+                err, s, p['kst_code'], link), "ZSW update customer" )
+    return failed
+
+"""
+ Sends a list of E-levels with one call; if the chunk fails, the levels are sent one by one
+ to isolate the failing records. Returns the number of levels sent successfully.
+"""
+def send_levels_e(s, operation, levels, failed):
+    if not levels:
+        return 0
     try:
-        if kst:
-            client.service.quickAddGroupMember(session, kst_code, link)
+        getattr(get_client().service, operation)(s, {'WSExtensibleLevel': levels})
+        return len(levels)
     except Exception as err:
-        frappe.log_error( "Unable to add link ({0})<br>Session: {1}, kst: {2}, link: {3}".format(
-            err, session, kst_code, link), "ZSW update customer" )
-    # close connection
-    disconnect()
-    return
+        print("{0} failed for chunk ({1}), retry one by one".format(operation, err))
+    count = 0
+    for level in levels:
+        try:
+            getattr(get_client().service, operation)(s, {'WSExtensibleLevel': [level]})
+            count += 1
+        except Exception as err:
+            failed.append(level['wsLevel']['code'])
+            frappe.log_error("{0} on {1}".format(err, level), "ZSW create_update customer error")
+    return count
 
-def create_update_item(item_code, item_name, active, target):
+def create_update_item(item_code, item_name, active, target, force=False):
     if active == 1 or active == "1":
         active = True
     elif active == 0 or active == "0":
@@ -466,16 +1883,19 @@ def create_update_item(item_code, item_name, active, target):
           'text': item_name
         }]
     }
+    # skip unchanged items
+    fingerprints = get_changed_payloads(target, {item_code: level}, force=force)
+    if not fingerprints:
+        return
     # connect to ZSW
     #print("Writing {0}".format(level))
-    s = getSession()
-    # create or update sales order
-    client.service.createLevels(session, level, True)
-    # close connection
-    disconnect()
+    with zsw_session() as s:
+        # create or update sales order
+        get_client().service.createLevels(s, level, True)
+    set_sync_fingerprints(target, fingerprints)
     return
     
-def create_update_sales_order(sales_order, customer, customer_name, tenant="AT", technician=None, active=True, debug=False):
+def create_update_sales_order(sales_order, customer, customer_name, tenant="AT", technician=None, active=True, debug=False, force=False):
     # collect city
     so = frappe.get_doc("Sales Order", sales_order)
     try:
@@ -510,39 +1930,46 @@ def create_update_sales_order(sales_order, customer, customer_name, tenant="AT",
           'text': "{0}, {1}".format(customer_name, city)
         }]
     }
+    # skip unchanged projects
+    fingerprints = get_changed_payloads("Sales Order", {sales_order: {
+        'level': level,
+        'customer': get_zsw_reference(customer, tenant),
+        'technician': zsw_technician
+    }}, tenant, force)
+    if not fingerprints:
+        print("ZSW project {0} unchanged".format(zsw_project_name))
+        return
     # connect to ZSW
-    s = getSession()
-    # create or update sales order
-    client.service.createLevels(session, level, True)
-    # retrieve E-level
-    wsTsNow = client.service.getTime(s)
-    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': get_zsw_reference(customer, tenant) }] }
-    wsLevelEArray = client.service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow)
-    if wsLevelEArray:
-        #print("Level E Array: {0}".format(wsLevelEArray[0]) )
-        # make sure extension key exists
-        if not wsLevelEArray[0]["extensions"]:
-            wsLevelEArray[0]["extensions"] = {'WSExtension': []}
-        if not wsLevelEArray[0]["extensions"]["WSExtension"]:
-            wsLevelEArray[0]["extensions"]["WSExtension"] = []
-        if active:
-            # create
-            createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_auftrag_projekt", zsw_project_name, 4, 3, False)
+    with zsw_session() as s:
+        # create or update sales order
+        get_client().service.createLevels(s, level, True)
+        # retrieve E-level
+        wsTsNow = get_client().service.getTime(s)
+        wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': get_zsw_reference(customer, tenant) }] }
+        wsLevelEArray = get_client().service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow)
+        if wsLevelEArray:
+            #print("Level E Array: {0}".format(wsLevelEArray[0]) )
+            # make sure extension key exists
+            if not wsLevelEArray[0]["extensions"]:
+                wsLevelEArray[0]["extensions"] = {'WSExtension': []}
+            if not wsLevelEArray[0]["extensions"]["WSExtension"]:
+                wsLevelEArray[0]["extensions"]["WSExtension"] = []
+            if active:
+                # create
+                createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_auftrag_projekt", zsw_project_name, 4, 3, False)
+            else:
+                # delete link
+                createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_auftrag_projekt", zsw_project_name, 4, 3, True)
+            if debug:
+                print("Project responsible: {0}".format(zsw_technician))
+            createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_projektverantwortlicher", zsw_technician, 2, 0, False)
+            contentDict = compress_level_e(wsLevelEArray[0])
+            if debug:
+                print("Content: {0}".format(contentDict))
+            get_client().service.updateLevelsE(s, {'WSExtensibleLevel': [contentDict]})
+            set_sync_fingerprints("Sales Order", fingerprints, tenant)
         else:
-            # delete link
-            createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_auftrag_projekt", zsw_project_name, 4, 3, True)
-        if debug:
-            print("Project responsible: {0}".format(zsw_technician))
-        createOrUpdateWSExtension_link(wsLevelEArray[0]["extensions"]["WSExtension"], "p_projektverantwortlicher", zsw_technician, 2, 0, False)
-        contentDict = compress_level_e(wsLevelEArray[0])
-        if debug:
-            print("Content: {0}".format(contentDict))
-        client.service.updateLevelsE(session, {'WSExtensibleLevel': [contentDict]})
-    else:
-        frappe.log_error( "Trying to link to customer that does not exist: {0} ({1})".format(customer, sales_order), "ZSW create_update_sales_order")
-        
-    # close connection
-    disconnect()
+            frappe.log_error( "Trying to link to customer that does not exist: {0} ({1})".format(customer, sales_order), "ZSW create_update_sales_order")
     return
 
 def get_zsw_reference(customer, tenant):
@@ -563,94 +1990,288 @@ def get_zsw_project_name(sales_order, tenant):
         zsw_project_name = "{0}".format(sales_order)
     return zsw_project_name
 
-def compress_level_e(level_e_array):
-    #print("Settings: {0}".format(client.settings))
-    contentStr = "{0}".format(level_e_array)
-    contentDict = eval(contentStr)
-    contentDict.pop('genericProperties', None)
-    #print("LevelArray: {0}".format(contentDict))
-    return contentDict
+# convert a zeep extensible level into plain dicts/lists (one walk, generic properties are dropped)
+def compress_level_e(level_e):
+    return {key: serialize_object(level_e[key], dict) for key in level_e if key != 'genericProperties'}
         
 """ interaction mechanisms """
 @frappe.whitelist()
-def update_customer(customer, customer_name, kst="Main", zsw_reference=None, active=True, tenant="AT", technician=None, short_name=None):
-    create_update_customer(
-        customer=customer,
-        customer_name=customer_name,
-        active=active,
-        kst=kst,
-        tenant=tenant,
-        technician=technician,
-        short_name=short_name
-    )
+def update_customer(customer, customer_name, kst="Main", zsw_reference=None, active=True, tenant="AT", technician=None, short_name=None, force=0):
+    # queue the push (see process_push_queue)
+    queue_push("Customer", customer, {
+        'customer': customer,
+        'customer_name': customer_name,
+        'active': active,
+        'kst': kst,
+        'technician': technician,
+        'short_name': short_name,
+        'force': cint(force)
+    }, tenant)
     return
 
 @frappe.whitelist()
-def update_project(sales_order, customer, customer_name, tenant="AT", technician=None, active=True):
-    create_update_sales_order(
-        sales_order=sales_order,
-        customer=customer,
-        customer_name=customer_name,
-        tenant=tenant,
-        technician=technician,
-        active=active
-    )
+def update_project(sales_order, customer, customer_name, tenant="AT", technician=None, active=True, force=0):
+    # queue the push (see process_push_queue)
+    queue_push("Sales Order", sales_order, {
+        'sales_order': sales_order,
+        'customer': customer,
+        'customer_name': customer_name,
+        'technician': technician,
+        'active': active,
+        'force': cint(force)
+    }, tenant)
     return
 
 @frappe.whitelist()
-def update_material(item_code, item_name, active=True):
-    create_update_item(
-        item_code=item_code,
-        item_name=item_name,
-        active=active,
-        target="Item (Material)"
-    )
+def update_material(item_code, item_name, active=True, force=0):
+    # queue the push (see process_push_queue)
+    queue_push("Item (Material)", item_code, {
+        'item_code': item_code,
+        'item_name': item_name,
+        'active': active,
+        'force': cint(force)
+    })
+    return
+
+@frappe.whitelist()
+def update_activity(item_code, item_name, active=True, force=0):
+    # queue the push (see process_push_queue)
+    queue_push("Item (Activity)", item_code, {
+        'item_code': item_code,
+        'item_name': item_name,
+        'active': active,
+        'force': cint(force)
+    })
+    return
+
+"""
+ Push queue for form-triggered updates (update_customer, update_project, update_material,
+ update_activity): the request only stores the payload on the sync record (status Queued) and
+ schedules a consumer. Repeated saves of a record overwrite its queued payload, so saves within
+ the coalescing window result in one push. The consumer drains the queue in batches over one
+ session; the status of each record (Queued, Syncing, Synced, Failed) is kept on its sync record
+"""
+def queue_push(record_type, record_name, payload, tenant=None):
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.sql("""INSERT INTO `tabZSW Sync Record`
+            (`name`, `record_type`, `record_name`, `tenant`, `status`, `payload`, `queued_on`, `creation`, `modified`, `owner`, `modified_by`)
+        VALUES (%(name)s, %(record_type)s, %(record_name)s, %(tenant)s, 'Queued', %(payload)s, %(timestamp)s, %(timestamp)s, %(timestamp)s, %(user)s, %(user)s)
+        ON DUPLICATE KEY UPDATE `status` = 'Queued', `payload` = VALUES(`payload`), `queued_on` = VALUES(`queued_on`),
+            `error` = NULL, `modified` = VALUES(`modified`), `modified_by` = VALUES(`modified_by`)""",
+        {
+            'name': get_sync_key(record_type, record_name, tenant),
+            'record_type': record_type,
+            'record_name': record_name,
+            'tenant': tenant or "",
+            'payload': json.dumps(payload),
+            'timestamp': timestamp,
+            'user': user
+        })
+    frappe.db.commit()
+    schedule_push_queue()
+    return
+
+def get_push_queue_key(name):
+    return "{0}|zsw_push_queue|{1}".format(frappe.local.site, name)
+
+# enqueue a consumer unless one is already waiting for the coalescing window
+def schedule_push_queue():
+    if frappe.cache().set(get_push_queue_key("scheduled"), 1, nx=True, ex=PUSH_LOCK_TIMEOUT):
+        enqueue_zsw_job("finkzeit.finkzeit.zsw.process_push_queue",
+            queue='default',
+            timeout=PUSH_LOCK_TIMEOUT)
+    return
+
+"""
+ Consumer of the push queue: waits for the coalescing window, then pushes the queued records in
+ batches until the queue is empty. One consumer drains at a time (lock in redis); a consumer
+ that finds the lock taken leaves its records to the running one, which checks the queue again
+ after releasing the lock
+"""
+def process_push_queue():
+    sleep(PUSH_COALESCE_WINDOW)
+    cache = frappe.cache()
+    cache.delete(get_push_queue_key("scheduled"))
+    while cache.set(get_push_queue_key("lock"), os.getpid(), nx=True, ex=PUSH_LOCK_TIMEOUT):
+        try:
+            # records left in Syncing by an aborted consumer (longer than a consumer may hold the lock)
+            frappe.db.sql("""UPDATE `tabZSW Sync Record` SET `status` = 'Queued'
+                WHERE `status` = 'Syncing' AND `modified` < %(cutoff)s""",
+                {'cutoff': now_datetime() - timedelta(seconds=PUSH_LOCK_TIMEOUT)})
+            frappe.db.commit()
+            while True:
+                records = frappe.db.sql("""SELECT `name`, `record_type`, `record_name`, `tenant`, `payload`
+                    FROM `tabZSW Sync Record`
+                    WHERE `status` = 'Queued'
+                    ORDER BY `queued_on` ASC
+                    LIMIT %(batch_size)s;""", {'batch_size': PUSH_BATCH_SIZE}, as_dict=True)
+                if not records:
+                    break
+                frappe.db.sql("""UPDATE `tabZSW Sync Record` SET `status` = 'Syncing', `modified` = %(timestamp)s
+                    WHERE `name` IN %(names)s""", {'names': tuple(r['name'] for r in records), 'timestamp': now()})
+                frappe.db.commit()
+                push_queued_records(records)
+                cache.expire(get_push_queue_key("lock"), PUSH_LOCK_TIMEOUT)
+        finally:
+            cache.delete(get_push_queue_key("lock"))
+        if not frappe.db.sql("""SELECT `name` FROM `tabZSW Sync Record` WHERE `status` = 'Queued' LIMIT 1"""):
+            break
+    return
+
+# push a batch of queued sync records over one session and set their status
+def push_queued_records(records):
+    errors = {}                     # sync record: error
+    groups = {}                     # (record type, tenant, force): records
+    for r in records:
+        r['payload'] = json.loads(r['payload'] or "{}")
+        groups.setdefault((r['record_type'], r['tenant'] or None, cint(r['payload'].get('force'))), []).append(r)
+    try:
+        with zsw_session():
+            for (record_type, tenant, force), group in groups.items():
+                try:
+                    errors.update(push_queued_group(record_type, tenant or "AT", force, group))
+                except Exception as err:
+                    frappe.log_error("Push queue batch failed: {0}".format(err), "ZSW push queue")
+                    for r in group:
+                        errors[r['name']] = "{0}".format(err)
+    except Exception as err:
+        # no session: retry with the next save or retry_failed_pushes
+        frappe.log_error("Push queue batch failed: {0}".format(err), "ZSW push queue")
+        for r in records:
+            errors.setdefault(r['name'], "{0}".format(err))
+    # records queued again in the meantime stay queued
+    synced = [r['name'] for r in records if r['name'] not in errors]
+    if synced:
+        frappe.db.sql("""UPDATE `tabZSW Sync Record`
+            SET `status` = 'Synced', `payload` = NULL, `error` = NULL, `last_sync` = %(timestamp)s
+            WHERE `name` IN %(names)s AND `status` = 'Syncing'""", {'names': tuple(synced), 'timestamp': now()})
+    for name, error in errors.items():
+        frappe.db.sql("""UPDATE `tabZSW Sync Record` SET `status` = 'Failed', `error` = %(error)s
+            WHERE `name` = %(name)s AND `status` = 'Syncing'""", {'name': name, 'error': error[:1000]})
+    frappe.db.commit()
     return
 
+# push the queued records of one record type, tenant and force flag, returns the errors by sync record
+def push_queued_group(record_type, tenant, force, group):
+    errors = {}
+    if record_type == "Customer":
+        summary = create_update_customers([r['payload'] for r in group], tenant=tenant, force=force)
+        for r in group:
+            if get_zsw_reference(r['record_name'], tenant) in summary['failed']:
+                errors[r['name']] = "Push to ZSW failed (see error log)"
+    elif record_type in ("Item (Material)", "Item (Activity)"):
+        summary = sync_items([{
+            'item_code': r['payload']['item_code'],
+            'item_name': r['payload']['item_name'],
+            'disabled': 0 if is_active(r['payload'].get('active', True)) else 1
+        } for r in group], record_type, force=force)
+        for r in group:
+            if r['record_name'] in summary['failed']:
+                errors[r['name']] = "Push to ZSW failed (see error log)"
+    else:
+        for r in group:
+            try:
+                create_update_sales_order(tenant=tenant, **r['payload'])
+            except Exception as err:
+                errors[r['name']] = "{0}".format(err)
+    return errors
+
+def is_active(active):
+    return False if active in (0, "0", False, "false", "False") else True
+
+# requeue the failed pushes
 @frappe.whitelist()
-def update_activity(item_code, item_name, active=True):
-    create_update_item(
-        item_code=item_code,
-        item_name=item_name,
-        active=active,
-        target="Item (Activity)"
-    )
+def retry_failed_pushes():
+    frappe.db.sql("""UPDATE `tabZSW Sync Record` SET `status` = 'Queued', `queued_on` = %(timestamp)s
+        WHERE `status` = 'Failed' AND `payload` IS NOT NULL""", {'timestamp': now()})
+    frappe.db.commit()
+    schedule_push_queue()
     return
 
+# sync status of a record (per record type and tenant)
+@frappe.whitelist()
+def get_sync_status(record_name, record_types=None):
+    conditions = ""
+    if record_types:
+        if not isinstance(record_types, list):
+            record_types = json.loads(record_types)
+        conditions = "AND `record_type` IN %(record_types)s"
+    return frappe.db.sql("""SELECT `record_type`, `tenant`, `status`, `last_sync`, `queued_on`, `error`
+        FROM `tabZSW Sync Record`
+        WHERE `record_name` = %(record_name)s {conditions}
+        ORDER BY `record_type` ASC;""".format(conditions=conditions),
+        {'record_name': record_name, 'record_types': tuple(record_types or [])}, as_dict=True)
+
 """
   This function will sync all materials to ZSW
 """
-def sync_materials():
+def sync_materials(force=False, chunk_size=ITEM_CHUNK_SIZE):
     materials = frappe.get_all("Item", 
         filters={'sync_as_material_to_zsw': 1}, 
         fields=['item_code', 'item_name', 'disabled'])
     print("Syncing {0} materials...".format(len(materials)))
-    for m in materials:
-        if m['disabled'] == 0:
-            active = True
-        else:
-            active = False
-        update_material(m['item_code'], m['item_name'], active)
-    return
+    summary = sync_items(materials, "Item (Material)", force, chunk_size)
+    print("Done ({0} synced, {1} unchanged, {2} failed)".format(summary['synced'], summary['skipped'], len(summary['failed'])))
+    return summary
 
 """
   This function will sync all activities to ZSW
 """
-def sync_activities():
+def sync_activities(force=False, chunk_size=ITEM_CHUNK_SIZE):
     activities = frappe.get_all("Item", 
         filters={'sync_as_activity_to_zsw': 1}, 
         fields=['item_code', 'item_name', 'disabled'])
     print("Syncing {0} activities...".format(len(activities)))
-    for a in activities:
-        if a['disabled'] == 0:
-            active = True
-        else:
-            active = False
-        update_activity(a['item_code'], a['item_name'], active)
-    return
-    
+    summary = sync_items(activities, "Item (Activity)", force, chunk_size)
+    print("Done ({0} synced, {1} unchanged, {2} failed)".format(summary['synced'], summary['skipped'], len(summary['failed'])))
+    return summary
+
+"""
+ Push items (item_code, item_name, disabled) to ZSW, unchanged items are skipped (unless forced)
+
+ Levels are sent in chunks with one createLevels call each over one session; if a chunk
+ fails, its levels are sent one by one to isolate the failing items.
+ Returns a summary with the failed item codes
+"""
+def sync_items(items, target, force=False, chunk_size=ITEM_CHUNK_SIZE):
+    summary = {'synced': 0, 'skipped': 0, 'failed': []}
+    levels = {}
+    for i in items:
+        levels[i['item_code']] = {
+            'active': False if i['disabled'] else True,
+            'code': i['item_code'],
+            'levelID': get_zsw_level(target),
+            'text': i['item_name']
+        }
+    fingerprints = get_changed_payloads(target, {code: {'WSLevel': [level]} for code, level in levels.items()}, force=force)
+    summary['skipped'] = len(levels) - len(fingerprints)
+    if not fingerprints:
+        return summary
+    item_codes = list(fingerprints.keys())
+    with zsw_session() as s:
+        for i in range(0, len(item_codes), chunk_size):
+            chunk = item_codes[i:i+chunk_size]
+            try:
+                get_client().service.createLevels(s, {'WSLevel': [levels[c] for c in chunk]}, True)
+                synced = chunk
+            except Exception as err:
+                print("Chunk {0} failed ({1}), retry one by one".format(int(i / chunk_size) + 1, err))
+                synced = []
+                for c in chunk:
+                    try:
+                        get_client().service.createLevels(s, {'WSLevel': [levels[c]]}, True)
+                        synced.append(c)
+                    except Exception as err:
+                        summary['failed'].append(c)
+                        frappe.log_error("{0} on {1}".format(err, levels[c]), "ZSW sync {0}".format(target))
+            print("Chunk {0}: {1} of {2} {3} synced".format(int(i / chunk_size) + 1, len(synced), len(chunk), target))
+            summary['synced'] += len(synced)
+            set_sync_fingerprints(target, {c: fingerprints[c] for c in synced})
+    return summary
+
 @frappe.whitelist()
-def enqueue_create_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None, service_filter=None, ignore_pricing_rule=1):
+def enqueue_create_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None, service_filter=None, ignore_pricing_rule=1, workers=None):
     # enqueue invoice creation (potential high workload)
     kwargs={
         'tenant': tenant,
@@ -658,14 +2279,33 @@ def enqueue_create_invoices(tenant="AT", from_date=None, to_date=None, kst_filte
         'to_date': to_date,
         'kst_filter': kst_filter,
         'service_filter': service_filter,
-        'ignore_pricing_rule': ignore_pricing_rule
+        'ignore_pricing_rule': ignore_pricing_rule,
+        'workers': workers,
+        'run_id': frappe.generate_hash(length=10)
     }
 
-    enqueue("finkzeit.finkzeit.zsw.create_invoices",
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.create_invoices",
         queue='long',
         timeout=15000,
         **kwargs)
-    return
+    return kwargs['run_id']
+
+@frappe.whitelist()
+def enqueue_create_invoices_multi(runs, from_date=None, to_date=None, workers=None):
+    # enqueue multi-tenant invoice creation (potential high workload)
+    kwargs={
+        'runs': runs,
+        'from_date': from_date,
+        'to_date': to_date,
+        'workers': workers,
+        'run_id': frappe.generate_hash(length=10)
+    }
+
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.create_invoices_multi",
+        queue='long',
+        timeout=15000,
+        **kwargs)
+    return kwargs['run_id']
 
 @frappe.whitelist()
 def enqueue_create_generic_invoices(from_date=None, to_date=None, with_time=False):
@@ -676,18 +2316,208 @@ def enqueue_create_generic_invoices(from_date=None, to_date=None, with_time=Fals
         'with_time': with_time
     }
 
-    enqueue("finkzeit.finkzeit.zsw.create_generic_invoices",
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.create_generic_invoices",
         queue='long',
         timeout=15000,
         **kwargs)
     return
     
-def create_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None, service_filter=None, ignore_pricing_rule=1):
+def create_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None, service_filter=None, ignore_pricing_rule=1, workers=None, run_id=None, dry_run=False):
+    if cint(dry_run):
+        return preview_invoices(tenant, from_date, to_date, kst_filter, service_filter, ignore_pricing_rule)
     # get start timestamp
     print("Reading config...")
     config = frappe.get_doc("ZSW", "ZSW")
     employees = get_employees()
     print("Got {0} employees.".format(len(employees)))
+    # a resumed run uses the booking window of its first attempt
+    invoice_run = get_invoice_run(run_id)
+    if invoice_run:
+        start_time, end_time = invoice_run.start_time, invoice_run.end_time
+    else:
+        start_time, end_time = get_invoice_period(from_date, to_date)
+    if end_time < start_time:
+        frappe.log_error( "Invalid end time (before start time)", "ZSW invalid end time" )
+        print("Invalid end time (before start time)")
+        return
+    # get bookings (fetched in time windows) and group them by customer
+    try:
+        booking_index = fetch_booking_index(start_time, end_time)
+    except Exception as err:
+        print("Fetching bookings failed: {0}".format(err))
+        booking_index = {}
+    if booking_index or invoice_run:
+        runs = [{
+            'tenant': tenant,
+            'kst_filter': kst_filter,
+            'service_filter': service_filter,
+            'ignore_pricing_rule': ignore_pricing_rule
+        }]
+        invoice_run = start_invoice_run(run_id, runs, start_time, end_time)
+        run = dict(runs[0], run_id=invoice_run.name, run_no=0, start_time=start_time, end_time=end_time)
+        invoice_bookings(run, booking_index, employees, cint(workers or config.invoice_workers or 1))
+    else:
+        print("No bookings found.")
+    return
+
+"""
+ Dry run of create_invoices: fetches and evaluates the bookings and returns the invoices that
+ would be created, without inserting documents, marking bookings or updating the last sync
+ Returns the invoices (customer, remarks, taxes_and_charges, items), the number of bookings on
+ them and the profile (timings [s] and number of queries per phase)
+"""
+def preview_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None, service_filter=None, ignore_pricing_rule=1):
+    profile = ZSWProfile()
+    profile.start()
+    try:
+        with profile.phase("soap_fetch"):
+            employees = get_employees(persist=False)
+        start_time, end_time = get_invoice_period(from_date, to_date)
+        booking_index = fetch_booking_index(start_time, end_time, profile)
+        run = {
+            'tenant': tenant,
+            'kst_filter': kst_filter,
+            'service_filter': service_filter,
+            'ignore_pricing_rule': ignore_pricing_rule,
+            'dry_run': True,
+            'preview': []
+        }
+        customers = [c for c in booking_index if c]
+        with profile.phase("pricing_lookups"):
+            context = get_invoice_context(customers, tenant)
+        booking_count = 0
+        with profile.phase("document_build"):
+            for customer in customers:
+                invoice_count, booking_ids, invoices = create_customer_invoices(customer, booking_index[customer], employees, run, context)
+                booking_count += len(booking_ids)
+    finally:
+        profile.stop()
+    return {
+        'invoices': run['preview'],
+        'customers': len(customers),
+        'bookings': booking_count,
+        'profile': profile.as_dict()
+    }
+
+"""
+ Multi-tenant invoice run: the bookings are fetched once and partitioned among the runs
+   runs: list of dicts (or JSON) with tenant, kst_filter, service_filter, ignore_pricing_rule
+ e.g. [{"tenant": "CH"}, {"tenant": "AT", "kst_filter": "..."}, {"tenant": "AT"}]
+
+ Each booking is assigned to the first run that matches (tenant range, cost center, service
+ type) as if the runs were started one after the other: list specific runs before general ones
+"""
+def create_invoices_multi(runs, from_date=None, to_date=None, workers=None, run_id=None):
+    if not isinstance(runs, list):
+        runs = json.loads(runs)
+    print("Reading config...")
+    config = frappe.get_doc("ZSW", "ZSW")
+    employees = get_employees()
+    print("Got {0} employees.".format(len(employees)))
+    # a resumed run uses the booking window of its first attempt
+    invoice_run = get_invoice_run(run_id)
+    if invoice_run:
+        start_time, end_time = invoice_run.start_time, invoice_run.end_time
+    else:
+        start_time, end_time = get_invoice_period(from_date, to_date)
+    if end_time < start_time:
+        frappe.log_error( "Invalid end time (before start time)", "ZSW invalid end time" )
+        print("Invalid end time (before start time)")
+        return
+    runs = [{
+        'tenant': r.get('tenant') or "AT",
+        'kst_filter': r.get('kst_filter'),
+        'service_filter': r.get('service_filter'),
+        'ignore_pricing_rule': r.get('ignore_pricing_rule', 1)
+    } for r in runs]
+    # get bookings once (fetched in time windows) and group them by customer
+    try:
+        booking_index = fetch_booking_index(start_time, end_time)
+    except Exception as err:
+        print("Fetching bookings failed: {0}".format(err))
+        booking_index = {}
+    if not booking_index and not invoice_run:
+        print("No bookings found.")
+        return
+    invoice_run = start_invoice_run(run_id, runs, start_time, end_time, multi_tenant=True)
+    runs = [dict(r, run_id=invoice_run.name, run_no=n, start_time=start_time, end_time=end_time) for n, r in enumerate(runs)]
+    # load the customer context once per tenant
+    contexts = {}
+    for run in runs:
+        if run['tenant'] not in contexts:
+            contexts[run['tenant']] = get_invoice_context([c for c in booking_index if c], run['tenant'])
+    partitions = partition_bookings(booking_index, runs, contexts)
+    for run, partition in zip(runs, partitions):
+        print("Run {0} (kst: {1}, service: {2}): {3} customers".format(
+            run['tenant'], run['kst_filter'], run['service_filter'], len(partition)))
+        invoice_bookings(run, partition, employees, cint(workers or config.invoice_workers or 1), contexts[run['tenant']])
+    return
+
+# assign the bookings of each customer to the first matching run, returns one booking index per run
+def partition_bookings(booking_index, runs, contexts):
+    partitions = [{} for run in runs]
+    for customer, bookings in booking_index.items():
+        if not customer:
+            continue
+        # runs this customer belongs to (tenant range and cost center)
+        candidates = []
+        for n, run in enumerate(runs):
+            erp_customer = get_erp_customer(customer, run['tenant'])
+            if not erp_customer:
+                continue
+            if run['kst_filter']:
+                customer_record = contexts[run['tenant']]['customers'].get(erp_customer)
+                if not customer_record or customer_record['kostenstelle'] != run['kst_filter']:
+                    continue
+            candidates.append(n)
+        for booking in bookings:
+            for n in candidates:
+                if runs[n]['service_filter'] and runs[n]['service_filter'] != booking.activity:
+                    continue
+                partitions[n].setdefault(customer, []).append(booking)
+                break
+    return partitions
+
+# invoice a booking index (ZSW customer: bookings) for a run, in parallel jobs if workers > 1
+def invoice_bookings(run, booking_index, employees, workers=1, context=None):
+    # skip customers completed by a previous attempt of this run
+    completed = set(e['customer'] for e in get_invoice_run_entries(run))
+    customers = [c for c in booking_index if c and c not in completed]
+    print("Has {0} customers with bookings ({1} completed before)".format(len(customers), len(completed)))
+    # (re)start: drop what an earlier attempt queued and allow finishing the run again
+    frappe.db.sql("""DELETE FROM `tabZSW Invoice Run Entry`
+        WHERE `invoice_run` = %(run_id)s AND `run_no` = %(run_no)s AND `status` = "Queued";""",
+        {'run_id': run['run_id'], 'run_no': run['run_no']})
+    frappe.db.commit()
+    frappe.cache().delete(get_invoice_run_key(run, "finished"))
+    workers = min(max(1, cint(workers)), len(customers))
+    if workers > 1:
+        # fan out: customers are split into chunks, each chunk is invoiced by its own job
+        enqueue_invoice_chunks(run, booking_index, customers, workers)
+        return
+    # load customers, warehouses and discounts of the run at once
+    if context is None:
+        context = get_invoice_context(customers, run['tenant'])
+    # loop through customers to create invoices
+    for customer in customers:
+        invoice_customer(run, customer, booking_index[customer], employees, context)
+    finish_invoice_run(run)
+    return
+
+# invoice one customer and record the result in the run journal
+def invoice_customer(run, customer, bookings, employees, context):
+    try:
+        invoice_count, booking_ids, invoices = create_customer_invoices(customer, bookings, employees, run, context)
+    except Exception as err:
+        frappe.log_error("Invoicing customer {0} failed: {1}".format(customer, err), "ZSW create_invoices")
+        add_invoice_run_entry(run, customer, "Failed", error="{0}".format(err))
+        return
+    if invoice_count or booking_ids:
+        add_invoice_run_entry(run, customer, "Completed", invoices, booking_ids, invoice_count)
+    return
+
+# invoicing period as timestamps
+def get_invoice_period(from_date, to_date):
     # get start time (at 0:00:00)
     if from_date:
         start_time = int((datetime.strptime(from_date, "%Y-%m-%d") - datetime(1970,1,1)).total_seconds())
@@ -701,302 +2531,551 @@ def create_invoices(tenant="AT", from_date=None, to_date=None, kst_filter=None,
     # shift times to find bookings (all booking pairs ar found on 0:00:00 on getBookingPairs
     start_time -= (2 * 60 * 60)
     end_time += (20 * 60 * 60)
-    if end_time < start_time:
-        frappe.log_error( "Invalid end time (before start time)", "ZSW invalid end time" )
-        print("Invalid end time (before start time)")
+    return start_time, end_time
+
+"""
+ Creates the invoices (remote support, onsite) of one customer (ZSW customer code) from its bookings
+
+ Returns the number of invoices created, the booking IDs to be marked as invoiced (bookings
+ on an invoice that could not be created are not returned) and the invoices
+"""
+def create_customer_invoices(customer, bookings, employees, run, context):
+    erp_customer = get_erp_customer(customer, run['tenant'])
+    if not erp_customer:
+        # customer outside tenant range, skip
+        print("Skip customer {0} (out of range)".format(customer))
+        return 0, [], []
+    # find customer record
+    customer_record = context['customers'].get(erp_customer)
+    if not customer_record:
+        # customer not found
+        frappe.log_error( "Customer {0} not found in ERPNext.".format(erp_customer), "ZSW customer not found" )
+        return 0, [], []
+    # prepare customer settings
+    kst = customer_record['kostenstelle']
+    # skip if filter_kst is set and not matching this customer
+    if run['kst_filter'] and kst != run['kst_filter']:
+        print("Customer {0} dropped by KST filter".format(customer))
+        return 0, [], []
+    # get default warehouse
+    warehouse = context['warehouses'].get(kst)
+    # find income account
+    if "FZCH" in kst:
+        income_account = u"3400 - Dienstleistungsertrag - FZCH"
+        tax_rule = "Schweiz normal (303) - FZCH"
+    else:
+        if customer_record['steuerregion'] == "EU":
+            income_account = u"4250 - Leistungserlöse EU-Ausland (in ZM) - FZAT"
+            tax_rule = "Verkaufssteuern Leistungen EU,DRL (021) - FZAT"
+        elif customer_record['steuerregion'] == "DRL":
+            income_account = u"4200 - Leistungserlöse Export - FZAT"
+            tax_rule = "Verkaufssteuern Leistungen EU,DRL (021) - FZAT"
+        else:
+            income_account = u"4220 - Leistungserlöse 20 % USt - FZAT"
+            tax_rule = "Verkaufssteuern Inland 20p (022) - FZAT"
+    # special conditions for phone support
+    discount = context['discounts'].get(erp_customer, 0)
+    # create lists to collect invoice items
+    items_remote = []
+    items_onsite = []
+    do_invoice_remote = False
+    collected = []          # (booking ID, on remote invoice, on onsite invoice)
+    # loop through the bookings of this customer
+    for booking in bookings:
+        service_type = booking.activity
+        invoice_type = booking.invoice_type
+        duration = booking.get_hours()
+        # hotfix to catch undefined person as observed in August 2019
+        person = employees.get(booking.person, "-")
+        description = "{0} {1}<br>{2}".format(
+            booking.date,
+            person,
+            booking.notice or "")
+        if booking.contact:
+            description += "<br>{0}".format(booking.contact)
+        # check for service type filter
+        if run['service_filter'] and run['service_filter'] != service_type:
+            print("Dropped {0} ({1}) by not matching service level filter".format(booking.booking_id, service_type))
+            continue
+        remote = False
+        onsite = False
+        if service_type == "T01":
+            if invoice_type in ["W", "N", "A"]:
+                # remote, free of charge
+                items_remote.append(get_item(
+                    item_code="3014",
+                    description=description,
+                    qty=duration,
+                    discount=100,
+                    kst=kst,
+                    income_account=income_account,
+                    warehouse=warehouse))
+                remote = True
+            elif invoice_type == "J":
+                # remote, normal
+                do_invoice_remote = True
+                items_remote.append(get_item(
+                    item_code="3014",
+                    description=description,
+                    qty=duration,
+                    discount=discount,
+                    kst=kst,
+                    income_account=income_account,
+                    warehouse=warehouse))
+                remote = True
+        elif service_type == "T03":
+            if invoice_type in ["V", "J"]:
+                # onsite, normal
+                items_onsite.append(get_item(
+                    item_code="3001",
+                    description=description,
+                    qty=duration,
+                    discount=0,
+                    kst=kst,
+                    income_account=income_account,
+                    warehouse=warehouse))
+                onsite = True
+            elif invoice_type == "N":
+                # onsite, free of charge
+                items_onsite.append(get_item(
+                    item_code="3001",
+                    description=description,
+                    qty=duration,
+                    discount=100,
+                    kst=kst,
+                    income_account=income_account,
+                    warehouse=warehouse))
+                onsite = True
+
+        # add material items
+        for item_code, qty in get_booking_materials(booking, kst):
+            items_onsite.append(get_short_item(
+                item_code=item_code,
+                qty=qty,
+                kst=kst,
+                income_account=income_account,
+                warehouse=warehouse))
+            onsite = True
+        # mark as collected
+        collected.append((booking.booking_id, remote, onsite))
+    # collected all items, create invoices
+    print("Customer {0} aggregated, {1} items remote, {2} items onsite.".format(customer, len(items_remote), len(items_onsite)))
+    if run.get('dry_run'):
+        # dry run: only collect the invoices that would be created
+        if do_invoice_remote and len(items_remote) > 0:
+            run['preview'].append(get_invoice_preview(erp_customer, "Telefonsupport", tax_rule, items_remote))
+        if len(items_onsite) > 0:
+            run['preview'].append(get_invoice_preview(erp_customer, "Dienstleistung vor Ort", tax_rule, items_onsite))
+        return 0, [booking_id for booking_id, remote, onsite in collected], []
+    invoice_count = 0
+    # invoice T01
+    remote_invoice = None
+    remote_created = True
+    if do_invoice_remote and len(items_remote) > 0:
+        remote_invoice = create_invoice(
+            customer = erp_customer,
+            items = items_remote,
+            overall_discount = 0,
+            remarks = "Telefonsupport",
+            taxes_and_charges = tax_rule,
+            from_licence = 0,
+            groups=None,
+            commission=None,
+            print_descriptions=1,
+            update_stock=1,
+            auto_submit=True,
+            ignore_pricing_rule=run['ignore_pricing_rule'])
+        remote_created = remote_invoice is not None
+        if remote_created:
+            invoice_count += 1
+    # invoice T03
+    onsite_invoice = None
+    onsite_created = True
+    if len(items_onsite) > 0:
+        onsite_invoice = create_invoice(
+            customer = erp_customer,
+            items = items_onsite,
+            overall_discount = 0,
+            remarks = "Dienstleistung vor Ort",
+            taxes_and_charges = tax_rule,
+            from_licence = 0,
+            groups=None,
+            commission=None,
+            print_descriptions=1,
+            update_stock=1,
+            auto_submit=False,
+            ignore_pricing_rule=run['ignore_pricing_rule'],
+            append=True)
+        onsite_created = onsite_invoice is not None
+        if onsite_created:
+            invoice_count += 1
+    booking_ids = [booking_id for booking_id, remote, onsite in collected
+        if (remote_created or not remote) and (onsite_created or not onsite)]
+    consumed = set(booking_ids)
+    invoices = [invoice for invoice in (remote_invoice, onsite_invoice) if invoice]
+    # record consumed bookings in the ledger (by the invoice they are on)
+    for invoice, bookings_on_invoice in ((remote_invoice, [b for b, remote, onsite in collected if remote]),
+            (onsite_invoice, [b for b, remote, onsite in collected if onsite and not remote]),
+            (None, [b for b, remote, onsite in collected if not remote and not onsite])):
+        record_invoiced_bookings([b for b in bookings_on_invoice if b in consumed],
+            "Sales Invoice" if invoice else None, invoice, erp_customer)
+    return invoice_count, booking_ids, invoices
+
+# invoice that a dry run would create
+def get_invoice_preview(customer, remarks, taxes_and_charges, items):
+    return {
+        'customer': customer,
+        'remarks': remarks,
+        'taxes_and_charges': taxes_and_charges,
+        'items': items
+    }
+
+# ERP customer key of a ZSW customer code (None if the customer is outside the tenant range)
+def get_erp_customer(customer, tenant):
+    if tenant.lower() == "zsw":
+        return customer
+    elif tenant.lower() != "at":
+        if tenant.lower() == "ch" and customer.lower().startswith("ch"):
+            # crop country digits
+            return "K-{0}".format(customer[2:])
+        return None
+    elif customer.lower().startswith("ch"):
+        return None
+    return "K-{0}".format(customer)
+
+"""
+ Loads the ERP information needed to invoice the customers (ZSW customer codes) of a run
+ with one query each:
+   customers: ERP customer: {kostenstelle, steuerregion}
+   warehouses: cost center: default warehouse
+   discounts: ERP customer: discount on remote support (3014) of the active pricing rule with the highest priority
+"""
+def get_invoice_context(customers, tenant, chunk_size=1000):
+    context = {'customers': {}, 'warehouses': {}, 'discounts': {}}
+    erp_customers = [c for c in (get_erp_customer(c, tenant) for c in customers or []) if c]
+    for i in range(0, len(erp_customers), chunk_size):
+        chunk = tuple(erp_customers[i:i+chunk_size])
+        for c in frappe.db.sql("""
+                SELECT `name`, `kostenstelle`, `steuerregion`
+                FROM `tabCustomer`
+                WHERE `name` IN %(customers)s;""",
+                {'customers': chunk}, as_dict=True):
+            context['customers'][c['name']] = c
+        for d in frappe.db.sql("""
+                SELECT `tabPricing Rule`.`customer`, `tabPricing Rule`.`discount_percentage`
+                FROM `tabPricing Rule Item Code`
+                LEFT JOIN `tabPricing Rule` ON `tabPricing Rule`.`name` = `tabPricing Rule Item Code`.`parent`
+                WHERE `tabPricing Rule Item Code`.`item_code` = %(item_code)s
+                  AND `tabPricing Rule`.`customer` IN %(customers)s
+                  AND `tabPricing Rule`.`disable` = 0
+                ORDER BY `tabPricing Rule`.`priority` DESC;""",
+                {'item_code': "3014", 'customers': chunk}, as_dict=True):
+            if d['customer'] not in context['discounts']:
+                context['discounts'][d['customer']] = d['discount_percentage']
+    cost_centers = tuple(set(c['kostenstelle'] for c in context['customers'].values() if c['kostenstelle']))
+    if cost_centers:
+        for w in frappe.db.sql("""
+                SELECT `name`, `default_warehouse`
+                FROM `tabCost Center`
+                WHERE `name` IN %(cost_centers)s;""",
+                {'cost_centers': cost_centers}, as_dict=True):
+            context['warehouses'][w['name']] = w['default_warehouse']
+    return context
+
+"""
+ Parallel invoice run: the customers are split into <workers> chunks (balanced by number of
+ bookings), each chunk is invoiced by a job on the long queue. The booking IDs of each customer
+ are queued in the run journal (entries with status Queued) and the bookings are read from the
+ booking store (use_booking_store) or handed over in redis, so that a job only gets the run and
+ its customers. The job finishing last (counter in redis) marks the collected bookings and writes
+ the summary; runs whose jobs died are finished by sweep_invoice_runs.
+"""
+def enqueue_invoice_chunks(run, booking_index, customers, workers):
+    chunks = [[] for w in range(0, workers)]
+    chunk_sizes = [0] * workers
+    for customer in sorted(customers, key=lambda c: len(booking_index[c]), reverse=True):
+        w = chunk_sizes.index(min(chunk_sizes))
+        chunks[w].append(customer)
+        chunk_sizes[w] += len(booking_index[customer])
+    if not use_booking_store():
+        # the bookings are not in the booking store
+        cache_run_bookings(run, {c: booking_index[c] for c in customers})
+    add_queued_run_entries(run, {c: [b.booking_id for b in booking_index[c]] for c in customers})
+    frappe.cache().delete(get_invoice_run_key(run))
+    for chunk_no, chunk in enumerate(chunks):
+        enqueue_zsw_job("finkzeit.finkzeit.zsw.create_invoices_chunk",
+            queue='long',
+            timeout=INVOICE_CHUNK_TIMEOUT,
+            run_id=run['run_id'],
+            run_no=run['run_no'],
+            chunk_no=chunk_no,
+            chunks=len(chunks),
+            customers=chunk)
+    print("Invoice run {0}/{1}: {2} jobs enqueued ({3} bookings per job)".format(run['run_id'], run['run_no'], len(chunks), chunk_sizes))
+    return
+
+def get_invoice_run_key(run, suffix="chunks"):
+    return "{0}|zsw_invoice_run|{1}|{2}|{3}".format(frappe.local.site, run['run_id'], run['run_no'], suffix)
+
+def create_invoices_chunk(run_id, run_no, chunk_no, chunks, customers):
+    run = get_invoice_sub_run(get_invoice_run(run_id), run_no)
+    try:
+        employees = get_employees()
+        queued = get_queued_bookings(run, customers)
+        context = get_invoice_context(list(queued.keys()), run['tenant'])
+        for customer, customer_bookings in queued.items():
+            invoice_customer(run, customer, customer_bookings, employees, context)
+    except Exception as err:
+        frappe.log_error("Invoice chunk {0} failed: {1}".format(chunk_no, err), "ZSW create_invoices")
+    # the last chunk joins the run
+    cache = frappe.cache()
+    done = cache.incr(get_invoice_run_key(run))
+    cache.expire(get_invoice_run_key(run), 24 * 60 * 60)
+    print("Invoice run {0}/{1}: chunk {2} done ({3} of {4})".format(run['run_id'], run['run_no'], chunk_no, done, chunks))
+    if done == chunks:
+        cache.delete(get_invoice_run_key(run))
+        finish_invoice_run(run)
+    return
+
+# the parameters of sub-run run_no of an invoice run (journal)
+def get_invoice_sub_run(invoice_run, run_no):
+    run_no = cint(run_no)
+    return dict(json.loads(invoice_run.runs)[run_no], run_id=invoice_run.name, run_no=run_no,
+        start_time=invoice_run.start_time, end_time=invoice_run.end_time)
+
+# queued booking IDs (customer: booking IDs) of the customers that have no result since they were queued
+def get_queued_customers(run, customers=None):
+    queued = {}
+    for entry in frappe.db.sql("""SELECT `queued`.`customer`, `queued`.`booking_ids`
+            FROM `tabZSW Invoice Run Entry` AS `queued`
+            WHERE `queued`.`invoice_run` = %(run_id)s AND `queued`.`run_no` = %(run_no)s
+              AND `queued`.`status` = "Queued" {conditions}
+              AND NOT EXISTS (SELECT `done`.`name` FROM `tabZSW Invoice Run Entry` AS `done`
+                WHERE `done`.`invoice_run` = `queued`.`invoice_run` AND `done`.`run_no` = `queued`.`run_no`
+                  AND `done`.`customer` = `queued`.`customer` AND `done`.`status` IN ("Completed", "Failed")
+                  AND `done`.`creation` >= `queued`.`creation`);""".format(
+                conditions="AND `queued`.`customer` IN %(customers)s" if customers is not None else ""),
+            {'run_id': run['run_id'], 'run_no': run['run_no'], 'customers': tuple(customers or []) or ("",)}, as_dict=True):
+        queued[entry['customer']] = decode_booking_ids(entry['booking_ids'])
+    return queued
+
+# queued bookings (ZSWBooking, handed over in redis or from the booking store) of customers that are not completed yet
+def get_queued_bookings(run, customers):
+    queued = get_queued_customers(run, customers)
+    bookings = get_cached_run_bookings(run, queued.keys())
+    missing = [c for c in queued if c not in bookings]
+    if missing:
+        bookings.update(group_bookings(get_stored_bookings_by_id([b for c in missing for b in queued[c]])))
+    for customer in [c for c in queued if queued[c] and not bookings.get(c)]:
+        # neither handed over nor stored (e.g. expired): resume the run to invoice them
+        add_invoice_run_entry(run, customer, "Failed", error="Queued bookings not found")
+        del queued[customer]
+    return {customer: bookings.get(customer, []) for customer in queued}
+
+# bookings of a fan-out run (customer: ZSWBooking list) in a redis hash, kept until the run is finished
+def cache_run_bookings(run, booking_index):
+    cache = frappe.cache()
+    name = get_run_bookings_cache_name(run)
+    cache.delete_key(name)
+    for customer, bookings in booking_index.items():
+        cache.hset(name, customer, bookings)
+    cache.expire(cache.make_key(name), RUN_BOOKINGS_CACHE_TTL)
+    return
+
+def get_cached_run_bookings(run, customers):
+    cache = frappe.cache()
+    name = get_run_bookings_cache_name(run)
+    bookings = {}
+    for customer in customers:
+        records = cache.hget(name, customer)
+        if records is not None:
+            bookings[customer] = records
+    return bookings
+
+def get_run_bookings_cache_name(run):
+    return "zsw_invoice_run|{0}|{1}|bookings".format(run['run_id'], run['run_no'])
+
+"""
+ Sweeper (scheduler, hourly): a fan-out run whose jobs died or timed out never reaches its join.
+ Sub-runs with queued customers and no journal activity for INVOICE_RUN_STALL_TIMEOUT are
+ finished: the customers left over are recorded as failed (resume the run to invoice them) and
+ the bookings of the completed customers are marked
+"""
+def sweep_invoice_runs():
+    try:
+        for stalled in frappe.db.sql("""SELECT `tabZSW Invoice Run Entry`.`invoice_run`, `tabZSW Invoice Run Entry`.`run_no`
+                FROM `tabZSW Invoice Run Entry`
+                JOIN `tabZSW Invoice Run` ON `tabZSW Invoice Run`.`name` = `tabZSW Invoice Run Entry`.`invoice_run`
+                WHERE `tabZSW Invoice Run`.`status` = "Running"
+                GROUP BY `tabZSW Invoice Run Entry`.`invoice_run`, `tabZSW Invoice Run Entry`.`run_no`
+                HAVING SUM(`tabZSW Invoice Run Entry`.`status` = "Queued") > 0
+                  AND MAX(`tabZSW Invoice Run Entry`.`modified`) < %(cutoff)s;""",
+                {'cutoff': now_datetime() - timedelta(seconds=INVOICE_RUN_STALL_TIMEOUT)}, as_dict=True):
+            run = get_invoice_sub_run(get_invoice_run(stalled['invoice_run']), stalled['run_no'])
+            print("Invoice run {0}/{1} stalled, finishing it".format(run['run_id'], run['run_no']))
+            for customer in get_queued_customers(run):
+                add_invoice_run_entry(run, customer, "Failed", error="Invoice job did not finish")
+            frappe.cache().delete(get_invoice_run_key(run))
+            finish_invoice_run(run)
+    finally:
+        # scheduler job: close the sessions used for marking
+        disconnect()
+    return
+
+# finished, mark the bookings of all completed customers (from the journal) as invoiced and write the summary
+def finish_invoice_run(run):
+    # the join and the sweeper can both finish a run: only the first one does
+    if not frappe.cache().set(get_invoice_run_key(run, "finished"), 1, nx=True, ex=7 * 24 * 60 * 60):
         return
-    # get bookings
-    bookings = get_bookings(start_time, end_time)
-    collected_bookings = []
     invoice_count = 0
-    if bookings:
-        print("Got {0} bookings.".format(len(bookings)))
-        # collect customers
-        customers = []
-        for booking in bookings:
-            for level in booking['levels']['WSLevelIdentification']:
-                if level['levelID'] == get_zsw_level("Customer"):
-                    customer = level['code']
-                    if customer not in customers:
-                        customers.append(customer)
-                        print("Found customer: ({0})".format(customer))
-        # loop through customers to create invoices
-        print("Has {0} customers with bookings".format(len(customers)))
-        for customer in customers:
-            erp_customer = customer
-            if tenant.lower() == "zsw":
-                erp_customer = erp_customer
-            elif tenant.lower() != "at":
-                if tenant.lower() == "ch" and erp_customer.lower().startswith("ch"):
-                    # crop country digits
-                    erp_customer = erp_customer[2:]
-                else:
-                    # customer outside tenant range, skip
-                    print("Skip customer {0} (out of range)".format(customer))
-                    continue
-            else:
-                if erp_customer.lower().startswith("ch"):
-                    # customer outside tenant range, skip
-                    print("Skip customer {0} (out of range)".format(customer))
-                    continue
-            # create ERP-type customer key
-            if tenant.lower() != "zsw":
-                erp_customer = "K-{0}".format(erp_customer)
-            # find customer record
-            try:
-                customer_record = frappe.get_doc("Customer", erp_customer)
-            except:
-                # customer not found
-                frappe.log_error( "Customer {0} not found in ERPNext.".format(erp_customer), "ZSW customer not found" )
-                continue
-            if customer_record:
-                # prepare customer settings
-                kst = customer_record.kostenstelle
-                # skip if filter_kst is set and not matching this customer
-                if kst_filter and kst != kst_filter:
-                    print("Customer {0} dropped by KST filter".format(customer))
-                    continue
-                # get default warehouse
-                warehouse = frappe.get_value('Cost Center', kst, 'default_warehouse')
-                # find income account
-                if "FZCH" in kst:
-                    income_account = u"3400 - Dienstleistungsertrag - FZCH"
-                    tax_rule = "Schweiz normal (303) - FZCH"
-                else:
-                    if customer_record.steuerregion == "EU":
-                        income_account = u"4250 - Leistungserlöse EU-Ausland (in ZM) - FZAT"
-                        tax_rule = "Verkaufssteuern Leistungen EU,DRL (021) - FZAT"
-                    elif customer_record.steuerregion == "DRL":
-                        income_account = u"4200 - Leistungserlöse Export - FZAT"
-                        tax_rule = "Verkaufssteuern Leistungen EU,DRL (021) - FZAT"
-                    else:
-                        income_account = u"4220 - Leistungserlöse 20 % USt - FZAT"
-                        tax_rule = "Verkaufssteuern Inland 20p (022) - FZAT"
-                # find special conditions for phone support
-                discount = 0
-                sql_query = """SELECT `tabPricing Rule`.`discount_percentage` 
-                    FROM `tabPricing Rule Item Code`
-                    LEFT JOIN `tabPricing Rule` ON `tabPricing Rule`.`name` = `tabPricing Rule Item Code`.`parent`
-                    WHERE `tabPricing Rule Item Code`.`item_code` = "{item_code}"
-                      AND `tabPricing Rule`.`customer` = "{customer}"
-                      AND `tabPricing Rule`.`disable` = 0
-                    ORDER BY `tabPricing Rule`.`priority` DESC;""".format(item_code="3014", customer=customer_record.name)
-                discount_match = frappe.db.sql(sql_query, as_dict=True)
-                if discount_match and len(discount_match) > 0:
-                    discount = discount_match[0]['discount_percentage']
-                # create lists to collect invoice items
-                items_remote = []
-                items_onsite = []
-                do_invoice_remote = False
-                # loop through all bookings
-                for booking in bookings:
-                    use_booking = False
-                    override_duration = False
-                    try:
-                        for level in booking['levels']['WSLevelIdentification']:
-                            if level['levelID'] == get_zsw_level("Customer") and level['code'] == customer:
-                                use_booking = True
-                            if level['levelID'] == get_zsw_level("Item (Activity)"):
-                                # service type, e.g. "T01" (remote), "T03" (onsite), "T02" (project remote), "T04" (project onsite)
-                                service_type = level['code']
-                            if level['levelID'] == get_zsw_level("Invoicing Type"):
-                                # invoicing_type, e.g. "J": invoice, "N"/"W": free of charge, "P": flat rate
-                                invoice_type = level['code']
-                            if level['levelID'] == get_zsw_level("Sales Order"):
-                                # link to project (ZSW) sales order (ERP), e.g. "AB-00001" or "CHAB-00000"
-                                sales_order_reference = level['code']
-                    except Exception as err:
-                        print("...no levels... ({0})".format(err))
-                    if use_booking:
-                        # collect properties
-                        item_code = []
-                        qty = []
-                        customer_contact = None
-                        #print("Booking: {0}".format(booking))
-                        try:
-                        #if True:
-                            try:
-                                print("Properties: {0}".format(len(booking['properties']['WSProperty'])))
-                            except:
-                                print("No properties")
-                            #print("Property details: {0}".format(booking['properties']))
-                            for p in booking['properties']['WSProperty']:
-                                print("Reading properties...")
-                                if p['key'] == 2:
-                                    customer_contact = p['val']
-                                elif p['key'] == 14:
-                                    content = p['val']
-                                    # "qty level/item_code"
-                                    _item = content.split("/")[1]
-                                    item_code.append(_item)
-                                    qty.append(float(content.split(" ")[0]))
-                                elif p['key'] == 11:
-                                    qty.append(1.0)
-                                    if p['val'] == "6/0":
-                                        item_code.append("3048")
-                                    elif p['val'] == "6/1":
-                                        item_code.append("3031")
-                                    elif p['val'] == "6/2":
-                                        item_code.append("3032")
-                                    elif p['val'] == "6/3":
-                                        item_code.append("3033")
-                                    elif p['val'] == "6/4":
-                                        item_code.append("3036")
-                                elif p['key'] == 12:
-                                    item_code.append("3026")
-                                    qty.append((round(float(p['val']) / 60.0) + 0.04, 1)) # in h
-                                elif p['key'] == 13:
-                                    qty.append(float(p['val']))
-                                    if "FZT" in kst:
-                                        item_code.append("3008")
-                                    else:
-                                        item_code.append("3007")
-                                elif p['key'] == 15:
-                                    override_duration = True
-                                    # field is stored as 01:30 (hh:mm)
-                                    print("Fetching custom duration...")
-                                    duration_fields = "{0}".format(p['val']).split(":")
-                                    duration = (float(duration_fields[0])) + (float(duration_fields[1]) / 60)
-                                    duration = round(duration, 2)
-                                    print("Duration override: {0}".format(duration))
-                        except Exception as err:
-                            print("...no properties... ({0})".format(err))
-                        # add item to list
-                        booking_id = booking['fromBookingID']
-                        if not override_duration:
-                            duration = round((float(booking['duration']) / 60.0) + 0.04, 1) # in h
-                        try: # hotfix to catch undefined person as observed in August 2019
-                            person = employees[booking['person']]
-                        except:
-                            person = "-"
-                        description = "{0} {1}<br>{2}".format(
-                            booking['from']['timestamp'].split(" ")[0],
-                            person,
-                            booking['notice'] or "")
-                        if customer_contact:
-                            description += "<br>{0}".format(customer_contact)
-                        # check for service type filter
-                        if service_filter and service_filter != service_type:
-                            print("Dropped {0} ({1}) by not matching service level filter".format(booking_id, service_type))
-                            continue
-                        if service_type == "T01":
-                            if invoice_type in ["W", "N", "A"]:
-                                # remote, free of charge
-                                items_remote.append(get_item(
-                                    item_code="3014",
-                                    description=description,
-                                    qty=duration,
-                                    discount=100,
-                                    kst=kst,
-                                    income_account=income_account,
-                                    warehouse=warehouse))
-                            elif invoice_type == "J":
-                                # remote, normal
-                                do_invoice_remote = True
-                                items_remote.append(get_item(
-                                    item_code="3014",
-                                    description=description,
-                                    qty=duration,
-                                    discount=discount,
-                                    kst=kst,
-                                    income_account=income_account,
-                                    warehouse=warehouse))
-                        elif service_type == "T03":
-                            if invoice_type in ["V", "J"]:
-                                # onsite, normal
-                                items_onsite.append(get_item(
-                                    item_code="3001",
-                                    description=description,
-                                    qty=duration,
-                                    discount=0,
-                                    kst=kst,
-                                    income_account=income_account,
-                                    warehouse=warehouse))
-                            elif invoice_type == "N":
-                                # onsite, free of charge
-                                items_onsite.append(get_item(
-                                    item_code="3001",
-                                    description=description,
-                                    qty=duration,
-                                    discount=100,
-                                    kst=kst,
-                                    income_account=income_account,
-                                    warehouse=warehouse))
-
-                        # add material items
-                        if (len(item_code) > 0) and (len(item_code) == len(qty)):
-                            for i in range(0, len(item_code)):
-                                items_onsite.append(get_short_item(
-                                    item_code=item_code[i],
-                                    qty=qty[i],
-                                    kst=kst,
-                                    income_account=income_account,
-                                    warehouse=warehouse))
-                        else:
-                            print("No invoicable items ({0}, {1}).".format(item_code, qty))
-                        # mark as collected
-                        collected_bookings.append(booking_id)
-                # collected all items, create invoices
-                print("Customer {0} aggregated, {1} items remote, {2} items onsite.".format(customer, len(items_remote), len(items_onsite)))
-                # invoice T01
-                if do_invoice_remote and len(items_remote) > 0:
-                    create_invoice(
-                        customer = customer_record.name,
-                        items = items_remote,
-                        overall_discount = 0,
-                        remarks = "Telefonsupport",
-                        taxes_and_charges = tax_rule,
-                        from_licence = 0,
-                        groups=None,
-                        commission=None,
-                        print_descriptions=1,
-                        update_stock=1,
-                        auto_submit=True,
-                        ignore_pricing_rule=ignore_pricing_rule)
-                    invoice_count += 1
-                # invoice T03
-                if len(items_onsite) > 0:
-                    create_invoice(
-                        customer = customer_record.name,
-                        items = items_onsite,
-                        overall_discount = 0,
-                        remarks = "Dienstleistung vor Ort",
-                        taxes_and_charges = tax_rule,
-                        from_licence = 0,
-                        groups=None,
-                        commission=None,
-                        print_descriptions=1,
-                        update_stock=1,
-                        auto_submit=False,
-                        ignore_pricing_rule=ignore_pricing_rule,
-                        append=True)
-                    invoice_count += 1
-            else:
-                err = "Customer not found in ERP: {0}".format(erp_customer)
-                print(err)
-                frappe.log_error(err, "ZSW customer not found")
-        # finished, mark bookings as invoices
-        mark_bookings(collected_bookings)
-        # update last status
-        config = frappe.get_doc("ZSW", "ZSW")
-        try:
-            config.last_status = "{0} {1} invoices created".format(
-                datetime.now(), invoice_count)
-            config.save()
-            add_comment(text="{0} invoices created".format(invoice_count), from_time=start_time, to_time=end_time, kst=kst_filter, service_filter=service_filter)
-        except Exception as err:
-            frappe.log_error( "Unable to set status. ({0})".format(err), "ZSW create_invoices")
+    collected_bookings = []
+    for entry in get_invoice_run_entries(run):
+        invoice_count += cint(entry['invoice_count'])
+        collected_bookings += decode_booking_ids(entry['booking_ids'])
+    mark_bookings(collected_bookings)
+    # the queued bookings have been consumed
+    frappe.db.sql("""DELETE FROM `tabZSW Invoice Run Entry`
+        WHERE `invoice_run` = %(run_id)s AND `run_no` = %(run_no)s AND `status` = "Queued";""",
+        {'run_id': run['run_id'], 'run_no': run['run_no']})
+    frappe.cache().delete_key(get_run_bookings_cache_name(run))
+    complete_invoice_run(run, invoice_count)
+    # update last status
+    config = frappe.get_doc("ZSW", "ZSW")
+    try:
+        config.last_status = "{0} {1} invoices created".format(
+            datetime.now(), invoice_count)
+        config.save()
+        add_comment(text="{0} invoices created".format(invoice_count), from_time=run['start_time'], to_time=run['end_time'],
+            kst=run['kst_filter'], service_filter=run['service_filter'])
+    except Exception as err:
+        frappe.log_error( "Unable to set status. ({0})".format(err), "ZSW create_invoices")
+    return
+
+"""
+ Invoice run journal: each run (ZSW Invoice Run) records the result per customer (ZSW Invoice
+ Run Entry). Rerunning a run ID (resume_invoice_run) reuses the booking window of the run,
+ skips the completed customers and marks the bookings of all completed customers at the end.
+"""
+def get_invoice_run(run_id):
+    if run_id and frappe.db.exists("ZSW Invoice Run", run_id):
+        return frappe.get_doc("ZSW Invoice Run", run_id)
+    return None
+
+# create the journal of a run or reopen it for a rerun
+def start_invoice_run(run_id, runs, start_time, end_time, multi_tenant=False):
+    invoice_run = get_invoice_run(run_id)
+    if invoice_run:
+        print("Resuming invoice run {0}".format(invoice_run.name))
+        invoice_run.status = "Running"
+        invoice_run.finished_runs = 0
+        invoice_run.invoice_count = 0
+        invoice_run.save(ignore_permissions=True)
     else:
-        print("No bookings found.")
+        invoice_run = frappe.get_doc({
+            'doctype': "ZSW Invoice Run",
+            'status': "Running",
+            'multi_tenant': 1 if multi_tenant else 0,
+            'runs': json.dumps(runs, indent=1),
+            'start_time': start_time,
+            'end_time': end_time,
+            'run_count': len(runs),
+            'finished_runs': 0,
+            'started_on': now()
+        })
+        invoice_run.flags.run_id = run_id
+        invoice_run.insert(ignore_permissions=True)
+        print("Invoice run {0} started".format(invoice_run.name))
+    frappe.db.commit()
+    return invoice_run
+
+def add_invoice_run_entry(run, customer, status, invoices=None, booking_ids=None, invoice_count=0, error=None):
+    frappe.get_doc({
+        'doctype': "ZSW Invoice Run Entry",
+        'invoice_run': run['run_id'],
+        'run_no': run['run_no'],
+        'customer': customer,
+        'status': status,
+        'documents': ", ".join(invoices or []),
+        'booking_ids': json.dumps(booking_ids or []),
+        'invoice_count': invoice_count,
+        'error': error
+    }).insert(ignore_permissions=True)
+    frappe.db.commit()
+
+# queue the customers of a fan-out run (customer: booking IDs) with one insert per chunk
+def add_queued_run_entries(run, queued, chunk_size=500):
+    timestamp = now()
+    user = frappe.session.user
+    rows = list(queued.items())
+    for i in range(0, len(rows), chunk_size):
+        values = []
+        for customer, booking_ids in rows[i:i+chunk_size]:
+            values += [frappe.generate_hash(length=10), run['run_id'], run['run_no'], customer, "Queued",
+                json.dumps(booking_ids), timestamp, timestamp, user, user]
+        frappe.db.sql("""INSERT INTO `tabZSW Invoice Run Entry`
+                (`name`, `invoice_run`, `run_no`, `customer`, `status`, `booking_ids`, `creation`, `modified`, `owner`, `modified_by`)
+            VALUES {0}""".format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * int(len(values) / 10))),
+            tuple(values))
+    frappe.db.commit()
+
+def get_invoice_run_entries(run, status="Completed"):
+    return frappe.db.sql("""SELECT `customer`, `invoice_count`, `booking_ids`
+        FROM `tabZSW Invoice Run Entry`
+        WHERE `invoice_run` = %(run_id)s AND `run_no` = %(run_no)s AND `status` = %(status)s;""",
+        {'run_id': run['run_id'], 'run_no': run['run_no'], 'status': status}, as_dict=True)
+
+# count a finished (sub-)run, the run is completed when all its sub-runs finished
+def complete_invoice_run(run, invoice_count):
+    frappe.db.sql("""UPDATE `tabZSW Invoice Run`
+        SET `finished_runs` = `finished_runs` + 1, `invoice_count` = `invoice_count` + %(invoice_count)s
+        WHERE `name` = %(run_id)s;""", {'run_id': run['run_id'], 'invoice_count': invoice_count})
+    frappe.db.sql("""UPDATE `tabZSW Invoice Run`
+        SET `status` = "Completed", `completed_on` = %(now)s
+        WHERE `name` = %(run_id)s AND `finished_runs` >= `run_count`;""", {'run_id': run['run_id'], 'now': now()})
+    frappe.db.commit()
+
+# rerun an interrupted invoice run with its original parameters
+def resume_invoice_run(run_id, workers=None):
+    invoice_run = frappe.get_doc("ZSW Invoice Run", run_id)
+    runs = json.loads(invoice_run.runs)
+    if invoice_run.multi_tenant:
+        create_invoices_multi(runs, workers=workers, run_id=invoice_run.name)
+    else:
+        create_invoices(workers=workers, run_id=invoice_run.name, **runs[0])
+    return
+
+@frappe.whitelist()
+def enqueue_resume_invoice_run(run_id, workers=None):
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.resume_invoice_run",
+        queue='long',
+        timeout=15000,
+        run_id=run_id,
+        workers=workers)
     return
 
 # this function is used to create sales invoices from bookings
 @frappe.whitelist()
-def create_generic_invoices(from_date=None, to_date=None, with_time=False):
+def create_generic_invoices(from_date=None, to_date=None, with_time=False, dry_run=False):
+    # dry run: evaluate the bookings and return the invoices that would be created (with profile)
+    if not cint(dry_run):
+        return invoice_generic_bookings(from_date, to_date, with_time)
+    profile = ZSWProfile()
+    profile.start()
+    try:
+        result = invoice_generic_bookings(from_date, to_date, with_time, profile)
+    finally:
+        profile.stop()
+    result['profile'] = profile.as_dict()
+    return result
+
+# generic invoices of a period; with a profile (dry run) nothing is written, the invoices that would be created are returned
+def invoice_generic_bookings(from_date=None, to_date=None, with_time=False, profile=None):
+    dry_run = profile is not None
     # get start timestamp
     print("Reading config...")
     config = frappe.get_doc("ZSW", "ZSW")
-    employees = get_employees()
+    with profile_phase(profile, "soap_fetch"):
+        employees = get_employees(persist=not dry_run)
     print("Got {0} employees.".format(len(employees)))
     # get start time (at 0:00:00)
     if from_date:
@@ -1016,124 +3095,37 @@ def create_generic_invoices(from_date=None, to_date=None, with_time=False):
         tmp_time = end_time
         end_time = start_time
         start_time = tmp_time
-    # get bookings
-    bookings = get_bookings(start_time, end_time)
+    # get bookings (fetched in time windows) and group them by customer
+    try:
+        booking_index = fetch_booking_index(start_time, end_time, profile)
+    except Exception as err:
+        print("Fetching bookings failed: {0}".format(err))
+        booking_index = {}
     collected_bookings = []
     invoice_count = 0
-    if bookings:
-        print("Got {0} bookings.".format(len(bookings)))
-        # collect customers
-        customers = []
-        for booking in bookings:
-            try:
-                for level in booking['levels']['WSLevelIdentification']:
-                    if level['levelID'] == get_zsw_level("Customer"):
-                        customer = level['code']
-                        if customer not in customers:
-                            customers.append(customer)
-                            print("Found customer: ({0})".format(customer))
-            except:
-                print("No WSLevelIndentification found")
+    preview = []
+    if booking_index:
+        customers = [c for c in booking_index if c]
         # loop through customers to create invoices
         print("Has {0} customers with bookings".format(len(customers)))
         for customer in customers:
             # find customer record
             try:
-                customer_record = frappe.get_doc("Customer", customer)
+                with profile_phase(profile, "pricing_lookups"):
+                    customer_record = frappe.get_doc("Customer", customer)
             except:
                 # customer not found
                 frappe.log_error( "Customer {0} not found in ERPNext.".format(customer), "ZSW customer not found" )
                 continue
-            if customer_record:
-                # create lists to collect invoice items
-                items = []
-                # loop through all bookings
-                for booking in bookings:
-                    use_booking = False
-                    override_duration = False
-                    try:
-                        for level in booking['levels']['WSLevelIdentification']:
-                            if level['levelID'] == get_zsw_level("Customer") and level['code'] == customer:
-                                # customer link on level 1
-                                use_booking = True
-                            if level['levelID'] == get_zsw_level("Item (Activity)"):
-                                # activity
-                                activity = level['code']
-                            if level['levelID'] == get_zsw_level("Invoicing Type"):
-                                # invoicing_type, e.g. "J": invoice, "N"/"W": free of charge, "P": flat rate
-                                invoice_type = level['code']
-                    except Exception as err:
-                        #print("...no levels... ({0})".format(err))
-                        pass
-                    if use_booking:
-                        # collect properties
-                        item_code = []
-                        qty = []
-                        customer_contact = None
-                        #print("Booking: {0}".format(booking))
-                        try:
-                            print("Properties: {0}".format(len(booking['properties']['WSProperty'])))
-                            #print("Property details: {0}".format(booking['properties']))
-                            for p in booking['properties']['WSProperty']:
-                                print("Reading properties...")
-                                if p['key'] == 2:
-                                    customer_contact = p['val']
-                                elif p['key'] == 14:
-                                    content = p['val']
-                                    # "qty level/item_code"
-                                    _item = content.split("/")[1]
-                                    item_code.append(_item)
-                                    qty.append(float(content.split(" ")[0]))
-                                elif p['key'] == 15:
-                                    override_duration = True
-                                    # field is stored as 01:30 (hh:mm)
-                                    print("Fetching custom duration...")
-                                    duration_fields = "{0}".format(p['val']).split(":")
-                                    duration = (float(duration_fields[0])) + (float(duration_fields[1]) / 60)
-                                    duration = round(duration, 2)
-                                    print("Duration override: {0}".format(duration))
-                        except Exception as err:
-                            #print("...no properties... ({0})".format(err))
-                            pass
-                        # add item to list
-                        booking_id = booking['fromBookingID']
-                        if not override_duration:
-                            duration = round((float(booking['duration']) / 60.0) + 0.04, 1) # in h
-                        try: # hotfix to catch undefined person as observed in August 2019
-                            person = employees[booking['person']]
-                        except:
-                            person = "-"
-                        if with_time:
-                            description = "{d} {p} ({hh:02d}:{mm:02d})<br>{n}".format(
-                                d=booking['from']['timestamp'].split(" ")[0],
-                                p=person,
-                                n=booking['notice'] or "",
-                                hh=int(booking['from']['hour'] or 0),
-                                mm=int(booking['from']['min'] or 0))
-                        else:
-                            description = "{0} {1}<br>{2}".format(
-                                booking['from']['timestamp'].split(" ")[0],
-                                person,
-                                booking['notice'] or "")
-                        if customer_contact:
-                            description += "<br>{0}".format(customer_contact)
-                        # add item
-                        if duration > 0:
-                            items.append(get_generic_item(
-                                item_code=activity,
-                                description=description,
-                                qty=duration))
-
-                        # add material items
-                        if (len(item_code) > 0) and (len(item_code) == len(qty)):
-                            for i in range(0, len(item_code)):
-                                items.append(get_generic_item(
-                                    item_code=item_code[i],
-                                    qty=qty[i]))
-                        else:
-                            print("No invoicable items ({0}, {1}).".format(item_code, qty))
-                        # mark as collected
-                        collected_bookings.append(booking_id)
+            if customer_record and dry_run:
+                with profile.phase("document_build"):
+                    items, customer_bookings = get_generic_invoice_items(booking_index[customer], employees, with_time, create_items=False)
+                collected_bookings += customer_bookings
+                preview.append(get_invoice_preview(customer, None, None, items))
+            elif customer_record:
+                # collect invoice items
+                items, customer_bookings = get_generic_invoice_items(booking_index[customer], employees, with_time)
+                collected_bookings += customer_bookings
                 # collected all items, create invoices
                 print("Customer {0} aggregated, {1} items.".format(customer, len(items)))
                 # create invoice
@@ -1146,6 +3138,7 @@ def create_generic_invoices(from_date=None, to_date=None, with_time=False):
                     sinv = new_sales_invoice.insert()
                     print("Sales invoice {0} created for {1}.".format(sinv.name, customer))
                     frappe.db.commit()
+                    record_invoiced_bookings(customer_bookings, "Sales Invoice", sinv.name, customer)
                 except Exception as err:
                     print("Error inserting sales invoice: {0}".format(err))
                     frappe.log_error("Error inserting invoice: {0} (customer {1})".format(err, customer), "ZSW: Error inserting invoice")
@@ -1154,8 +3147,11 @@ def create_generic_invoices(from_date=None, to_date=None, with_time=False):
                 err = "Customer not found in ERP: {0}".format(erp_customer)
                 print(err)
                 frappe.log_error(err, "ZSW customer not found")
+        if dry_run:
+            return {'invoices': preview, 'bookings': len(collected_bookings)}
         # finished, mark bookings as invoices
         mark_bookings(collected_bookings)
+        frappe.db.commit()
         # update last status
         config = frappe.get_doc("ZSW", "ZSW")
         try:
@@ -1166,8 +3162,52 @@ def create_generic_invoices(from_date=None, to_date=None, with_time=False):
             frappe.log_error( "Unable to set status. ({0})".format(err), "ZSW create_invoices")
     else:
         print("No bookings found.")
+    if dry_run:
+        return {'invoices': [], 'bookings': 0}
     return
 
+# generic invoice items of the bookings of a customer, returns the items and the collected booking IDs
+# (create_items: create missing items, off for dry runs)
+def get_generic_invoice_items(bookings, employees, with_time=False, create_items=True):
+    items = []
+    customer_bookings = []
+    # loop through the bookings of this customer
+    for booking in bookings:
+        duration = booking.get_hours()
+        # hotfix to catch undefined person as observed in August 2019
+        person = employees.get(booking.person, "-")
+        if with_time:
+            description = "{d} {p} ({hh:02d}:{mm:02d})<br>{n}".format(
+                d=booking.date,
+                p=person,
+                n=booking.notice or "",
+                hh=booking.hour,
+                mm=booking.minute)
+        else:
+            description = "{0} {1}<br>{2}".format(
+                booking.date,
+                person,
+                booking.notice or "")
+        if booking.contact:
+            description += "<br>{0}".format(booking.contact)
+        # add item
+        if duration > 0:
+            items.append(get_generic_item(
+                item_code=booking.activity,
+                description=description,
+                qty=duration,
+                create=create_items))
+
+        # add material items
+        for item_code, qty in get_booking_materials(booking, generic=True):
+            items.append(get_generic_item(
+                item_code=item_code,
+                qty=qty,
+                create=create_items))
+        # mark as collected
+        customer_bookings.append(booking.booking_id)
+    return items, customer_bookings
+
 # parse to sales invoice item structure
 def get_item(item_code, description, qty, discount, kst, income_account, warehouse, against_sales_order=None, date="2000-01-01"):
     return {
@@ -1195,9 +3235,9 @@ def get_short_item(item_code, qty, kst, income_account, warehouse, against_sales
         'date': date
     }
 
-def get_generic_item(item_code, qty, description=None):
+def get_generic_item(item_code, qty, description=None, create=True):
     # check if the item exists in the ERP system
-    if not frappe.db.exists("Item", item_code):
+    if create and not frappe.db.exists("Item", item_code):
         # create item
         new_item = frappe.get_doc({
             'doctype': 'Item',
@@ -1226,7 +3266,7 @@ def set_last_sync(date):
     date_str = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
     print("Timestamp: {0} / {1}".format(timestamp, date_str))
     # update end_time in ZSW record
-    global config
+    config = frappe.get_doc("ZSW", "ZSW")
     try:
         config.last_sync_sec = timestamp
         config.last_sync_date = date_str
@@ -1252,45 +3292,90 @@ def add_comment(text, from_time, to_time, kst, service_filter):
 
 # integarted test functions for integration tests
 def test_connect():
-    get_employees()
+    get_employees(reload=True)
     disconnect()
     return
 
 def test_customer():
-    s = getSession()
-    #wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': 1, 'code': "1234500" }] }
-    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': "21762" }] }
-    wsLevelEArray = client.service.getLevelsEByIdentification(session, wsLevelIdentArray, None)
-    contentStr = "{0}".format(wsLevelEArray[0])
-    contentDict = eval(contentStr)
-    contentDict.pop('genericProperties', None)
-    print("Level E: {0}".format(contentDict))
-    client.service.updateLevelsE(session, {'WSExtensibleLevel': [contentDict]})
-    disconnect()
+    with zsw_session() as s:
+        #wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': 1, 'code': "1234500" }] }
+        wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': "21762" }] }
+        wsLevelEArray = get_client().service.getLevelsEByIdentification(s, wsLevelIdentArray, None)
+        contentDict = compress_level_e(wsLevelEArray[0])
+        print("Level E: {0}".format(contentDict))
+        get_client().service.updateLevelsE(s, {'WSExtensibleLevel': [contentDict]})
 
 @frappe.whitelist()
-def deliver_sales_order(sales_order, tenant="AT"):
+def deliver_sales_order(sales_order, tenant="AT", dry_run=False):
+    # dry run: evaluate the bookings and return the delivery note items (with profile)
+    if not cint(dry_run):
+        return deliver_project(sales_order, tenant)
+    profile = ZSWProfile()
+    profile.start()
+    try:
+        result = deliver_project(sales_order, tenant, profile)
+    finally:
+        profile.stop()
+    result['profile'] = profile.as_dict()
+    return result
+
+# delivery of one project sales order; with a profile (dry run) nothing is written, the delivery note items are returned
+def deliver_project(sales_order, tenant="AT", profile=None):
+    dry_run = profile is not None
     # zsw project name
     zsw_project_name = get_zsw_project_name(sales_order, tenant)
     # get start timestamp
     print("Reading config...")
     config = frappe.get_doc("ZSW", "ZSW")
-    employees = get_employees()
+    with profile_phase(profile, "soap_fetch"):
+        employees = get_employees(persist=not dry_run)
     print("Got {0} employees.".format(len(employees)))
     sales_order_object = frappe.get_doc("Sales Order", sales_order)
-    customer_record = frappe.get_doc("Customer", sales_order_object.customer)
     start_time = sales_order_object.last_zsw_get_dn_timestamp
     end_time = int(time())
 
     # get bookings
-    bookings = get_project_bookings(zsw_project=zsw_project_name, from_time=start_time, to_time=end_time)
+    bookings = get_project_bookings(zsw_project=zsw_project_name, from_time=start_time, to_time=end_time, profile=profile,
+        persist=not dry_run)
+    result = deliver_project_bookings(sales_order_object, bookings, employees, end_time, profile)
+    if dry_run:
+        return {
+            'delivery_note': None,
+            'items': result['items'],
+            'taxes_and_charges': result.get('taxes_and_charges'),
+            'bookings': len(result['booking_ids'])
+        }
+    # finished, mark bookings as invoices
+    if result['booking_ids']:
+        mark_bookings(result['booking_ids'])
+        frappe.db.commit()
+    return {'delivery_note': result['delivery_note']}
+
+"""
+ Creates the delivery note of a project sales order from its bookings (ZSWBooking) and moves the
+ delivery timestamp of the order to end_time; bookings in the ledger are skipped, the bookings
+ are not marked (see mark_bookings)
+
+ Returns the delivery note and the collected booking IDs (none if the delivery note could not be
+ created, the order is then not updated). With a profile (dry run) the items are returned instead
+ of creating the delivery note and the order is not updated
+"""
+def deliver_project_bookings(sales_order_object, bookings, employees, end_time, profile=None):
+    sales_order = sales_order_object.name
+    if bookings:
+        with profile_phase(profile, "grouping"):
+            invoiced = get_invoiced_bookings([b.booking_id for b in bookings])
+            bookings = [b for b in bookings if b.booking_id not in invoiced]
     collected_bookings = []
+    new_dn = None
     if bookings:
         print("Got {0} bookings.".format(len(bookings)))
         items = []
         # get default warehouse
         kst = sales_order_object.kostenstelle
-        warehouse = frappe.get_value('Cost Center', kst, 'default_warehouse')
+        with profile_phase(profile, "pricing_lookups"):
+            customer_record = frappe.get_doc("Customer", sales_order_object.customer)
+            warehouse = frappe.get_value('Cost Center', kst, 'default_warehouse')
         # find income account
         if "FZCH" in kst:
             income_account = u"3400 - Dienstleistungsertrag - FZCH"
@@ -1305,92 +3390,22 @@ def deliver_sales_order(sales_order, tenant="AT"):
             else:
                 income_account = u"4220 - Leistungserlöse 20 % USt - FZAT"
                 tax_rule = "Verkaufssteuern Inland 20p (022) - FZAT"
-        # loop through all bookings
-        for booking in bookings:
-            use_booking = False
-            override_duration = False
-            # collect WS levels
-            try:
-                for level in booking['levels']['WSLevelIdentification']:
-                    if level['levelID'] == get_zsw_level("Customer"):
-                        use_booking = True
-                        customer_zsw_code = level['code']
-                    if level['levelID'] == get_zsw_level("Item (Activity)"):
-                        # service type, e.g. "T02" (project remote), "T04" (project onsite)
-                        service_type = level['code']
-                    if level['levelID'] == get_zsw_level("Invoicing Type"):
-                        # invoicing_type, e.g. "J": invoice, "N": free of charge, "P": flat rate
-                        invoice_type = level['code']
-                    if level['levelID'] == get_zsw_level("Sales Order"):
-                        # link to project (ZSW) sales order (ERP), e.g. "AB-00001" or "CHAB-00000"
-                        sales_order_reference = level['code']
-            except Exception as err:
-                print("...no levels... ({0})".format(err))
-            if use_booking:
-                # collect properties
-                item_code = []
-                qty = []
-                customer_contact = None
-                try:
-                #if True:
-                    try:
-                        print("Properties: {0}".format(len(booking['properties']['WSProperty'])))
-                    except:
-                        print("No properties")
-                    for p in booking['properties']['WSProperty']:
-                        print("Reading properties...")
-                        if p['key'] == 2:
-                            customer_contact = p['val']
-                        elif p['key'] == 14:
-                            content = p['val']
-                            # "qty level/item_code"
-                            _item = content.split("/")[1]
-                            item_code.append(_item)
-                            qty.append(float(content.split(" ")[0]))
-                            print("Found {0} x {1}".format(float(content.split(" ")[0]), _item))
-                        elif p['key'] == 11:
-                            qty.append(1.0)
-                            if p['val'] == "6/0":
-                                item_code.append("3048")
-                            elif p['val'] == "6/1":
-                                item_code.append("3031")
-                            elif p['val'] == "6/2":
-                                item_code.append("3032")
-                            elif p['val'] == "6/3":
-                                item_code.append("3033")
-                            elif p['val'] == "6/4":
-                                item_code.append("3036")
-                        elif p['key'] == 12:
-                            item_code.append("3026")
-                            qty.append((round(float(p['val']) / 60.0) + 0.04, 1)) # in h
-                        elif p['key'] == 13:
-                            qty.append(float(p['val']))
-                            if "FZT" in kst:
-                                item_code.append("3008")
-                            else:
-                                item_code.append("3007")
-                        elif p['key'] == 15:
-                            override_duration = True
-                            # field is stored as 01:30 (hh:mm)
-                            print("Fetching custom duration...")
-                            duration_fields = "{0}".format(p['val']).split(":")
-                            duration = (float(duration_fields[0])) + (float(duration_fields[1]) / 60)
-                            duration = round(duration, 2)
-                            print("Duration override: {0}".format(duration))
-                except Exception as err:
-                    print("...no properties... ({0})".format(err))
-                # add item to list
-                booking_id = booking['fromBookingID']
-                date = datetime.strptime(booking['from']['timestamp'].split(" ")[0], "%d.%m.%Y")
-                if not override_duration:
-                    duration = round((float(booking['duration']) / 60.0) + 0.04, 1) # in h
+        with profile_phase(profile, "document_build"):
+            # loop through all bookings with a customer link
+            for booking in bookings:
+                if not booking.customer:
+                    continue
+                service_type = booking.activity
+                invoice_type = booking.invoice_type
+                date = datetime.strptime(booking.date, "%d.%m.%Y")
+                duration = booking.get_hours()
                 description = "{0} {1} ({3})<br>{2}".format(
-                    booking['from']['timestamp'].split(" ")[0],
-                    employees[booking['person']],
-                    booking['notice'] or "",
+                    booking.date,
+                    employees.get(booking.person, "-"),
+                    booking.notice or "",
                     service_type)
-                if customer_contact:
-                    description += "<br>{0}".format(customer_contact)
+                if booking.contact:
+                    description += "<br>{0}".format(booking.contact)
                 if invoice_type in ["W", "N", "P"] and duration > 0:
                     # remote, free of charge
                     items.append(get_item(
@@ -1405,7 +3420,6 @@ def deliver_sales_order(sales_order, tenant="AT"):
                         date=date))
                 elif invoice_type == "J" and duration > 0:
                     # remote, normal
-                    do_invoice_remote = True
                     items.append(get_item(
                         item_code="3001",
                         description=description,
@@ -1420,24 +3434,28 @@ def deliver_sales_order(sales_order, tenant="AT"):
                     print("skipping {0} for qty = 0 or unkown invoice type".format(description[:10]))
 
                 # add material items
-                if (len(item_code) > 0) and (len(item_code) == len(qty)):
-                    for i in range(0, len(item_code)):
-                        items.append(get_item(
-                            item_code=item_code[i],
-                            description= "{0}".format(booking['from']['timestamp'].split(" ")[0]),
-                            qty=qty[i],
-                            discount=0,
-                            kst=kst,
-                            income_account=income_account,
-                            warehouse=warehouse,
-                            against_sales_order=sales_order,
-                            date=date))
-                else:
-                    print("No invoicable items ({0}, {1}).".format(item_code, qty))
+                for item_code, qty in get_booking_materials(booking, kst):
+                    items.append(get_item(
+                        item_code=item_code,
+                        description= "{0}".format(booking.date),
+                        qty=qty,
+                        discount=0,
+                        kst=kst,
+                        income_account=income_account,
+                        warehouse=warehouse,
+                        against_sales_order=sales_order,
+                        date=date))
                 # mark as collected
-                collected_bookings.append(booking_id)
+                collected_bookings.append(booking.booking_id)
         # collected all items, create invoices
         print("Processed all bookings, found {0} items.".format(len(items)))
+        if profile:
+            return {
+                'delivery_note': None,
+                'booking_ids': collected_bookings,
+                'items': sorted(items, key=lambda val: val['date']),
+                'taxes_and_charges': tax_rule
+            }
         # create delivery note with items sorted by date
         if len(items) > 0:
             new_dn = create_delivery_note(sales_order_object.customer, # customer 
@@ -1448,20 +3466,125 @@ def deliver_sales_order(sales_order, tenant="AT"):
                 groups=None, 
                 auto_submit=False, 
                 append=False)
+            if not new_dn:
+                # delivery note failed: keep the bookings unmarked and the delivery timestamp, so
+                #  that the next run collects them again
+                return {'delivery_note': None, 'booking_ids': []}
+            record_invoiced_bookings(collected_bookings, "Delivery Note", new_dn, sales_order_object.customer)
 
-        # finished, mark bookings as invoices
-        mark_bookings(collected_bookings)
         # update last status
         sales_order_object.last_zsw_get_dn_timestamp = end_time
         try:
             sales_order_object.save()
         except Exception as err:
             frappe.log_error( "Unable to update sync time. ({0}, {1})".format(sales_order, err), "ZSW create_invoices")
-        return {'delivery_note': new_dn}
+        return {'delivery_note': new_dn, 'booking_ids': collected_bookings}
     else:
         print("No bookings found.")
-        return {'delivery_note': None}
-        
+        return {'delivery_note': None, 'booking_ids': [], 'items': []}
+
+@frappe.whitelist()
+def enqueue_deliver_sales_orders(tenant="AT"):
+    # enqueue batch delivery of all open projects (potential high workload)
+    kwargs={
+        'tenant': tenant
+    }
+
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.deliver_sales_orders",
+        queue='long',
+        timeout=15000,
+        **kwargs)
+    return
+
+"""
+ Batch delivery of all open project sales orders (or of the given sales orders): the bookings
+ are fetched once in time windows (getBookingPairs) from the oldest delivery timestamp, at most
+ PROJECT_FETCH_MAX_WINDOW back, grouped by project (Sales Order level) in one pass and delivered
+ per order. Orders with an older delivery timestamp are fetched on their own by project level.
+
+ Each order only gets the bookings after its own delivery timestamp; orders that have not been
+ delivered yet start one day before their creation (the project level is created on submit)
+"""
+def deliver_sales_orders(tenant="AT", sales_orders=None):
+    print("Reading config...")
+    orders = get_open_project_orders(tenant, sales_orders)
+    if not orders:
+        print("No open projects.")
+        return {'delivery_notes': [], 'orders': 0}
+    employees = get_employees()
+    print("Got {0} employees.".format(len(employees)))
+    end_time = int(time())
+    start_time = max(min(o['start_time'] for o in orders.values()), end_time - PROJECT_FETCH_MAX_WINDOW)
+    # orders delivered last before the shared fetch window
+    older = [p for p, o in orders.items() if o['start_time'] < start_time]
+    print("Delivering {0} projects from {1} ({2} fetched on their own)".format(
+        len(orders), datetime.fromtimestamp(start_time), len(older)))
+    # fetch bookings once and group them by project
+    project_bookings = {}
+    try:
+        for booking in read_bookings(start_time, end_time, update_sync=False):
+            order = orders.get(booking.sales_order)
+            if not order or order['start_time'] < start_time:
+                continue
+            if booking.time_in_seconds is not None and booking.time_in_seconds < order['start_time']:
+                # already covered by an earlier delivery of this order
+                continue
+            project_bookings.setdefault(booking.sales_order, []).append(booking)
+        for project in older:
+            bookings = get_project_bookings(project, orders[project]['start_time'], end_time)
+            if bookings:
+                project_bookings[project] = bookings
+    except Exception as err:
+        frappe.log_error("Fetching bookings failed: {0}".format(err), "ZSW deliver_sales_orders")
+        print("Fetching bookings failed: {0}".format(err))
+        return {'delivery_notes': [], 'orders': 0}
+    print("Got bookings for {0} projects.".format(len(project_bookings)))
+    delivery_notes = []
+    collected_bookings = []
+    for project, bookings in project_bookings.items():
+        sales_order = orders[project]['name']
+        try:
+            result = deliver_project_bookings(frappe.get_doc("Sales Order", sales_order), bookings, employees, end_time)
+        except Exception as err:
+            frappe.log_error("Delivering {0} failed: {1}".format(sales_order, err), "ZSW deliver_sales_orders")
+            continue
+        collected_bookings += result['booking_ids']
+        if result['delivery_note']:
+            delivery_notes.append(result['delivery_note'])
+    # finished, mark bookings of all orders at once
+    mark_bookings(collected_bookings)
+    frappe.db.commit()
+    print("Created {0} delivery notes for {1} projects.".format(len(delivery_notes), len(project_bookings)))
+    return {'delivery_notes': delivery_notes, 'orders': len(project_bookings)}
+
+# open project sales orders by ZSW project code, with the start of their next delivery (timestamp)
+def get_open_project_orders(tenant="AT", sales_orders=None):
+    conditions = ""
+    if sales_orders:
+        if not isinstance(sales_orders, list):
+            sales_orders = json.loads(sales_orders)
+        conditions = "AND `name` IN %(sales_orders)s"
+    records = frappe.db.sql("""SELECT `name`, `creation`, `last_zsw_get_dn_timestamp`
+        FROM `tabSales Order`
+        WHERE `docstatus` = 1
+          AND `ist_projekt` = 1
+          AND `projekt_abgeschlossen` = 0
+          {conditions};""".format(conditions=conditions),
+        {'sales_orders': tuple(sales_orders or [])}, as_dict=True)
+    orders = {}
+    for r in records:
+        created = get_system_timestamp(r['creation']) - 24 * 60 * 60
+        orders[get_zsw_project_name(r['name'], tenant)] = {
+            'name': r['name'],
+            'start_time': max(cint(r['last_zsw_get_dn_timestamp']), created)
+        }
+    return orders
+
+# unix time of a naive datetime in the system time zone (e.g. creation, modified)
+def get_system_timestamp(value):
+    local_time = pytz.timezone(get_time_zone()).localize(get_datetime(value))
+    return int((local_time - datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds())
+
 def maintain_projects(tenant="AT"):
     sql_query = """SELECT `name` FROM `tabSales Order`
                    WHERE `modified` >= (DATE(NOW()) - INTERVAL 3 DAY)
@@ -1483,59 +3606,33 @@ def debug_bookings(start_date, end_date):
     end_time = int(datetime.strptime(end_date, "%Y-%m-%d").strftime("%s"))
     print("From {0} to {1} ({2} .. {3})".format(start_date, end_date, start_time, end_time))
     print("Reading bookings...")
-    bookings = get_bookings(start_time, end_time)
-    print("Got {0} bookings. Collecting customers...".format(len(bookings)))
-    # collect customers
-    customers = []
-    for booking in bookings:
-        for level in booking['levels']['WSLevelIdentification']:
-            if level['levelID'] == get_zsw_level("Customer"):
-                customer = level['code']
-                if customer not in customers:
-                    customers.append(customer)
-                    #print("Found customer: ({0})".format(customer))
-    print("Has {0} customers with bookings. Checking bookings...".format(len(customers)))
+    # read bookings (store or time windows) and group them by customer
+    booking_index = group_bookings(read_bookings(start_time, end_time))
+    print("Has {0} customers with bookings. Checking bookings...".format(len([c for c in booking_index if c])))
     # loop through all bookings
-    for booking in bookings:
-        override_duration = False
-        try:
-            for level in booking['levels']['WSLevelIdentification']:
-                if level['levelID'] == get_zsw_level("Customer"):
-                    customer = level['code']
-                if level['levelID'] == get_zsw_level("Item (Activity)"):
-                    # service type, e.g. "T01" (remote), "T03" (onsite), "T02" (project remote), "T04" (project onsite)
-                    service_type = level['code']
-                if level['levelID'] == get_zsw_level("Invoicing Type"):
-                    # invoicing_type, e.g. "J": invoice, "N"/"W": free of charge, "P": flat rate
-                    invoice_type = level['code']
-                if level['levelID'] == get_zsw_level("Sales Order"):
-                    # link to project (ZSW) sales order (ERP), e.g. "AB-00001" or "CHAB-00000"
-                    sales_order_reference = level['code']
-        except Exception as err:
-            print("...no levels... ({0})".format(err))
-        # add item to list
-        booking_id = booking['fromBookingID']
-        duration = round((float(booking['duration']) / 60.0) + 0.04, 1) # in h, ignore override
-        person = booking['person']
-        timestamp = booking['from']['timestamp']
-        print("{booking_id} ({timestamp}): customer {customer}, service type {service_type}, invoice {invoice_type}, duration {duration} h, by {person}".format(
-            booking_id=booking_id, customer=customer, service_type=service_type, invoice_type=invoice_type, duration=duration, person=person, 
-            timestamp=timestamp))
+    for customer, customer_bookings in booking_index.items():
+        for booking in customer_bookings:
+            print("{booking_id} ({timestamp}): customer {customer}, service type {service_type}, invoice {invoice_type}, duration {duration} h, by {person}".format(
+                booking_id=booking.booking_id, customer=customer, service_type=booking.activity, invoice_type=booking.invoice_type, 
+                duration=booking.get_hours(allow_override=False), person=booking.person, timestamp=booking.timestamp))
 
     return
 
 def get_all_level_definitions():
-    level_definitions = client.service.getAllLevelDefinitions(getSession())
+    with zsw_session() as s:
+        level_definitions = get_client().service.getAllLevelDefinitions(s)
     print("{0}".format(level_definitions))        
     return level_definitions
 
 def get_levels_by_level_id(level_id):
-    levels = client.service.getLevelsByLevelID(getSession(), level_id)
+    with zsw_session() as s:
+        levels = get_client().service.getLevelsByLevelID(s, level_id)
     print("{0}".format(levels))
     return levels
 
 def get_all_property_definitions():
-    property_definitions = client.service.getAllPropertyDefinitions(getSession())
+    with zsw_session() as s:
+        property_definitions = get_client().service.getAllPropertyDefinitions(s)
     print("{0}".format(property_definitions))  
     properties = []
     for p in property_definitions:
@@ -1558,28 +3655,274 @@ def get_materials():
     materials = get_levels_by_level_id(get_zsw_level("Item (Material)"))
     return materials
 
+"""
+ Local mirror of the ZSW levels (ZSW Level): code, text, active and, for customers, a hash of the
+ compared extensions. Each structure is replaced with one getLevelsByLevelID call, the customer
+ extensions are read in chunks (getLevelsEByIdentification)
+"""
+def refresh_level_mirror(structures=None, chunk_size=CUSTOMER_CHUNK_SIZE):
+    if not isinstance(structures, (list, tuple)):
+        structures = json.loads(structures) if structures else MIRROR_STRUCTURES
+    summary = {}
+    with zsw_session() as s:
+        wsTsNow = get_client().service.getTime(s)
+        for structure in structures:
+            level_id = get_zsw_level(structure)
+            records = OrderedDict()
+            for level in get_client().service.getLevelsByLevelID(s, level_id) or []:
+                records[level['code']] = {
+                    'text': level['text'],
+                    'active': 1 if level['active'] else 0,
+                    'extension_hash': None
+                }
+            if structure == "Customer":
+                codes = list(records.keys())
+                for i in range(0, len(codes), chunk_size):
+                    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': level_id, 'code': c} for c in codes[i:i+chunk_size]] }
+                    for level_e in get_client().service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow) or []:
+                        code = level_e['wsLevel']['code']
+                        if code in records:
+                            records[code]['extension_hash'] = get_payload_fingerprint(get_zsw_extension_values(level_e))
+            set_level_mirror(structure, level_id, records)
+            summary[structure] = len(records)
+            print("Mirrored {0} levels of {1}".format(len(records), structure))
+    return summary
+
+def get_level_key(level_id, code):
+    return "{0}:{1}".format(level_id, code)
+
+# replace the mirror of one level
+def set_level_mirror(structure, level_id, records, chunk_size=500):
+    timestamp = now()
+    user = frappe.session.user
+    frappe.db.sql("""DELETE FROM `tabZSW Level` WHERE `level_id` = %(level_id)s""", {'level_id': level_id})
+    rows = list(records.items())
+    for i in range(0, len(rows), chunk_size):
+        values = []
+        for code, record in rows[i:i+chunk_size]:
+            values.append((get_level_key(level_id, code), structure, level_id, code, record['text'], record['active'],
+                record['extension_hash'], timestamp, timestamp, timestamp, user, user))
+        frappe.db.sql("""INSERT INTO `tabZSW Level`
+                (`name`, `structure`, `level_id`, `code`, `text`, `active`, `extension_hash`, `last_refresh`, `creation`, `modified`, `owner`, `modified_by`)
+            VALUES {0}""".format(", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(values))),
+            tuple(v for row in values for v in row))
+    frappe.db.commit()
+    return
+
+# mirrored levels of a structure by code
+def get_level_mirror(structure):
+    levels = frappe.db.sql("""SELECT `code`, `text`, `active`, `extension_hash`
+        FROM `tabZSW Level`
+        WHERE `level_id` = %(level_id)s;""", {'level_id': get_zsw_level(structure)}, as_dict=True)
+    return {l['code']: l for l in levels}
+
+# compared extension values of a ZSW customer level (links by their natural ID)
+def get_zsw_extension_values(level_e):
+    values = OrderedDict((name, "") for name in CUSTOMER_EXTENSIONS)
+    extensions = level_e['extensions']['WSExtension'] if level_e['extensions'] else None
+    for extension in extensions or []:
+        if extension['name'] in values:
+            value = extension['link']['naturalID'] if extension['link'] else extension['value']
+            values[extension['name']] = "{0}".format(value or "")
+    return values
+
+# compared extension values of a customer payload as they are pushed (see get_customer_extensions)
+def get_customer_extension_values(payload, available_properties):
+    extensions = get_customer_extensions(payload, available_properties)
+    return OrderedDict((name, "{0}".format(extensions.get(name) or "")) for name in CUSTOMER_EXTENSIONS)
+
+# codes of other tenants (CH prefix) are not reconciled
+def is_tenant_code(code, tenant):
+    if tenant.lower() == "zsw":
+        return True
+    return ("{0}".format(code).upper().startswith("CH")) == (tenant.lower() == "ch")
+
+"""
+ Reconciles ERP customers, project sales orders and sync-flagged items with the level mirror in
+ one pass per structure (hash maps by ZSW code) and pushes only the differences (push=0: report only)
+
+ Returns the drift report per structure: missing (not in ZSW), changed (with the fields that
+ differ), orphaned (active in ZSW, unknown to the ERP; reported only) and the number in sync
+"""
+def reconcile_zsw_levels(tenant="AT", push=True, refresh=True):
+    if cint(refresh):
+        refresh_level_mirror()
+    report = OrderedDict()
+    # customers: enabled customers and disabled customers that exist in ZSW (as the customer sync)
+    mirror = get_level_mirror("Customer")
+    customers = [c for c in frappe.get_all("Customer", fields=['name', 'customer_name', 'short_name', 'technik', 'disabled'])
+        if not cint(c['disabled']) or get_zsw_reference(c['name'], tenant) in mirror]
+    customer_data = get_customer_zsw_data([c['name'] for c in customers])
+    available_properties = get_all_property_definitions() if customers else []
+    expected = {}
+    for c in customers:
+        payload = get_customer_payload(c['name'], c['customer_name'], False if cint(c['disabled']) else True,
+            tenant=tenant, technician=c['technik'], short_name=c['short_name'], data=customer_data.get(c['name']) or {})
+        expected[payload['zsw_reference']] = ({
+            'text': get_customer_level_text(payload, update=True),
+            'active': 1 if payload['active'] else 0,
+            'extension_hash': get_payload_fingerprint(get_customer_extension_values(payload, available_properties))
+        }, {
+            'customer': c['name'],
+            'customer_name': c['customer_name'],
+            'active': False if cint(c['disabled']) else True,
+            'technician': c['technik'],
+            'short_name': c['short_name']
+        })
+    report['Customer'] = diff_levels(expected, mirror, tenant)
+    # project sales orders
+    sales_orders = frappe.db.sql("""SELECT
+            `tabSales Order`.`name`,
+            `tabSales Order`.`customer`,
+            `tabSales Order`.`customer_name`,
+            `tabSales Order`.`projekt_abgeschlossen`,
+            `tabAddress`.`city`
+        FROM `tabSales Order`
+        LEFT JOIN `tabAddress` ON `tabAddress`.`name` = `tabSales Order`.`customer_address`
+        WHERE `tabSales Order`.`docstatus` = 1
+          AND `tabSales Order`.`ist_projekt` = 1;""", as_dict=True)
+    expected = {}
+    for so in sales_orders:
+        active = False if cint(so['projekt_abgeschlossen']) else True
+        expected[get_zsw_project_name(so['name'], tenant)] = ({
+            'text': "{0}, {1}".format(so['customer_name'], so['city'] or "-"),
+            'active': 1 if active else 0
+        }, {
+            'sales_order': so['name'],
+            'customer': so['customer'],
+            'customer_name': so['customer_name'],
+            'active': active
+        })
+    report['Sales Order'] = diff_levels(expected, get_level_mirror("Sales Order"), tenant)
+    # items
+    for target, flag in (("Item (Material)", 'sync_as_material_to_zsw'), ("Item (Activity)", 'sync_as_activity_to_zsw')):
+        items = frappe.get_all("Item", filters={flag: 1}, fields=['item_code', 'item_name', 'disabled'])
+        expected = {}
+        for i in items:
+            expected[i['item_code']] = ({
+                'text': i['item_name'],
+                'active': 0 if cint(i['disabled']) else 1
+            }, i)
+        report[target] = diff_levels(expected, get_level_mirror(target), "zsw")
+    # push the differences
+    if cint(push):
+        for structure, drift in report.items():
+            records = [drift['records'][code] for code in drift['missing'] + [c['code'] for c in drift['changed']]]
+            if not records:
+                continue
+            print("Pushing {0} {1} records".format(len(records), structure))
+            if structure == "Customer":
+                drift['failed'] = create_update_customers(records, tenant=tenant, force=True)['failed']
+            elif structure == "Sales Order":
+                drift['failed'] = []
+                with zsw_session():
+                    for so in records:
+                        try:
+                            create_update_sales_order(tenant=tenant, force=True, **so)
+                        except Exception as err:
+                            frappe.log_error("{0}: {1}".format(so['sales_order'], err), "ZSW reconcile")
+                            drift['failed'].append(so['sales_order'])
+            else:
+                drift['failed'] = sync_items(records, structure, force=True)['failed']
+    for structure, drift in report.items():
+        del drift['records']
+        print("{0}: {1} in sync, {2} missing, {3} changed, {4} orphaned".format(structure, drift['in_sync'],
+            len(drift['missing']), len(drift['changed']), len(drift['orphaned'])))
+    add_reconciliation_comment(report, tenant, cint(push))
+    return report
+
+# diff expected levels (code: (values, ERP record)) against the mirror (code: level)
+def diff_levels(expected, mirror, tenant):
+    drift = {'missing': [], 'changed': [], 'orphaned': [], 'in_sync': 0, 'records': {}}
+    for code, (values, record) in expected.items():
+        level = mirror.get(code)
+        if not level:
+            drift['missing'].append(code)
+            drift['records'][code] = record
+            continue
+        fields = [field for field, value in values.items() if value != level[field]]
+        if fields:
+            drift['changed'].append({'code': code, 'fields': fields})
+            drift['records'][code] = record
+        else:
+            drift['in_sync'] += 1
+    drift['orphaned'] = [code for code, level in mirror.items()
+        if code not in expected and cint(level['active']) and is_tenant_code(code, tenant)]
+    return drift
+
+def add_reconciliation_comment(report, tenant, pushed):
+    new_comment = frappe.get_doc({
+        'doctype': 'Communication',
+        'comment_type': "Comment",
+        'content': "Level reconciliation ({tenant}{pushed}): {drift}".format(
+            tenant=tenant, pushed=", pushed" if pushed else "",
+            drift=", ".join("{0} {1} missing / {2} changed / {3} orphaned".format(structure, len(drift['missing']),
+                len(drift['changed']), len(drift['orphaned'])) for structure, drift in report.items())),
+        'reference_doctype': "ZSW",
+        'status': "Linked",
+        'reference_name': "ZSW"
+    })
+    new_comment.insert()
+    return
+
+@frappe.whitelist()
+def enqueue_reconcile_zsw_levels(tenant="AT", push=1):
+    # enqueue level reconciliation (potential high workload)
+    kwargs={
+        'tenant': tenant,
+        'push': push
+    }
+
+    enqueue_zsw_job("finkzeit.finkzeit.zsw.reconcile_zsw_levels",
+        queue='long',
+        timeout=15000,
+        **kwargs)
+    return
+
 """
  This function returns the ZSW level for an ERPNext data structure
  Data structures are: "Customer", "Item (Activity)", "Item (Material)", "Sales Order", "Invoicing Type"
 """
 def get_zsw_level(erp_structure):
-    levels = frappe.db.sql("""SELECT `zsw_level` FROM `tabZSW Field Configuration` WHERE `erp_doctype` = '{erp_structure}' LIMIT 1;""".format(erp_structure=erp_structure), as_dict=True)
-    if levels:
-        return levels[0]['zsw_level']
-    else:
-        # revert to default values
-        if erp_structure == "Customer":
-            return 1
-        elif erp_structure == "Item (Activity)":
-            return 2
-        elif erp_structure == "Item (Material)":
-            return 7
-        elif erp_structure == "Invoicing Type":
-            return 3
-        elif erp_structure == "Sales Order":
-            return 4
-        else:
-            return None
+    return get_zsw_levels()['levels'].get(erp_structure)
+
+"""
+ Reverse lookup: returns the ERPNext data structure for a ZSW level ID (or None)
+"""
+def get_zsw_structure(level_id):
+    return get_zsw_levels()['structures'].get(level_id)
+
+"""
+ Map of the ZSW levels, loaded from the ZSW field configuration and cached in redis, so that all
+ web and background workers see the same map. It is invalidated when the ZSW settings are saved
+ (see clear_zsw_level_cache) and read once per request or job
+"""
+def get_zsw_levels(reload=False):
+    if reload:
+        clear_zsw_level_cache()
+    return frappe.cache().get_value(ZSW_LEVEL_CACHE_KEY, generator=load_zsw_levels)
+
+def load_zsw_levels():
+    levels = {}
+    field_configurations = frappe.db.sql("""SELECT `erp_doctype`, `zsw_level` 
+        FROM `tabZSW Field Configuration` 
+        ORDER BY `idx` ASC;""", as_dict=True)
+    for field_configuration in field_configurations:
+        # first configuration per data structure wins
+        if field_configuration['erp_doctype'] not in levels:
+            levels[field_configuration['erp_doctype']] = field_configuration['zsw_level']
+    # revert to default values
+    for erp_structure, zsw_level in DEFAULT_ZSW_LEVELS.items():
+        if erp_structure not in levels:
+            levels[erp_structure] = zsw_level
+    return {
+        'levels': levels,
+        'structures': {zsw_level: erp_structure for erp_structure, zsw_level in levels.items()}
+    }
+
+def clear_zsw_level_cache():
+    frappe.cache().delete_value(ZSW_LEVEL_CACHE_KEY)
+    return
 
 """ 
  Returns the ID (ZSW) for the technician
@@ -1607,32 +3950,29 @@ def update_customer_all_in(licence, calc_rate, tenant="AT"):
     else:
         all_in_ms = 0
         
-    s = getSession()
-    # create or update customer
-    wsTsNow = client.service.getTime(s)
-    wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': zsw_reference }] }
-    wsLevelEArray = client.service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow)
-    # prepare properties
-    available_properties = get_all_property_definitions()
-    # check if customer exists
-    if wsLevelEArray:
-        # customer exists --> update
-        print("Customer found, update")
-        wsLevelEArray[0]["action"] = 3
+    with zsw_session() as s:
+        # create or update customer
+        wsTsNow = get_client().service.getTime(s)
+        wsLevelIdentArray = { 'WSLevelIdentification': [{'levelID': get_zsw_level("Customer"), 'code': zsw_reference }] }
+        wsLevelEArray = get_client().service.getLevelsEByIdentification(s, wsLevelIdentArray, wsTsNow)
+        # prepare properties
+        available_properties = get_all_property_definitions()
+        # check if customer exists
+        if wsLevelEArray:
+            # customer exists --> update
+            print("Customer found, update")
+            wsLevelEArray[0]["action"] = 3
         
-        if "p_all_in_std" in available_properties:
-            createOrUpdateWSExtension_historical(wsLevelEArray[0]["extensions"]["WSExtension"], "p_all_in_std", all_in_ms)
-
-        # compress level
-        contentDict = compress_level_e(wsLevelEArray[0])
-        print("{0}".format(contentDict))
-        try:
-            client.service.updateLevelsE(s, {'WSExtensibleLevel': [contentDict]})
-        except Exception as err:
-            frappe.log_error("{0} on {1}".format(err, contentDict), "ZSW update_customer_all_in customer error")
-    else:
-        print("Customer not found")
+            if "p_all_in_std" in available_properties:
+                createOrUpdateWSExtension_historical(wsLevelEArray[0]["extensions"]["WSExtension"], "p_all_in_std", all_in_ms)
 
-    # close connection
-    disconnect()
+            # compress level
+            contentDict = compress_level_e(wsLevelEArray[0])
+            print("{0}".format(contentDict))
+            try:
+                get_client().service.updateLevelsE(s, {'WSExtensibleLevel': [contentDict]})
+            except Exception as err:
+                frappe.log_error("{0} on {1}".format(err, contentDict), "ZSW update_customer_all_in customer error")
+        else:
+            print("Customer not found")
     return
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018-2026, Fink Zeitsysteme/libracore and contributors
+# For license information, please see license.txt
+#
+# Benchmark of the ZSW booking parsers (zeep object tree vs. streaming iterparse) and
+# throughput benchmark of the ZSW functions against the local stand-in (see zsw_standin)
+#
+# Run from bench:
+#  $ bench --site [site] execute finkzeit.finkzeit.zsw_benchmark.benchmark_booking_parser --kwargs "{'count': 50000}"
+#  $ bench --site [site] execute finkzeit.finkzeit.zsw_benchmark.benchmark_suite --kwargs "{'sizes': [1000, 10000, 100000], 'latency': 0.05}"
+#
+from __future__ import unicode_literals
+import frappe
+from finkzeit.finkzeit.zsw import get_client, get_zsw_levels, parse_booking, iterparse_bookings, \
+    get_zsw_reference, create_update_customers, sync_materials, create_invoices, send_booking_marks
+from finkzeit.finkzeit.zsw_standin import ZSWStandIn, generate_bookings, use_standin, to_xml, SOAP_ENV
+from lxml import etree
+from frappe.utils import cint
+from datetime import datetime, timedelta
+import io
+import os
+import gc
+import resource
+import tracemalloc
+from time import time
+
+"""
+ Renders a synthetic getBookingPairs SOAP response with <count> booking pairs, the records are
+ the ones the stand-in serves (generate_bookings, serialized as WSBookingPair)
+"""
+def render_booking_response(count, levels, namespace, response_name="getBookingPairsResponse"):
+    start_time = 1767225600
+    bookings = generate_bookings(count, start_time, start_time + 30 * 24 * 60 * 60,
+        ["{0:05d}".format(c) for c in range(1, 5001)],
+        projects=["AB-{0:05d}".format(p) for p in range(1, 301)],
+        materials=["M-{0:04d}".format(m) for m in range(1, 51)],
+        level_ids={erp_structure: zsw_level for zsw_level, erp_structure in levels.items()})
+    envelope = etree.Element("{{{0}}}Envelope".format(SOAP_ENV), nsmap={'S': SOAP_ENV})
+    body = etree.SubElement(envelope, "{{{0}}}Body".format(SOAP_ENV))
+    response = etree.SubElement(body, "{{{0}}}{1}".format(namespace, response_name), nsmap={'ns2': namespace})
+    to_xml(response, "return", bookings, "WSBookingPair[]")
+    return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+class BenchmarkResponse(object):
+    # minimal requests response for zeep's reply processing
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+        self.encoding = "utf-8"
+        self.headers = {'Content-Type': 'text/xml; charset=utf-8'}
+
+def parse_with_zeep(content, levels):
+    zeep_client = get_client()
+    binding = zeep_client.service._binding
+    operation = binding.get("getBookingPairs")
+    bookings = binding.process_reply(zeep_client, operation, BenchmarkResponse(content))
+    return [parse_booking(booking, levels) for booking in bookings or []]
+
+def parse_with_iterparse(content, levels):
+    return list(iterparse_bookings(io.BytesIO(content), levels))
+
+# runs one parser in a forked child to isolate peak memory (ru_maxrss) from the parent process
+def measure(parser, content, levels):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        start = time()
+        records = parser(content, levels)
+        duration = time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, "{0};{1};{2};{3}".format(len(records), duration, peak, rss_after - rss_before).encode("utf-8"))
+        os.close(write_fd)
+        os._exit(0)
+    os.close(write_fd)
+    result = b""
+    while True:
+        chunk = os.read(read_fd, 1024)
+        if not chunk:
+            break
+        result += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    count, duration, peak, rss = result.decode("utf-8").split(";")
+    return {'records': int(count), 'seconds': float(duration), 'peak_mb': int(peak) / 1048576.0, 'rss_mb': int(rss) / 1024.0}
+
+def benchmark_booking_parser(count=50000):
+    count = int(count)
+    levels = get_zsw_levels()['structures']
+    zeep_client = get_client()
+    namespace = zeep_client.service._binding.get("getBookingPairs").output.body.qname.namespace
+    content = render_booking_response(count, levels, namespace)
+    print("Benchmark response: {0} bookings, {1:.1f} MB".format(count, len(content) / 1048576.0))
+    results = {}
+    for name, parser in (("zeep", parse_with_zeep), ("iterparse", parse_with_iterparse)):
+        results[name] = measure(parser, content, levels)
+        print("{0:>10}: {records} records in {seconds:.2f} s, peak {peak_mb:.1f} MB (traced), "
+            "+{rss_mb:.1f} MB (rss)".format(name, **results[name]))
+    return results
+
+"""
+ Throughput of the ZSW functions against the local stand-in with <latency> [s] per call:
+   customer sync: create_update_customers (forced) with up to <customers> ERP customers
+   material sync: sync_materials (forced)
+   invoice run: create_invoices (dry run, with phase profile) over <days> days with <size> bookings
+   booking marks: send_booking_marks of all bookings of the run
+ per size in <sizes>. The syncs do not depend on the booking volume and run once. The local
+ sync state of the real ZSW (fingerprints, booking store, employee cache) is not used while the
+ stand-in is (see use_standin).
+"""
+def benchmark_suite(sizes=(1000, 10000, 100000), latency=0.05, latency_per_record=0, customers=1000, days=30, sessions=4):
+    if isinstance(sizes, (int, float)) or (isinstance(sizes, str) and sizes.isdigit()):
+        sizes = [sizes]
+    erp_customers = frappe.get_all("Customer",
+        filters={'disabled': 0, 'name': ['like', 'K-%']},
+        fields=['name', 'customer_name', 'short_name', 'technik'],
+        limit=cint(customers))
+    customer_codes = [get_zsw_reference(c['name'], "AT") for c in erp_customers]
+    materials = [m['item_code'] for m in frappe.get_all("Item", filters={'sync_as_material_to_zsw': 1}, fields=['item_code'])]
+    to_date = datetime.now().date()
+    from_date = to_date - timedelta(days=cint(days))
+    start_time = int((datetime.combine(from_date, datetime.min.time()) - datetime(1970, 1, 1)).total_seconds())
+    end_time = int((datetime.combine(to_date, datetime.max.time()) - datetime(1970, 1, 1)).total_seconds())
+    results = {'latency': latency, 'customers': len(customer_codes), 'materials': len(materials), 'runs': {}}
+    standin = ZSWStandIn(latency=latency, latency_per_record=latency_per_record).start()
+    try:
+        with use_standin(standin, sessions=sessions):
+            # customer and material sync
+            results['customer_sync'] = measure_call(standin, create_update_customers, [{
+                'customer': c['name'],
+                'customer_name': c['customer_name'],
+                'active': True,
+                'technician': c['technik'],
+                'short_name': c['short_name']} for c in erp_customers], force=True)
+            print_result("customer sync", results['customer_sync'])
+            results['material_sync'] = measure_call(standin, sync_materials, force=True)
+            print_result("material sync", results['material_sync'])
+            # invoice runs per booking volume
+            for size in sizes:
+                size = cint(size)
+                bookings = generate_bookings(size, start_time, end_time, customer_codes or ["00000"], materials=materials)
+                standin.clear_bookings()
+                standin.add_bookings(bookings)
+                run = {}
+                run['invoice_run'] = measure_call(standin, create_invoices, tenant="AT",
+                    from_date=from_date.strftime("%Y-%m-%d"), to_date=to_date.strftime("%Y-%m-%d"), dry_run=1)
+                print_result("invoice run {0}".format(size), run['invoice_run'])
+                run['booking_marks'] = measure_call(standin, send_booking_marks, [b['fromBookingID'] for b in bookings])
+                print_result("booking marks {0}".format(size), run['booking_marks'])
+                results['runs'][size] = run
+    finally:
+        standin.stop()
+    return results
+
+# time one call, with the stand-in calls and records it caused
+def measure_call(standin, function, *args, **kwargs):
+    standin.reset_stats()
+    start = time()
+    result = function(*args, **kwargs)
+    duration = time() - start
+    stats = standin.stats()
+    measurement = {'seconds': round(duration, 3), 'calls': stats['calls'], 'records': stats['records']}
+    if isinstance(result, dict) and 'profile' in result:
+        measurement['profile'] = result['profile']
+        measurement['invoices'] = len(result.get('invoices') or [])
+    return measurement
+
+def print_result(name, measurement):
+    print("{0:>22}: {1:.2f} s, {2} calls ({3})".format(name, measurement['seconds'],
+        sum(measurement['calls'].values()), ", ".join("{0}: {1}".format(k, v) for k, v in sorted(measurement['calls'].items()))))
+    if 'profile' in measurement:
+        print("{0:>22}  {1} invoices, phases: {2}".format("", measurement['invoices'], ", ".join(
+            "{0} {1:.2f} s".format(k, v) for k, v in measurement['profile']['timings'].items())))
@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2018-2026, Fink Zeitsysteme/libracore and contributors
+# For license information, please see license.txt
+#
+# Local stand-in for the ZSW SOAP web service (tests and benchmarks)
+#
+# Serves a WSDL with the operations used by finkzeit.finkzeit.zsw and answers them from memory
+# with a configurable latency, so that the module (zeep client, session pool, fast booking
+# parser) can be run against it unchanged:
+#
+#   standin = ZSWStandIn(latency=0.05)
+#   standin.add_bookings(generate_bookings(10000, start_time, end_time, customers=["12345"]))
+#   standin.start()
+#   with use_standin(standin):
+#       create_invoices(from_date="2026-01-01", to_date="2026-01-31", dry_run=1)
+#   standin.stop()
+#
+from __future__ import unicode_literals
+import frappe
+from lxml import etree
+from zeep import Client, Settings
+from finkzeit.finkzeit import zsw
+from finkzeit.finkzeit.zsw import DEFAULT_ZSW_LEVELS, TRAVEL_ITEMS
+from contextlib import contextmanager
+from collections import OrderedDict
+from datetime import datetime
+from time import time, sleep
+import bisect
+import random
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+SOAP_ENV = "http://schemas.xmlsoap.org/soap/envelope/"
+XSI = "http://www.w3.org/2001/XMLSchema-instance"
+NAMESPACE = "urn:finkzeit:zsw-standin"
+
+# complex types: ordered fields (name, type), "[]" marks repeated elements
+TYPES = OrderedDict([
+    ('WSTimestamp', (('timeInSeconds', 'long'), ('timestamp', 'string'), ('day', 'int'), ('month', 'int'),
+        ('year', 'int'), ('hour', 'int'), ('min', 'int'))),
+    ('WSLevelIdentification', (('levelID', 'int'), ('code', 'string'))),
+    ('WSLevelIdentificationArray', (('WSLevelIdentification', 'WSLevelIdentification[]'),)),
+    ('WSProperty', (('key', 'int'), ('val', 'string'))),
+    ('WSPropertyArray', (('WSProperty', 'WSProperty[]'),)),
+    ('WSBookingPair', (('fromBookingID', 'long'), ('toBookingID', 'long'), ('person', 'int'), ('duration', 'int'),
+        ('notice', 'string'), ('from', 'WSTimestamp'), ('to', 'WSTimestamp'), ('levels', 'WSLevelIdentificationArray'),
+        ('properties', 'WSPropertyArray'))),
+    ('WSEmployee', (('personID', 'int'), ('firstname', 'string'), ('lastname', 'string'))),
+    ('WSLevel', (('levelID', 'int'), ('code', 'string'), ('text', 'string'), ('active', 'boolean'))),
+    ('WSLevelArray', (('WSLevel', 'WSLevel[]'),)),
+    ('WSLink', (('action', 'int'), ('linkType', 'int'), ('naturalID', 'string'), ('naturalInfo', 'int'))),
+    ('WSExtension', (('action', 'int'), ('name', 'string'), ('value', 'string'), ('validFrom', 'WSTimestamp'),
+        ('validTo', 'WSTimestamp'), ('link', 'WSLink'))),
+    ('WSExtensionArray', (('WSExtension', 'WSExtension[]'),)),
+    ('WSExtensibleLevel', (('action', 'int'), ('wsLevel', 'WSLevel'), ('extensions', 'WSExtensionArray'))),
+    ('WSExtensibleLevelArray', (('WSExtensibleLevel', 'WSExtensibleLevel[]'),)),
+    ('WSLevelDefinition', (('levelID', 'int'), ('name', 'string'))),
+    ('WSPropertyDefinition', (('key', 'int'), ('name', 'string'), ('scriptVariable', 'string'))),
+    ('longArray', (('long', 'long[]'),))
+])
+
+# operations: (argument types, return type), the arguments are named arg0, arg1, ...
+OPERATIONS = OrderedDict([
+    ('openSession', (('string',), 'string')),
+    ('login', (('string', 'string', 'string'), 'int')),
+    ('refreshSession', (('string',), 'string')),
+    ('logout', (('string',), 'int')),
+    ('closeSession', (('string',), 'int')),
+    ('getTime', (('string',), 'WSTimestamp')),
+    ('getAllEmployees', (('string', 'int'), 'WSEmployee[]')),
+    ('getBookingPairs', (('string', 'WSTimestamp', 'WSTimestamp', 'boolean', 'int'), 'WSBookingPair[]')),
+    ('getBookingPairsByLevel', (('string', 'WSTimestamp', 'WSTimestamp', 'string', 'int'), 'WSBookingPair[]')),
+    ('getLevelsEByIdentification', (('string', 'WSLevelIdentificationArray', 'WSTimestamp'), 'WSExtensibleLevel[]')),
+    ('updateLevelsE', (('string', 'WSExtensibleLevelArray'), None)),
+    ('createLevelsE', (('string', 'WSExtensibleLevelArray'), None)),
+    ('createLevels', (('string', 'WSLevelArray', 'boolean'), None)),
+    ('checkBookings', (('string', 'longArray', 'int'), None)),
+    ('getAllPropertyDefinitions', (('string',), 'WSPropertyDefinition[]')),
+    ('quickAddGroupMember', (('string', 'int', 'WSLink'), None)),
+    ('getAllLevelDefinitions', (('string',), 'WSLevelDefinition[]')),
+    ('getLevelsByLevelID', (('string', 'int'), 'WSLevel[]'))
+])
+
+# customer extensions known to the stand-in (see set_customer_extensions)
+PROPERTY_DEFINITIONS = ("p_ortKunde", "p_strasseKunde", "p_plzKunde", "p_mailadresseKunde", "p_telefonnummer",
+    "p_projektverantwortlicher", "p_lizenzname", "p_auftrag_projekt")
+
+class ZSWFault(Exception):
+    pass
+
+"""
+ In-memory ZSW web service
+   latency: delay per call [s]
+   latency_per_record: additional delay per record sent or returned [s]
+   employees: number of employees (personID 1..n)
+ Counts the calls and records per operation (see stats)
+"""
+class ZSWStandIn(object):
+    def __init__(self, latency=0, latency_per_record=0, employees=40, host="127.0.0.1", port=0, level_ids=None):
+        self.latency = float(latency or 0)
+        self.latency_per_record = float(latency_per_record or 0)
+        self.host = host
+        self.port = int(port or 0)
+        self.level_ids = dict(level_ids or DEFAULT_ZSW_LEVELS)
+        self.employees = [{'personID': i, 'firstname': "Employee", 'lastname': "{0:03d}".format(i)}
+            for i in range(1, int(employees) + 1)]
+        self.lock = threading.Lock()
+        self.sessions = {}                  # session: logged in
+        self.session_count = 0
+        self.levels = {}                    # (levelID, code): extensible level
+        self.group_members = {}             # group: set of naturalIDs
+        self.bookings = []                  # sorted by from.timeInSeconds
+        self.booking_times = []
+        self.checked = set()
+        self.calls = {}
+        self.records = {}
+        self.server = None
+        self.thread = None
+
+    """ data """
+    def add_bookings(self, bookings):
+        with self.lock:
+            self.bookings = sorted(self.bookings + list(bookings), key=lambda b: b['from']['timeInSeconds'])
+            self.booking_times = [b['from']['timeInSeconds'] for b in self.bookings]
+        return
+
+    def clear_bookings(self):
+        with self.lock:
+            self.bookings = []
+            self.booking_times = []
+            self.checked = set()
+        return
+
+    def add_levels(self, structure, codes, text=None):
+        level_id = self.level_ids[structure]
+        with self.lock:
+            for code in codes:
+                self.levels[(level_id, code)] = {
+                    'action': 0,
+                    'wsLevel': {'levelID': level_id, 'code': code, 'text': text or code, 'active': True},
+                    'extensions': {'WSExtension': []}
+                }
+        return
+
+    def get_levels(self, structure):
+        level_id = self.level_ids[structure]
+        with self.lock:
+            return [level for key, level in self.levels.items() if key[0] == level_id]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'records': dict(self.records),
+                'checked': len(self.checked),
+                'levels': len(self.levels)
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.records = {}
+        return
+
+    """ server """
+    def start(self):
+        class Handler(ZSWRequestHandler):
+            standin = self
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        print("ZSW stand-in listening on {0}".format(self.address))
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        return
+
+    @property
+    def address(self):
+        return "http://{0}:{1}/zsw".format(self.host, self.port)
+
+    @property
+    def wsdl_url(self):
+        return "{0}?wsdl".format(self.address)
+
+    # zeep client for the stand-in (same settings as zsw.get_client)
+    def get_client(self):
+        return Client(self.wsdl_url, settings=Settings(strict=True, xml_huge_tree=False))
+
+    """ dispatch """
+    def call(self, operation, args):
+        if operation not in OPERATIONS:
+            raise ZSWFault("Unknown operation {0}".format(operation))
+        if operation not in ("openSession", "login", "refreshSession", "logout", "closeSession"):
+            self.check_session(args[0])
+        result = getattr(self, "op_{0}".format(operation))(*args)
+        records = len(result) if isinstance(result, list) else 0
+        for arg in args:
+            if isinstance(arg, dict) and len(arg) == 1 and isinstance(list(arg.values())[0], list):
+                records += len(list(arg.values())[0])
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.records[operation] = self.records.get(operation, 0) + records
+        delay = self.latency + self.latency_per_record * records
+        if delay > 0:
+            sleep(delay)
+        return result
+
+    def check_session(self, session):
+        with self.lock:
+            if not self.sessions.get(session):
+                raise ZSWFault("Invalid session {0}".format(session))
+
+    """ operations """
+    def op_openSession(self, license):
+        with self.lock:
+            self.session_count += 1
+            session = "standin-{0}".format(self.session_count)
+            self.sessions[session] = False
+        return session
+
+    def op_login(self, session, user, password):
+        with self.lock:
+            if session not in self.sessions:
+                return 1
+            self.sessions[session] = True
+        return 0
+
+    def op_refreshSession(self, session):
+        with self.lock:
+            return session if self.sessions.get(session) else None
+
+    def op_logout(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions[session] = False
+        return 0
+
+    def op_closeSession(self, session):
+        with self.lock:
+            self.sessions.pop(session, None)
+        return 0
+
+    def op_getTime(self, session):
+        return get_timestamp(int(time()))
+
+    def op_getAllEmployees(self, session, mode):
+        return self.employees
+
+    def op_getBookingPairs(self, session, from_ts, to_ts, checked, mode):
+        return self.find_bookings(from_ts, to_ts)
+
+    def op_getBookingPairsByLevel(self, session, from_ts, to_ts, code, level_id):
+        return [b for b in self.find_bookings(from_ts, to_ts)
+            if any(l['levelID'] == level_id and l['code'] == code for l in b['levels']['WSLevelIdentification'])]
+
+    def find_bookings(self, from_ts, to_ts):
+        start = (from_ts or {}).get('timeInSeconds') or 0
+        end = (to_ts or {}).get('timeInSeconds') or int(time())
+        with self.lock:
+            return self.bookings[bisect.bisect_left(self.booking_times, start):bisect.bisect_right(self.booking_times, end)]
+
+    def op_getLevelsEByIdentification(self, session, identifications, timestamp):
+        with self.lock:
+            return [self.levels[(i['levelID'], i['code'])] for i in (identifications or {}).get('WSLevelIdentification') or []
+                if (i['levelID'], i['code']) in self.levels]
+
+    def op_updateLevelsE(self, session, levels):
+        levels = (levels or {}).get('WSExtensibleLevel') or []
+        with self.lock:
+            for level in levels:
+                key = (level['wsLevel']['levelID'], level['wsLevel']['code'])
+                if key not in self.levels:
+                    raise ZSWFault("Level {0}/{1} not found".format(*key))
+            for level in levels:
+                key = (level['wsLevel']['levelID'], level['wsLevel']['code'])
+                self.levels[key] = merge_level_e(self.levels[key], level)
+        return None
+
+    def op_createLevelsE(self, session, levels):
+        levels = (levels or {}).get('WSExtensibleLevel') or []
+        with self.lock:
+            for level in levels:
+                key = (level['wsLevel']['levelID'], level['wsLevel']['code'])
+                if key in self.levels:
+                    raise ZSWFault("Level {0}/{1} exists".format(*key))
+            for level in levels:
+                key = (level['wsLevel']['levelID'], level['wsLevel']['code'])
+                self.levels[key] = merge_level_e({'action': 0, 'wsLevel': level['wsLevel'], 'extensions': {'WSExtension': []}}, level)
+        return None
+
+    def op_createLevels(self, session, levels, update):
+        with self.lock:
+            for level in (levels or {}).get('WSLevel') or []:
+                key = (level['levelID'], level['code'])
+                if key in self.levels:
+                    self.levels[key]['wsLevel'] = level
+                else:
+                    self.levels[key] = {'action': 0, 'wsLevel': level, 'extensions': {'WSExtension': []}}
+        return None
+
+    def op_checkBookings(self, session, booking_ids, mode):
+        with self.lock:
+            self.checked.update((booking_ids or {}).get('long') or [])
+        return None
+
+    def op_getAllPropertyDefinitions(self, session):
+        return [{'key': n + 1, 'name': p, 'scriptVariable': p} for n, p in enumerate(PROPERTY_DEFINITIONS)]
+
+    def op_quickAddGroupMember(self, session, group, link):
+        with self.lock:
+            self.group_members.setdefault(group, set()).add(link['naturalID'])
+        return None
+
+    def op_getAllLevelDefinitions(self, session):
+        return [{'levelID': level_id, 'name': structure} for structure, level_id in self.level_ids.items()]
+
+    def op_getLevelsByLevelID(self, session, level_id):
+        with self.lock:
+            return [level['wsLevel'] for key, level in self.levels.items() if key[0] == level_id]
+
+# apply an update (action per extension: 1 create, 2 delete, 3 update) to a stored E-level
+def merge_level_e(stored, update):
+    extensions = [e for e in (stored.get('extensions') or {}).get('WSExtension') or []]
+    for extension in (update.get('extensions') or {}).get('WSExtension') or []:
+        action = extension.get('action')
+        if action in (2, 3):
+            # replace or drop the stored extension with the same name (and link)
+            extensions = [e for e in extensions if not (e['name'] == extension['name']
+                and (e.get('link') or {}).get('naturalID') == (extension.get('link') or {}).get('naturalID'))]
+        if action != 2:
+            extensions.append(dict(extension, action=0))
+    return {'action': 0, 'wsLevel': update.get('wsLevel') or stored['wsLevel'], 'extensions': {'WSExtension': extensions}}
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ZSWRequestHandler(BaseHTTPRequestHandler):
+    standin = None
+
+    def do_GET(self):
+        self.send_xml(200, render_wsdl(self.standin.address))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            operation, args = parse_request(body)
+            result = self.standin.call(operation, args)
+            self.send_xml(200, render_response(operation, result))
+        except Exception as err:
+            self.send_xml(500, render_fault(err))
+
+    def send_xml(self, status, content):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+""" WSDL """
+def render_wsdl(address):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+        '<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{0}" targetNamespace="{0}" name="ZSWStandIn">'.format(NAMESPACE),
+        '<types><xsd:schema targetNamespace="{0}" elementFormDefault="unqualified">'.format(NAMESPACE)]
+    for name, fields in TYPES.items():
+        lines.append('<xsd:complexType name="{0}"><xsd:sequence>{1}</xsd:sequence></xsd:complexType>'.format(
+            name, "".join(render_xsd_element(field, field_type) for field, field_type in fields)))
+    for operation, (args, result) in OPERATIONS.items():
+        lines.append('<xsd:element name="{0}" type="tns:{0}"/><xsd:complexType name="{0}"><xsd:sequence>{1}</xsd:sequence></xsd:complexType>'.format(
+            operation, "".join(render_xsd_element("arg{0}".format(n), arg) for n, arg in enumerate(args))))
+        lines.append('<xsd:element name="{0}Response" type="tns:{0}Response"/><xsd:complexType name="{0}Response"><xsd:sequence>{1}</xsd:sequence></xsd:complexType>'.format(
+            operation, render_xsd_element("return", result) if result else ""))
+    lines.append('</xsd:schema></types>')
+    for operation in OPERATIONS:
+        for message in (operation, "{0}Response".format(operation)):
+            lines.append('<message name="{0}"><part name="parameters" element="tns:{0}"/></message>'.format(message))
+    lines.append('<portType name="ZSWPort">')
+    for operation in OPERATIONS:
+        lines.append('<operation name="{0}"><input message="tns:{0}"/><output message="tns:{0}Response"/></operation>'.format(operation))
+    lines.append('</portType><binding name="ZSWBinding" type="tns:ZSWPort">'
+        '<soap:binding transport="http://schemas.xmlsoap.org/soap/http" style="document"/>')
+    for operation in OPERATIONS:
+        lines.append('<operation name="{0}"><soap:operation soapAction=""/><input><soap:body use="literal"/></input>'
+            '<output><soap:body use="literal"/></output></operation>'.format(operation))
+    lines.append('</binding><service name="ZSWService"><port name="ZSWPort" binding="tns:ZSWBinding">'
+        '<soap:address location="{0}"/></port></service></definitions>'.format(address))
+    return "".join(lines).encode("utf-8")
+
+def render_xsd_element(name, field_type):
+    repeated = field_type.endswith("[]")
+    field_type = field_type.rstrip("[]")
+    return '<xsd:element name="{0}" type="{1}:{2}" minOccurs="0"{3} nillable="true"/>'.format(
+        name, "tns" if field_type in TYPES else "xsd", field_type, ' maxOccurs="unbounded"' if repeated else "")
+
+""" SOAP messages """
+def parse_request(body):
+    envelope = etree.fromstring(body)
+    operation_element = envelope.find("{{{0}}}Body".format(SOAP_ENV))[0]
+    operation = etree.QName(operation_element).localname
+    if operation not in OPERATIONS:
+        raise ZSWFault("Unknown operation {0}".format(operation))
+    arg_types = OPERATIONS[operation][0]
+    values = {}
+    for child in operation_element:
+        values[etree.QName(child).localname] = child
+    args = []
+    for n, arg_type in enumerate(arg_types):
+        element = values.get("arg{0}".format(n))
+        args.append(from_xml(element, arg_type) if element is not None else None)
+    return operation, args
+
+def from_xml(element, field_type):
+    if element.get("{{{0}}}nil".format(XSI)) == "true":
+        return None
+    if field_type not in TYPES:
+        return convert_value(element.text, field_type)
+    children = {}
+    for child in element:
+        if isinstance(child.tag, str):
+            children.setdefault(etree.QName(child).localname, []).append(child)
+    value = {}
+    for name, child_type in TYPES[field_type]:
+        elements = children.get(name) or []
+        if child_type.endswith("[]"):
+            value[name] = [from_xml(e, child_type[:-2]) for e in elements]
+        else:
+            value[name] = from_xml(elements[0], child_type) if elements else None
+    return value
+
+def convert_value(text, field_type):
+    if text is None:
+        return None
+    if field_type in ("int", "long"):
+        return int(text)
+    if field_type == "boolean":
+        return text.strip() in ("true", "1")
+    return text
+
+def render_response(operation, result):
+    envelope = etree.Element("{{{0}}}Envelope".format(SOAP_ENV), nsmap={'S': SOAP_ENV})
+    body = etree.SubElement(envelope, "{{{0}}}Body".format(SOAP_ENV))
+    response = etree.SubElement(body, "{{{0}}}{1}Response".format(NAMESPACE, operation), nsmap={'ns2': NAMESPACE})
+    result_type = OPERATIONS[operation][1]
+    if result_type and result is not None:
+        to_xml(response, "return", result, result_type)
+    return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+def to_xml(parent, name, value, field_type):
+    if value is None:
+        return
+    if field_type.endswith("[]"):
+        for item in value:
+            to_xml(parent, name, item, field_type[:-2])
+        return
+    element = etree.SubElement(parent, name)
+    if field_type in TYPES:
+        for child_name, child_type in TYPES[field_type]:
+            to_xml(element, child_name, value.get(child_name), child_type)
+    elif field_type == "boolean":
+        element.text = "true" if value else "false"
+    else:
+        element.text = "{0}".format(value)
+
+def render_fault(err):
+    envelope = etree.Element("{{{0}}}Envelope".format(SOAP_ENV), nsmap={'S': SOAP_ENV})
+    body = etree.SubElement(envelope, "{{{0}}}Body".format(SOAP_ENV))
+    fault = etree.SubElement(body, "{{{0}}}Fault".format(SOAP_ENV))
+    etree.SubElement(fault, "faultcode").text = "S:Server"
+    etree.SubElement(fault, "faultstring").text = "{0}".format(err)
+    return etree.tostring(envelope, xml_declaration=True, encoding="UTF-8")
+
+""" synthetic data """
+def get_timestamp(seconds):
+    dt = datetime.utcfromtimestamp(seconds)
+    return {
+        'timeInSeconds': seconds,
+        'timestamp': dt.strftime("%d.%m.%Y %H:%M"),
+        'day': dt.day,
+        'month': dt.month,
+        'year': dt.year,
+        'hour': dt.hour,
+        'min': dt.minute
+    }
+
+"""
+ Generates <count> booking pairs spread evenly between start and end time (unix timestamps)
+   customers: ZSW customer codes
+   projects: ZSW project codes, a share of the bookings (project_share) is booked on projects
+   materials: material item codes for material properties (key 14)
+ Activities, invoicing types, durations, contacts, travel and material properties are drawn
+ from a seeded random generator, so the same arguments give the same bookings
+"""
+def generate_bookings(count, start_time, end_time, customers, projects=None, materials=None, employees=40,
+        project_share=0.1, level_ids=None, first_booking_id=1000000, seed=1):
+    level_ids = dict(level_ids or DEFAULT_ZSW_LEVELS)
+    rng = random.Random(seed)
+    customers = list(customers)
+    projects = list(projects or [])
+    materials = list(materials or [])
+    step = float(max(1, int(end_time) - int(start_time))) / max(1, int(count))
+    bookings = []
+    for i in range(0, int(count)):
+        duration = rng.choice((15, 30, 45, 60, 90, 120, 240))
+        from_time = int(start_time + i * step)
+        levels = [{'levelID': level_ids['Customer'], 'code': rng.choice(customers)}]
+        if projects and rng.random() < project_share:
+            levels.append({'levelID': level_ids['Item (Activity)'], 'code': rng.choice(("T02", "T04"))})
+            levels.append({'levelID': level_ids['Invoicing Type'], 'code': rng.choice(("J", "J", "J", "N", "P"))})
+            levels.append({'levelID': level_ids['Sales Order'], 'code': rng.choice(projects)})
+        elif rng.random() < 0.6:
+            levels.append({'levelID': level_ids['Item (Activity)'], 'code': "T01"})
+            levels.append({'levelID': level_ids['Invoicing Type'], 'code': rng.choice(("J", "J", "J", "W", "N", "A"))})
+        else:
+            levels.append({'levelID': level_ids['Item (Activity)'], 'code': "T03"})
+            levels.append({'levelID': level_ids['Invoicing Type'], 'code': rng.choice(("J", "V", "V", "N"))})
+        properties = [{'key': 2, 'val': "Contact {0}".format(rng.randint(1, 500))}]
+        if materials and rng.random() < 0.2:
+            properties.append({'key': 14, 'val': "{0} {1}/{2}".format(rng.randint(1, 5), level_ids['Item (Material)'], rng.choice(materials))})
+        if rng.random() < 0.1:
+            properties.append({'key': 11, 'val': rng.choice(sorted(TRAVEL_ITEMS.keys()))})
+        bookings.append({
+            'fromBookingID': first_booking_id + 2 * i,
+            'toBookingID': first_booking_id + 2 * i + 1,
+            'person': rng.randint(1, employees),
+            'duration': duration,
+            'notice': "Synthetic booking {0}".format(i),
+            'from': get_timestamp(from_time),
+            'to': get_timestamp(from_time + 60 * duration),
+            'levels': {'WSLevelIdentification': levels},
+            'properties': {'WSProperty': properties}
+        })
+    return bookings
+
+"""
+ Points finkzeit.finkzeit.zsw to a running stand-in: the module's SOAP client and session pool
+ are replaced for the duration of the block (the pool uses its own session slots) and the local
+ sync state is switched off (zsw.persist_state), so that sync fingerprints, booking store,
+ employee cache, invoiced booking ledger and last sync time of the real ZSW are neither read nor written
+"""
+@contextmanager
+def use_standin(standin, sessions=4):
+    previous = (zsw.client, zsw.session_pool, zsw.persist_state)
+    zsw.client = standin.get_client()
+    zsw.persist_state = False
+    zsw.session_pool = zsw.ZSWSessionPool(
+        client=zsw.client,
+        site="{0}|standin-{1}".format(frappe.local.site, standin.port),
+        license="standin",
+        user="standin",
+        password="standin",
+        size=sessions)
+    try:
+        yield standin
+    finally:
+        zsw.session_pool.close_idle(force=True)
+        zsw.client, zsw.session_pool, zsw.persist_state = previous
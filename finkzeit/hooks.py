@@ -30,7 +30,9 @@ app_include_js = ["/assets/finkzeit/js/fink_common.js", "/assets/finkzeit/js/iba
 doctype_js = {
   "Supplier": "public/js/supplier.js",
   "Customer": "public/js/customer.js",
-  "Payment Entry": "public/js/payment_entry.js"
+  "Payment Entry": "public/js/payment_entry.js",
+  "Sales Order": "public/js/sales_order.js",
+  "Item": "public/js/item.js"
 }
 # doctype_js = {"doctype" : "public/js/doctype.js"}
 doctype_list_js = {
@@ -103,9 +105,13 @@ doctype_list_js = {
 scheduler_events = {
     "cron": {
         "* * * * *": [
-            "frappe.email.queue.flush"
+            "frappe.email.queue.flush",
+            "finkzeit.finkzeit.zsw.scheduled_booking_pull"
         ]
-    }
+    },
+    "hourly": [
+        "finkzeit.finkzeit.zsw.sweep_invoice_runs"
+    ]
 }
 # scheduler_events = {
 # 	"all": [
@@ -130,6 +136,13 @@ scheduler_events = {
 
 # before_tests = "finkzeit.install.before_tests"
 
+# Requests
+# --------
+
+# close the ZSW sessions leased by a desk request (after_request hooks require Frappe v13 or later;
+# on older versions the session pool closes idle sessions after the session idle timeout)
+after_request = ["finkzeit.finkzeit.zsw.disconnect"]
+
 # Overriding Whitelisted Methods
 # ------------------------------
 #
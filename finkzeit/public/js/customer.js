@@ -11,6 +11,7 @@ try {
 frappe.ui.form.on('Customer', {
     refresh(frm) {
         // check_credit_balance(frm);    // disabled 2024-04-30 as no longer used
+        show_zsw_sync_status(frm, ["Customer"]);
     }
 });
 
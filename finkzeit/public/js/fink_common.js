@@ -41,3 +41,26 @@ function check_period(date) {
 function sleep(milliseconds) {
    return new Promise(resolve => setTimeout(resolve, milliseconds));
 }
+
+// show the ZSW sync status of a record (see ZSW Sync Record) on the form dashboard
+function show_zsw_sync_status(frm, record_types) {
+    if (frm.doc.__islocal) {
+        return;
+    }
+    frappe.call({
+        method: "finkzeit.finkzeit.zsw.get_sync_status",
+        args: {
+            record_name: frm.doc.name,
+            record_types: record_types
+        },
+        callback: function (response) {
+            var colors = {'Queued': 'orange', 'Syncing': 'blue', 'Synced': 'green', 'Failed': 'red'};
+            (response.message || []).forEach(function (sync) {
+                if (sync.status) {
+                    frm.dashboard.add_indicator("ZSW " + frappe.utils.escape_html(sync.tenant || "") + ": " + __(sync.status)
+                        + (sync.error ? " (" + frappe.utils.escape_html(sync.error) + ")" : ""), colors[sync.status]);
+                }
+            });
+        }
+    });
+}
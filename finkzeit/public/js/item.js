@@ -0,0 +1,7 @@
+frappe.ui.form.on('Item', {
+    refresh(frm) {
+        if ((frm.doc.sync_as_material_to_zsw) || (frm.doc.sync_as_activity_to_zsw)) {
+            show_zsw_sync_status(frm, ["Item (Material)", "Item (Activity)"]);
+        }
+    }
+});
@@ -0,0 +1,7 @@
+frappe.ui.form.on('Sales Order', {
+    refresh(frm) {
+        if (frm.doc.ist_projekt) {
+            show_zsw_sync_status(frm, ["Sales Order"]);
+        }
+    }
+});